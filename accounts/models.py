@@ -2,6 +2,7 @@ from accounts.listeners import profile_changed
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_save, pre_delete
+from utils.compact_serializer import CompactSerializer
 from utils.listeners import invalidate_object_cache
 
 
@@ -41,4 +42,8 @@ pre_delete.connect(invalidate_object_cache, sender=User)
 post_save.connect(invalidate_object_cache, sender=User)
 
 pre_delete.connect(profile_changed, sender=UserProfile)
-post_save.connect(profile_changed, sender=UserProfile)
\ No newline at end of file
+post_save.connect(profile_changed, sender=UserProfile)
+
+# memcached中只存field的值，见MemcachedHelper.encode
+CompactSerializer.register(User, tag=4)
+CompactSerializer.register(UserProfile, tag=5)
\ No newline at end of file
@@ -1,6 +1,8 @@
 from accounts.models import UserProfile
 from django.conf import settings
 from django.core.cache import caches
+from utils.compact_serializer import CompactSerializer
+from utils.local_cache import LocalCacheHelper
 from utils.memcached_helper import MemcachedHelper
 from weitter.cache import USER_PROFILE_PATTERN
 from django.contrib.auth.models import User
@@ -10,25 +12,87 @@ cache = caches['testing'] if settings.TESTING else caches['default']
 
 class UserService:
 
+    @classmethod
+    def get_profile_key(cls, user_id):
+        # profile和MemcachedHelper中的object一样用紧凑格式存储，key中带有schema version
+        return USER_PROFILE_PATTERN.format(
+            version=CompactSerializer.get_schema_version(UserProfile),
+            user_id=user_id,
+        )
+
     @classmethod
     def get_profile_through_cache(cls, user_id):
-        key = USER_PROFILE_PATTERN.format(user_id=user_id)
+        key = cls.get_profile_key(user_id)
 
-        profile = cache.get(key)
-        if profile is not None:
-            return profile
+        # 先读进程内的cache，见utils/local_cache.py
+        value = LocalCacheHelper.get(key)
+        if value is not None:
+            return MemcachedHelper.decode(value)
+
+        value = cache.get(key)
+        if value is not None:
+            LocalCacheHelper.set(key, value)
+            return MemcachedHelper.decode(value)
 
         # cache miss, read from db
         profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
-        cache.set(key, profile)
+        value = MemcachedHelper.encode(profile)
+        cache.set(key, value)
+        LocalCacheHelper.set(key, value)
         return profile
 
     @classmethod
     def invalidate_profile(cls, user_id):
-        key = USER_PROFILE_PATTERN.format(user_id=user_id)
+        key = cls.get_profile_key(user_id)
         cache.delete(key)
+        LocalCacheHelper.invalidate(key)
 
     @classmethod
     def get_user_by_id(cls, user_id):
         return MemcachedHelper.get_object_through_cache(User, user_id)
 
+    @classmethod
+    def prefetch_profiles(cls, users):
+        """
+        批量版本的get_profile_through_cache，进程内cache没命中的用一次get_many，memcached也没命中的用一次user_id__in查询，
+        读到的profile存在user实例上（见accounts.models.get_profile），之后user.profile不再访问cache
+        """
+        users = [user for user in users if not hasattr(user, '_cached_user_profile')]
+        if not users:
+            return
+        keys = {cls.get_profile_key(user.id): user.id for user in users}
+        values = LocalCacheHelper.get_many(list(keys))
+        missing_keys = [key for key in keys if key not in values]
+        if missing_keys:
+            cached_values = cache.get_many(missing_keys)
+            LocalCacheHelper.set_many(cached_values)
+            values.update(cached_values)
+        profiles = {keys[key]: MemcachedHelper.decode(value) for key, value in values.items()}
+        missing_ids = [user.id for user in users if user.id not in profiles]
+        if missing_ids:
+            db_profiles = {
+                profile.user_id: profile
+                for profile in UserProfile.objects.filter(user_id__in=missing_ids)
+            }
+            for user_id in missing_ids:
+                if user_id not in db_profiles:
+                    db_profiles[user_id], _ = UserProfile.objects.get_or_create(user_id=user_id)
+            db_values = {
+                cls.get_profile_key(user_id): MemcachedHelper.encode(profile)
+                for user_id, profile in db_profiles.items()
+            }
+            cache.set_many(db_values)
+            LocalCacheHelper.set_many(db_values)
+            profiles.update(db_profiles)
+        for user in users:
+            setattr(user, '_cached_user_profile', profiles[user.id])
+
+    @classmethod
+    def prefetch_users(cls, user_ids):
+        """
+        序列化一页数据之前调用，批量读取user和profile，需要在MemcachedHelper.prefetch_scope中
+        """
+        users = MemcachedHelper.prefetch_objects(User, user_ids)
+        cls.prefetch_profiles(users)
+        return users
+
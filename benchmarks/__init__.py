@@ -0,0 +1,28 @@
+"""
+性能对比脚本，不属于单元测试，需要在装好 mysql/redis/memcached/hbase 的开发环境（vagrant）中运行，比如
+    python -m benchmarks.redis_serializers
+"""
+import os
+import timeit
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'weitter.settings')
+    import django
+    django.setup()
+
+
+def measure(func, number, repeat=5):
+    """
+    func 平均每次调用耗时多少微秒，取repeat次中最快的一次，减少其他进程的干扰
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1000000
+
+
+def print_table(headers, rows):
+    widths = [
+        max(len(str(value)) for value in column)
+        for column in zip(headers, *rows)
+    ]
+    for row in [headers] + list(rows):
+        print('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
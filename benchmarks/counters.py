@@ -0,0 +1,69 @@
+"""
+对比热门weit点赞时likes_count的两种更新方式：
+- sync: 每次点赞 UPDATE ... SET likes_count = likes_count + 1，再更新redis中的count cache
+- write-behind: 增量只记在redis中，最后用RedisHelper.flush_pending_counts合并写回数据库（计入总耗时）
+多个线程同时给同一个weit点赞，输出每秒能处理多少次点赞
+    python -m benchmarks.counters
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import print_table, setup_django
+
+setup_django()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.db.models import F  # noqa: E402
+from utils.redis_helper import RedisHelper  # noqa: E402
+from weits.models import Weit  # noqa: E402
+
+LIKES_COUNT = 2000
+THREADS = (1, 8, 32)
+
+
+def sync_like(weit):
+    Weit.objects.filter(id=weit.id).update(likes_count=F('likes_count') + 1)
+    RedisHelper.incr_count(weit, 'likes_count')
+
+
+def write_behind_like(weit):
+    RedisHelper.incr_pending_count(weit, 'likes_count', 1)
+
+
+def run(like, weit, threads):
+    def worker(count):
+        try:
+            for _ in range(count):
+                like(weit)
+        finally:
+            # 每个线程有自己的数据库连接
+            connection.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, [LIKES_COUNT // threads] * threads))
+    RedisHelper.flush_pending_counts()
+    return time.perf_counter() - start
+
+
+def main():
+    user, _ = User.objects.get_or_create(username='benchmark_counters')
+    rows = []
+    try:
+        for threads in THREADS:
+            for name, like in (('sync', sync_like), ('write-behind', write_behind_like)):
+                weit = Weit.objects.create(user=user, content='benchmark hot weit')
+                seconds = run(like, weit, threads)
+                weit.refresh_from_db()
+                total = LIKES_COUNT // threads * threads
+                assert weit.likes_count == total, (weit.likes_count, total)
+                rows.append([name, threads, total, '{:.0f}'.format(total / seconds)])
+    finally:
+        Weit.objects.filter(user=user).delete()
+        user.delete()
+    print_table(['mode', 'threads', 'likes', 'likes/s'], rows)
+
+
+if __name__ == '__main__':
+    main()
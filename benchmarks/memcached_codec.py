@@ -0,0 +1,71 @@
+"""
+对比memcached中object的两种存储格式：
+- pickle: 之前的写法，pickle整个model实例，包括_state和另外加的属性（比如user上的_cached_user_profile）
+- compact: MemcachedHelper.encode，只存field的值，读取时用Model.from_db重建
+输出每个object编码/解码的耗时（微秒）和平均大小（字节），大小决定了每次get_many的网络传输量
+    python -m benchmarks.memcached_codec
+"""
+import pickle
+
+from benchmarks import measure, print_table, setup_django
+
+setup_django()
+
+from accounts.models import UserProfile  # noqa: E402
+from django.contrib.auth.models import User  # noqa: E402
+from utils.memcached_helper import MemcachedHelper  # noqa: E402
+from utils.time_helpers import utc_now  # noqa: E402
+from weits.models import Weit  # noqa: E402
+
+OBJECT_COUNT = 200
+
+
+def build_objects():
+    now = utc_now()
+    profiles = [
+        UserProfile(id=i, user_id=i, nickname='nickname {}'.format(i), avatar='avatars/{}.png'.format(i),
+                    created_at=now, updated_at=now)
+        for i in range(1, OBJECT_COUNT + 1)
+    ]
+    users = []
+    for profile in profiles:
+        user = User(id=profile.user_id, username='benchmark_user_{}'.format(profile.user_id),
+                    email='user{}@weitter.com'.format(profile.user_id), password='pbkdf2_sha256$' + 'x' * 80,
+                    date_joined=now, last_login=now)
+        # 与accounts.models.get_profile之后的user一样
+        user._cached_user_profile = profile
+        users.append(user)
+    weits = [
+        Weit(id=i, user_id=i % 50 + 1, content='benchmark weit content {}'.format(i), created_at=now,
+             likes_count=i % 7, comments_count=i % 3)
+        for i in range(1, OBJECT_COUNT + 1)
+    ]
+    return [('User', users), ('UserProfile', profiles), ('Weit', weits)]
+
+
+def main():
+    # django的memcached backend用pickle.HIGHEST_PROTOCOL
+    codecs = (
+        ('pickle', lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        ('compact', MemcachedHelper.encode, MemcachedHelper.decode),
+    )
+    rows = []
+    for model_name, objects in build_objects():
+        for codec_name, encode, decode in codecs:
+            # compact格式的bytes存到memcached时不会再pickle
+            encoded_list = [encode(obj) for obj in objects]
+            encode_us = measure(lambda: [encode(obj) for obj in objects], 20) / len(objects)
+            decode_us = measure(lambda: [decode(data) for data in encoded_list], 20) / len(objects)
+            size = sum(len(data) for data in encoded_list) / len(encoded_list)
+            rows.append([
+                model_name,
+                codec_name,
+                '{:.2f}'.format(encode_us),
+                '{:.2f}'.format(decode_us),
+                '{:.0f}'.format(size),
+            ])
+    print_table(['model', 'codec', 'encode(us)', 'decode(us)', 'bytes/object'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+对比timeline cache的两种序列化格式：
+- DjangoModelSerializer/HBaseModelSerializer: 之前使用的json格式
+- CompactSerializer: 按tag和field顺序打包的tuple
+输出每个object序列化/反序列化的耗时（微秒），平均大小，以及同样数据存在redis sorted set中占用的内存
+    python -m benchmarks.redis_serializers
+"""
+from benchmarks import measure, print_table, setup_django
+
+setup_django()
+
+from newsfeeds.models import HBaseNewsFeed, NewsFeed  # noqa: E402
+from redis.exceptions import ConnectionError  # noqa: E402
+from utils.redis_client import RedisClient  # noqa: E402
+from utils.compact_serializer import CompactSerializer  # noqa: E402
+from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer  # noqa: E402
+from utils.time_helpers import utc_now  # noqa: E402
+from weits.models import Weit  # noqa: E402
+
+OBJECT_COUNT = 200
+BENCHMARK_KEY = 'benchmark:redis_serializers'
+
+
+def build_objects():
+    now = utc_now()
+    weits = [
+        Weit(id=i, user_id=i % 50 + 1, content='benchmark weit content {}'.format(i), created_at=now,
+             likes_count=i % 7, comments_count=i % 3)
+        for i in range(1, OBJECT_COUNT + 1)
+    ]
+    newsfeeds = [
+        NewsFeed(id=i, user_id=1, weit_id=i, created_at=now)
+        for i in range(1, OBJECT_COUNT + 1)
+    ]
+    hbase_newsfeeds = [
+        HBaseNewsFeed(user_id=1, created_at=1666000000000000 + i, weit_id=i)
+        for i in range(1, OBJECT_COUNT + 1)
+    ]
+    return [
+        ('Weit', weits, DjangoModelSerializer),
+        ('NewsFeed', newsfeeds, DjangoModelSerializer),
+        ('HBaseNewsFeed', hbase_newsfeeds, HBaseModelSerializer),
+    ]
+
+
+def redis_memory_usage(serialized_list):
+    conn = RedisClient.get_connection()
+    conn.delete(BENCHMARK_KEY)
+    conn.zadd(BENCHMARK_KEY, {data: score for score, data in enumerate(serialized_list)})
+    usage = conn.memory_usage(BENCHMARK_KEY)
+    conn.delete(BENCHMARK_KEY)
+    return usage
+
+
+def main():
+    rows = []
+    redis_available = True
+    for model_name, objects, serializer in build_objects():
+        for serializer_class in (serializer, CompactSerializer):
+            serialized_list = [serializer_class.serialize(obj) for obj in objects]
+            serialize_us = measure(lambda: [serializer_class.serialize(obj) for obj in objects], 20) / len(objects)
+            deserialize_us = measure(
+                lambda: [serializer_class.deserialize(data) for data in serialized_list], 20,
+            ) / len(objects)
+            size = sum(len(data) for data in serialized_list) / len(serialized_list)
+            memory = '-'
+            if redis_available:
+                try:
+                    memory = redis_memory_usage(serialized_list)
+                except ConnectionError:
+                    redis_available = False
+            rows.append([
+                model_name,
+                serializer_class.__name__,
+                '{:.2f}'.format(serialize_us),
+                '{:.2f}'.format(deserialize_us),
+                '{:.0f}'.format(size),
+                memory,
+            ])
+    print_table(
+        ['model', 'serializer', 'serialize(us)', 'deserialize(us)', 'bytes/object',
+         'redis bytes/{} objects'.format(OBJECT_COUNT)],
+        rows,
+    )
+    if not redis_available:
+        print('redis is not available, skipped memory usage')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+对比newsfeed列表cache hit时日志的CPU开销（微秒/请求）：
+- f-string: 之前的写法，每次都把整个序列化之后的list和反序列化之后的objects格式化成字符串
+- Tracer: utils/tracing.py，默认只记录大小，payload按TRACE_PAYLOAD_SAMPLE_RATE采样
+分别在日志输出到文件（INFO）和日志被丢弃（WARNING）两种情况下运行，只统计日志部分
+    python -m benchmarks.tracing
+"""
+import logging
+import os
+
+from benchmarks import measure, print_table, setup_django
+
+setup_django()
+
+from django.conf import settings  # noqa: E402
+from newsfeeds.models import HBaseNewsFeed  # noqa: E402
+from utils.loggers import logger  # noqa: E402
+from utils.redis_serializers import HBaseModelSerializer  # noqa: E402
+from utils.tracing import Tracer  # noqa: E402
+
+KEY = 'user_newsfeed_ids:1'
+
+
+def build_timeline():
+    newsfeeds = [
+        HBaseNewsFeed(user_id=1, created_at=1666000000000000 + i, weit_id=i)
+        for i in range(settings.REDIS_LIST_LENGTH_LIMIT)
+    ]
+    return [HBaseModelSerializer.serialize(newsfeed) for newsfeed in newsfeeds], newsfeeds
+
+
+def fstring_logging(serialized_list, objects):
+    logger.info(f'Get key:{KEY} from redis: {serialized_list}')
+    logger.info(f'Cache return deserialized {objects}')
+    logger.info("filter table {}, start={}, stop={}, prefix={}, limit={}, reverse={}, columns={}, filters={}".format(
+        HBaseNewsFeed.get_table_name(), None, None, (1,), 20, True, None, {},
+    ))
+    logger.info(f"filter get results: {objects[:20]}")
+
+
+def tracer_logging(serialized_list, objects):
+    Tracer.payload('redis.hit', serialized_list, key=KEY)
+    Tracer.event(
+        'hbase.filter', level=logging.DEBUG, table=HBaseNewsFeed.Meta.table_name,
+        start=None, stop=None, prefix=(1,), limit=20, reverse=True, columns=None, filters={},
+    )
+    Tracer.payload('hbase.filter_results', objects[:20], table=HBaseNewsFeed.Meta.table_name)
+
+
+def main():
+    serialized_list, objects = build_timeline()
+    # 日志写到/dev/null，只统计格式化和handler的开销
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    logger.handlers = [handler]
+    logger.propagate = False
+
+    rows = []
+    for level in (logging.INFO, logging.WARNING):
+        logger.setLevel(level)
+        before = measure(lambda: fstring_logging(serialized_list, objects), 200)
+        after = measure(lambda: tracer_logging(serialized_list, objects), 200)
+        rows.append([
+            logging.getLevelName(level),
+            '{:.1f}'.format(before),
+            '{:.1f}'.format(after),
+            '{:.1f}'.format(before - after),
+        ])
+    print_table(['logger level', 'f-string(us)', 'Tracer(us)', 'saved(us)/request'], rows)
+
+
+if __name__ == '__main__':
+    main()
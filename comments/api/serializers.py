@@ -1,17 +1,19 @@
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
-from likes.serivces import LikeService
+from likes.api.serializers import HasLikedPrefetchMixin
 from weits.models import Weit
-from utils.redis_helper import RedisHelper
+from utils.serializers import CountsPrefetchMixin, PrefetchListSerializer
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(HasLikedPrefetchMixin, CountsPrefetchMixin, serializers.ModelSerializer):
     user = UserSerializerForComment(source='cached_user')
     has_liked = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
+    count_fields = ('likes_count',)
 
     class Meta:
         model = Comment
@@ -25,13 +27,17 @@ class CommentSerializer(serializers.ModelSerializer):
             'has_liked',
             'likes_count',
         )
+        list_serializer_class = PrefetchListSerializer
 
-    def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+    def prefetch(self, comments):
+        # user，计数和has_liked各批量读取一次
+        UserService.prefetch_users([comment.user_id for comment in comments])
+        self.prefetch_has_liked(comments)
+        super().prefetch(comments)
 
     def get_likes_count(self, obj):
         # return obj.like_set.count()
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self.get_cached_count(obj, 'likes_count')
 
 
 class CommentSerializerForCreate(serializers.ModelSerializer):
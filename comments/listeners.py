@@ -1,4 +1,5 @@
 from django.db.models import F
+from gatekeeper.models import GateKeeper
 from utils.redis_helper import RedisHelper
 
 
@@ -8,6 +9,10 @@ def incr_comments_count(sender, instance, created, **kwargs):
     if not created:
         return
 
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        RedisHelper.incr_pending_count(instance.weit, 'comments_count', 1)
+        return
+
     # handle the comment
     Weit.objects.filter(id=instance.weit_id).update(comments_count=F('comments_count') + 1)
     RedisHelper.incr_count(instance.weit, 'comments_count')
@@ -16,6 +21,10 @@ def incr_comments_count(sender, instance, created, **kwargs):
 def decr_comments_count(sender, instance, **kwargs):
     from weits.models import Weit
 
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        RedisHelper.incr_pending_count(instance.weit, 'comments_count', -1)
+        return
+
     # handle the comment
     Weit.objects.filter(id=instance.weit_id).update(comments_count=F('comments_count') - 1)
     RedisHelper.decr_count(instance.weit, 'comments_count')
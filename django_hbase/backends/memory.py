@@ -0,0 +1,354 @@
+from bisect import bisect_left, bisect_right, insort
+from happybase.util import bytes_increment
+
+import threading
+
+
+# 所有MemoryConnection共享同一份数据，和连到同一个hbase server的多个连接效果一样
+_tables = {}
+_lock = threading.RLock()
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class MemoryTransport:
+
+    def __init__(self):
+        self._open = True
+
+    def is_open(self):
+        return self._open
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+
+class MemoryConnection:
+    """
+    进程内的hbase替身，实现了HBaseModel用到的happybase.Connection/Table/Batch的接口，
+    不需要hbase thrift server，用于本地或ci中跑测试和benchmark，数据只存在当前进程的内存中
+    settings.HBASE_BACKEND = 'memory' 时连接池使用这个连接
+    """
+
+    def __init__(self, host=None, **kwargs):
+        self.host = host
+        self.transport = MemoryTransport()
+
+    def open(self):
+        self.transport.open()
+
+    def close(self):
+        self.transport.close()
+
+    def table(self, name):
+        return MemoryTable(_to_bytes(name))
+
+    def tables(self):
+        with _lock:
+            return sorted(_tables)
+
+    def create_table(self, name, families):
+        name = _to_bytes(name)
+        with _lock:
+            if name in _tables:
+                raise ValueError(f'Table {name} already exists')
+            _tables[name] = MemoryTableData(families)
+
+    def delete_table(self, name, disable=False):
+        name = _to_bytes(name)
+        with _lock:
+            if name not in _tables:
+                raise ValueError(f'Table {name} does not exist')
+            del _tables[name]
+
+
+class MemoryTableData:
+    """
+    一张表的数据，row key有序的list加上row key到列数据的dict，相当于一个sorted dict
+    """
+
+    def __init__(self, families):
+        self.families = [_to_bytes(family) for family in families]
+        self.row_keys = []
+        self.rows = {}
+
+
+class MemoryTable:
+
+    def __init__(self, name):
+        self.name = name
+
+    def _data(self):
+        data = _tables.get(self.name)
+        if data is None:
+            raise ValueError(f'Table {self.name} does not exist')
+        return data
+
+    @staticmethod
+    def _project(row_data, columns):
+        if columns is None:
+            return dict(row_data)
+        columns = [_to_bytes(column) for column in columns]
+        return {
+            column_key: value
+            for column_key, value in row_data.items()
+            if any(column_key == column or column_key.startswith(column + b':') for column in columns)
+        }
+
+    def row(self, row, columns=None, timestamp=None, include_timestamp=False):
+        with _lock:
+            row_data = self._data().rows.get(_to_bytes(row), {})
+            return self._project(row_data, columns)
+
+    def rows(self, rows, columns=None, timestamp=None, include_timestamp=False):
+        results = []
+        with _lock:
+            data = self._data()
+            for row in rows:
+                row = _to_bytes(row)
+                if row in data.rows:
+                    results.append((row, self._project(data.rows[row], columns)))
+        return results
+
+    def _row_keys_in_range(self, row_start, row_stop, reverse):
+        row_keys = self._data().row_keys
+        if not reverse:
+            # [row_start, row_stop)
+            begin = bisect_left(row_keys, row_start) if row_start else 0
+            end = bisect_left(row_keys, row_stop) if row_stop else len(row_keys)
+            return row_keys[begin:end]
+        # 反向scan时row_start在后，(row_stop, row_start]
+        begin = bisect_right(row_keys, row_stop) if row_stop else 0
+        end = bisect_right(row_keys, row_start) if row_start else len(row_keys)
+        return row_keys[begin:end][::-1]
+
+    def scan(self, row_start=None, row_stop=None, row_prefix=None, columns=None, filter=None,
+             timestamp=None, include_timestamp=False, batch_size=1000, scan_batching=None,
+             limit=None, sorted_columns=False, reverse=False):
+        if batch_size < 1:
+            raise ValueError("'batch_size' must be >= 1")
+        if limit is not None and limit < 1:
+            raise ValueError("'limit' must be >= 1")
+        if row_prefix is not None:
+            if row_start is not None or row_stop is not None:
+                raise TypeError("'row_prefix' cannot be combined with 'row_start' or 'row_stop'")
+            row_prefix = _to_bytes(row_prefix)
+            if reverse:
+                row_start, row_stop = bytes_increment(row_prefix), row_prefix
+            else:
+                row_start, row_stop = row_prefix, bytes_increment(row_prefix)
+        row_start = _to_bytes(row_start) if row_start else None
+        row_stop = _to_bytes(row_stop) if row_stop else None
+        row_filter = parse_filter_string(filter)
+
+        with _lock:
+            row_keys = self._row_keys_in_range(row_start, row_stop, reverse)
+
+        returned = 0
+        for row_key in row_keys:
+            with _lock:
+                row_data = self._data().rows.get(row_key)
+            if row_data is None:
+                # scan过程中被删除了
+                continue
+            row_data = row_filter(row_data)
+            if row_data is None:
+                continue
+            row_data = self._project(row_data, columns)
+            if not row_data:
+                continue
+            yield row_key, row_data
+            returned += 1
+            if limit is not None and returned >= limit:
+                return
+
+    def put(self, row, data, timestamp=None, wal=True):
+        with _lock:
+            self._put(self._data(), _to_bytes(row), data)
+
+    def delete(self, row, columns=None, timestamp=None, wal=True):
+        with _lock:
+            self._delete(self._data(), _to_bytes(row), columns)
+
+    @staticmethod
+    def _put(table_data, row, data):
+        if row not in table_data.rows:
+            insort(table_data.row_keys, row)
+            table_data.rows[row] = {}
+        for column_key, value in data.items():
+            table_data.rows[row][_to_bytes(column_key)] = _to_bytes(value)
+
+    @staticmethod
+    def _delete(table_data, row, columns):
+        row_data = table_data.rows.get(row)
+        if row_data is None:
+            return
+        if columns is not None:
+            for column_key in MemoryTable._project(row_data, columns):
+                del row_data[column_key]
+        if columns is None or not row_data:
+            del table_data.rows[row]
+            del table_data.row_keys[bisect_left(table_data.row_keys, row)]
+
+    def batch(self, timestamp=None, batch_size=None, transaction=False, wal=True):
+        return MemoryBatch(self, batch_size=batch_size, transaction=transaction)
+
+
+class MemoryBatch:
+    """
+    与happybase.Batch一样，按mutation（列）计数，达到batch_size时自动send
+    """
+
+    def __init__(self, table, batch_size=None, transaction=False):
+        self._table = table
+        self._batch_size = batch_size
+        self._transaction = transaction
+        self._mutations = []
+        self._mutation_count = 0
+        self.send_count = 0
+
+    def send(self):
+        if not self._mutations:
+            return
+        with _lock:
+            table_data = self._table._data()
+            for is_delete, row, data in self._mutations:
+                if is_delete:
+                    MemoryTable._delete(table_data, row, data)
+                else:
+                    MemoryTable._put(table_data, row, data)
+        self._mutations = []
+        self._mutation_count = 0
+        self.send_count += 1
+
+    def _add(self, is_delete, row, data, count):
+        self._mutations.append((is_delete, _to_bytes(row), data))
+        self._mutation_count += count
+        if self._batch_size and self._mutation_count >= self._batch_size:
+            self.send()
+
+    def put(self, row, data, wal=None):
+        self._add(False, row, data, len(data))
+
+    def delete(self, row, columns=None, wal=None):
+        self._add(True, row, columns, len(columns) if columns is not None else 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._transaction and exc_type is not None:
+            return
+        self.send()
+
+
+def _tokenize_arguments(arguments):
+    """
+    把filter的参数按逗号分开，单引号中的逗号不算，单引号中的''表示一个单引号
+    "'cf', 'a''b', =" -> ['cf', "a'b", '=']
+    """
+    values, current, in_quote, index = [], '', False, 0
+    while index < len(arguments):
+        char = arguments[index]
+        if in_quote:
+            if char == "'" and arguments[index + 1: index + 2] == "'":
+                current += "'"
+                index += 1
+            elif char == "'":
+                in_quote = False
+            else:
+                current += char
+        elif char == "'":
+            in_quote = True
+        elif char == ',':
+            values.append(current.strip())
+            current = ''
+        else:
+            current += char
+        index += 1
+    if current.strip():
+        values.append(current.strip())
+    return values
+
+
+def _split_filters(filter_string):
+    """
+    "A() AND B('x')" -> [('A', ''), ('B', "'x'")]，目前只支持用AND连接的filter
+    """
+    filters, index = [], 0
+    while index < len(filter_string):
+        open_index = filter_string.index('(', index)
+        name = filter_string[index:open_index].strip()
+        if name.startswith('AND '):
+            name = name[4:].strip()
+        in_quote, close_index = False, open_index + 1
+        while in_quote or filter_string[close_index] != ')':
+            if filter_string[close_index] == "'":
+                in_quote = not in_quote
+            close_index += 1
+        filters.append((name, filter_string[open_index + 1:close_index]))
+        index = close_index + 1
+        while index < len(filter_string) and filter_string[index] == ' ':
+            index += 1
+    return filters
+
+
+COMPARE_OPERATORS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def parse_filter_string(filter_string):
+    """
+    把hbase的filter string转化为一个函数，输入一行的数据，返回过滤之后的数据，整行被过滤掉时返回None
+    只支持HBaseModel会用到的FirstKeyOnlyFilter，KeyOnlyFilter和SingleColumnValueFilter
+    """
+    if not filter_string:
+        return lambda row_data: row_data
+
+    column_filters, cell_filters = [], []
+    for name, arguments in _split_filters(filter_string):
+        arguments = _tokenize_arguments(arguments)
+        if name == 'FirstKeyOnlyFilter':
+            cell_filters.append(lambda row_data: dict(sorted(row_data.items())[:1]))
+        elif name == 'KeyOnlyFilter':
+            cell_filters.append(lambda row_data: {column_key: b'' for column_key in row_data})
+        elif name == 'SingleColumnValueFilter':
+            family, qualifier, operator, comparator = arguments[:4]
+            filter_if_missing = len(arguments) > 4 and arguments[4].lower() == 'true'
+            if not comparator.startswith('binary:'):
+                raise NotImplementedError(f'Unsupported comparator {comparator}')
+            column_filters.append((
+                _to_bytes(f'{family}:{qualifier}'),
+                COMPARE_OPERATORS[operator],
+                _to_bytes(comparator[len('binary:'):]),
+                filter_if_missing,
+            ))
+        else:
+            raise NotImplementedError(f'Unsupported filter {name}')
+
+    def row_filter(row_data):
+        for column_key, compare, value, filter_if_missing in column_filters:
+            if column_key not in row_data:
+                if filter_if_missing:
+                    return None
+                continue
+            if not compare(row_data[column_key], value):
+                return None
+        for cell_filter in cell_filters:
+            row_data = cell_filter(row_data)
+        return row_data
+
+    return row_filter
@@ -1,15 +1,282 @@
+from contextlib import contextmanager
 from django.conf import settings
+from django_hbase.backends.memory import MemoryConnection
+from thriftpy2.thrift import TException
 
 import happybase
+import os
+import socket
+import threading
+import time
+
+
+# settings.HBASE_BACKEND 可选的连接实现
+HBASE_BACKENDS = {
+    'happybase': happybase.Connection,
+    'memory': MemoryConnection,
+}
+
+
+class NoConnectionsAvailable(RuntimeError):
+    pass
+
+
+def get_connection_class(backend):
+    if backend not in HBASE_BACKENDS:
+        raise ValueError(f'Unknown HBase backend {backend}, choices are {list(HBASE_BACKENDS)}')
+    return HBASE_BACKENDS[backend]
+
+
+class PooledConnection:
+    """
+    连接池中的一个连接，记录创建时间和最近一次归还时间，用于健康检查、闲置淘汰和连接年龄统计
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+    def age(self, now=None):
+        return (now or time.monotonic()) - self.created_at
+
+    def idle_time(self, now=None):
+        return (now or time.monotonic()) - self.last_used_at
+
+    def close(self):
+        try:
+            self.connection.close()
+        except (TException, socket.error):
+            pass
+
+
+class HBaseConnectionPool:
+    """
+    有上限的 HBase thrift 连接池
+    - 同一个线程内嵌套 checkout 时复用同一个连接，不会重复占用连接
+    - 连接惰性创建，最多 size 个，池满时最多等待 timeout 秒，超时抛出 NoConnectionsAvailable
+    - 闲置超过 max_idle_time 的连接直接淘汰，因为 thrift server 会主动断开 idle 连接（见 settings 中 hbase 安装说明 11，12）
+    - 闲置超过 health_check_interval 的连接在 checkout 时先 ping 一下，失败则重连
+    - 存活超过 max_age 的连接归还时直接关闭
+    - 使用过程中遇到 transport 错误时关闭该连接，下次 checkout 会重新建立连接
+    - celery prefork 的 worker 进程 fork 之后会重建连接池，不会和父进程共享 socket
+    """
+
+    def __init__(self, size, timeout=None, max_idle_time=None, max_age=None,
+                 health_check_interval=None, connection_class=happybase.Connection, **connection_kwargs):
+        if size < 1:
+            raise ValueError('HBase connection pool size must be >= 1')
+        self.size = size
+        self.timeout = timeout
+        self.max_idle_time = max_idle_time
+        self.max_age = max_age
+        self.health_check_interval = health_check_interval
+        self.connection_class = connection_class
+        self.connection_kwargs = connection_kwargs
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Condition()
+        self._local = threading.local()
+        # 栈结构，最近归还的连接在最后，优先复用，最久没用的连接在最前面，方便淘汰
+        self._idle = []
+        self._in_use = set()
+        self._total = 0
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'reconnects': 0,
+            'evictions': 0,
+            'transport_errors': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # fork 之后继承下来的 socket 不能在父子进程之间共享，直接丢弃重建
+            self._reset()
+
+    def _create_connection(self):
+        return PooledConnection(self.connection_class(**self.connection_kwargs))
+
+    def _is_healthy(self, pooled, now):
+        if not pooled.connection.transport.is_open():
+            return False
+        if self.health_check_interval is None or pooled.idle_time(now) < self.health_check_interval:
+            return True
+        try:
+            pooled.connection.tables()
+        except (TException, socket.error):
+            return False
+        return True
+
+    def _pop_expired_locked(self, now):
+        """
+        把闲置太久的连接从栈底移出，需要在持有锁时调用，返回需要关闭的连接
+        """
+        expired = []
+        if self.max_idle_time is None:
+            return expired
+        while self._idle and self._idle[0].idle_time(now) > self.max_idle_time:
+            expired.append(self._idle.pop(0))
+            self._total -= 1
+        self._stats['evictions'] += len(expired)
+        return expired
+
+    def _acquire(self, timeout):
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._lock:
+            expired = self._pop_expired_locked(start)
+            while not self._idle and self._total >= self.size:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise NoConnectionsAvailable(
+                        f'No HBase connection available in {timeout} seconds, pool size {self.size}'
+                    )
+                self._lock.wait(remaining)
+            pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                self._total += 1
+            waited = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+
+        for connection in expired:
+            connection.close()
+
+        stat_key = None
+        try:
+            if pooled is None:
+                pooled = self._create_connection()
+                stat_key = 'created'
+            elif not self._is_healthy(pooled, time.monotonic()):
+                pooled.close()
+                pooled = self._create_connection()
+                stat_key = 'reconnects'
+        except Exception:
+            # 建立连接失败，把占的名额还回去
+            with self._lock:
+                self._total -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            if stat_key is not None:
+                self._stats[stat_key] += 1
+            self._in_use.add(pooled)
+        return pooled
+
+    def _release(self, pooled, broken=False):
+        now = time.monotonic()
+        with self._lock:
+            self._in_use.discard(pooled)
+            if broken:
+                self._stats['transport_errors'] += 1
+            discard = broken or (self.max_age is not None and pooled.age(now) > self.max_age)
+            if discard:
+                self._total -= 1
+            else:
+                pooled.last_used_at = now
+                self._idle.append(pooled)
+            self._lock.notify()
+        if discard:
+            pooled.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        with pool.connection() as conn: 从连接池中借出一个 happybase.Connection，with 结束时自动归还
+        """
+        self._check_pid()
+        local = self._local
+        if getattr(local, 'pooled', None) is None:
+            local.pooled = self._acquire(self.timeout if timeout is None else timeout)
+            local.depth = 0
+            local.broken = False
+        # 同一个线程中嵌套调用（包括还没迭代完的scan生成器），直接复用外层借出的连接，
+        # 用引用计数保证最后一个使用者退出时才归还连接
+        pooled = local.pooled
+        local.depth += 1
+        try:
+            yield pooled.connection
+        except (TException, socket.error):
+            local.broken = True
+            raise
+        finally:
+            local.depth -= 1
+            if local.depth == 0:
+                local.pooled = None
+                self._release(pooled, broken=local.broken)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+        for pooled in idle:
+            pooled.close()
+
+    def is_held_by_current_thread(self):
+        # 当前线程是否已经借出了连接，包括外层的with和还没迭代完的scan生成器
+        return getattr(self._local, 'pooled', None) is not None
+
+    def get_stats(self):
+        """
+        连接池的统计数据，用于评估 web worker 和 fanout worker 各自需要的连接池大小
+        """
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            ages = [pooled.age(now) for pooled in self._idle + list(self._in_use)]
+            stats['size'] = self.size
+            stats['total'] = self._total
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._in_use)
+        checkouts = stats['checkouts']
+        stats['wait_time_avg'] = stats['wait_time_total'] / checkouts if checkouts else 0.0
+        stats['connection_age_max'] = max(ages) if ages else 0.0
+        stats['connection_age_avg'] = sum(ages) / len(ages) if ages else 0.0
+        return stats
 
 
 class HBaseClient:
-    _conn = None
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        if cls._pool is not None:
+            return cls._pool
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = HBaseConnectionPool(
+                    size=settings.HBASE_POOL_SIZE,
+                    timeout=settings.HBASE_POOL_TIMEOUT,
+                    max_idle_time=settings.HBASE_CONNECTION_MAX_IDLE_TIME,
+                    max_age=settings.HBASE_CONNECTION_MAX_AGE,
+                    health_check_interval=settings.HBASE_POOL_HEALTH_CHECK_INTERVAL,
+                    connection_class=get_connection_class(settings.HBASE_BACKEND),
+                    host=settings.HBASE_HOST,
+                )
+        return cls._pool
+
+    @classmethod
+    def connection(cls, timeout=None):
+        """
+        with HBaseClient.connection() as conn: 借出连接池中的连接
+        """
+        return cls.get_pool().connection(timeout=timeout)
 
     @classmethod
     def get_connection(cls):
-        # if cls._conn:
-        #     return cls._conn
-        cls._conn = happybase.Connection(settings.HBASE_HOST)
-        return cls._conn
+        # 不经过连接池的独立连接，仅用于 shell 或者脚本里临时调试，调用方负责 close
+        return get_connection_class(settings.HBASE_BACKEND)(settings.HBASE_HOST)
 
+    @classmethod
+    def get_pool_stats(cls):
+        return cls.get_pool().get_stats()
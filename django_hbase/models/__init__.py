@@ -1,3 +1,5 @@
+from .batch import *
 from .fields import *
 from .hbase_models import *
+from .parallel import *
 from .exceptions import *
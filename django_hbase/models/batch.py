@@ -0,0 +1,75 @@
+from .exceptions import EmptyColumnError
+from django.conf import settings
+
+
+class HBaseBatch:
+    """
+    批量写入，put和delete可以混合使用，攒够batch_size个mutation时自动发送一次thrift请求，内存中最多只保留batch_size个mutation
+    with HBaseNewsFeed.batch(batch_size=1000) as batch:
+        batch.create(user_id=1, created_at=123, weit_id=2)
+        batch.delete(user_id=1, created_at=100)
+    with正常结束时发送剩下的mutation，with中抛出异常时不再发送还没发送的部分
+    wal=False 时不写hbase的WAL，只用于可以重跑的离线回填，region server挂掉会丢数据
+    """
+
+    def __init__(self, model_class, batch_size=None, wal=True, write_legacy=True):
+        self.model_class = model_class
+        self.batch_size = batch_size or settings.HBASE_BATCH_SIZE
+        self.wal = wal
+        self._table_context = None
+        self._batch = None
+        # 迁移row key编码的过程中，需要同时写老表
+        self._legacy_batch = None
+        if write_legacy and model_class._legacy_model is not None:
+            self._legacy_batch = HBaseBatch(model_class._legacy_model, batch_size=batch_size, wal=wal)
+
+    def __enter__(self):
+        self._table_context = self.model_class.get_table()
+        table = self._table_context.__enter__()
+        self._batch = table.batch(batch_size=self.batch_size, wal=self.wal)
+        if self._legacy_batch is not None:
+            self._legacy_batch.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # send失败时，把异常传给老表的batch和get_table()，连接池才会丢掉出错的连接
+        try:
+            if exc_type is None:
+                self._batch.send()
+        except Exception as e:
+            exc_type, exc_value, traceback = type(e), e, e.__traceback__
+            raise
+        finally:
+            self._batch = None
+            try:
+                # 不管send是否成功，老表的batch都要退出，否则借出的连接不会归还
+                if self._legacy_batch is not None:
+                    self._legacy_batch.__exit__(exc_type, exc_value, traceback)
+            except Exception as e:
+                exc_type, exc_value, traceback = type(e), e, e.__traceback__
+                raise
+            finally:
+                self._table_context.__exit__(exc_type, exc_value, traceback)
+
+    def save(self, instance):
+        row_data = instance.serialize_row_data(instance.to_dict())
+        if not row_data:
+            raise EmptyColumnError("columns should not be empty")
+        self._batch.put(instance.row_key, row_data)
+        if self._legacy_batch is not None:
+            self._legacy_batch.save(self.model_class._legacy_model(**instance.to_dict()))
+
+    def create(self, **kwargs):
+        instance = self.model_class(**kwargs)
+        self.save(instance)
+        return instance
+
+    def delete(self, **kwargs):
+        self._batch.delete(self.model_class.serialize_row_key(kwargs))
+        if self._legacy_batch is not None:
+            self._legacy_batch.delete(**kwargs)
+
+    def send(self):
+        self._batch.send()
+        if self._legacy_batch is not None:
+            self._legacy_batch.send()
@@ -4,3 +4,7 @@ class EmptyColumnError(Exception):
 
 class BadRowKeyError(Exception):
     pass
+
+
+class BadColumnError(Exception):
+    pass
@@ -7,6 +7,22 @@ class HBaseField:
         self.column_family = column_family
         #TODO: 增加is_required 属性，默认为true， default属性，默认为None， 并在HBaseModel中做相应处理，抛出相应异常
 
+    def make_serializer(self):
+        """
+        返回把field的值序列化为字符串的函数，只在HBaseModel类创建时调用一次，避免每次序列化都判断field类型
+        """
+        if self.reverse:
+            return lambda value: str(value)[::-1]
+        return str
+
+    def make_deserializer(self):
+        """
+        返回把字符串反序列化为field的值的函数
+        """
+        if self.reverse:
+            return lambda value: value[::-1]
+        return lambda value: value
+
 
 class IntegerField(HBaseField):
     field_type = 'int'
@@ -14,9 +30,25 @@ class IntegerField(HBaseField):
     def __init__(self, *args, **kwargs):
         super(IntegerField, self).__init__(*args, **kwargs)
 
+    def make_serializer(self):
+        # 因为排序要按照字典序排序，所以要固定int为16位，长度是16，不足的给integer前面补0
+        if self.reverse:
+            return lambda value: str(value).rjust(16, '0')[::-1]
+        return lambda value: str(value).rjust(16, '0')
+
+    def make_deserializer(self):
+        if self.reverse:
+            return lambda value: int(value[::-1])
+        return int
+
 
 class TimestampField(HBaseField):
     field_type = 'timestamp'
 
     def __init__(self, *args, **kwargs):
         super(TimestampField, self).__init__(*args, **kwargs)
+
+    def make_deserializer(self):
+        if self.reverse:
+            return lambda value: int(value[::-1])
+        return int
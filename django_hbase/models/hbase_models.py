@@ -1,99 +1,170 @@
-from .exceptions import EmptyColumnError, BadRowKeyError
-from .fields import HBaseField, IntegerField, TimestampField
+import logging
+from contextlib import contextmanager
+from .batch import HBaseBatch
+from .exceptions import BadColumnError, EmptyColumnError, BadRowKeyError
+from .fields import HBaseField
+from .parallel import HBaseParallelScan
+from .row_key_codecs import ROW_KEY_CODECS, StringRowKeyCodec
 from django.conf import settings
 from django_hbase.client import HBaseClient
 from utils.loggers import logger
+from utils.tracing import Tracer
+
+# 与happybase scan的默认batch_size一致
+DEFAULT_SCAN_BATCH_SIZE = 1000
+# 每行只返回第一个cell的key，不返回value，用于只关心row key的scan，比如计数
+KEY_ONLY_FILTER = 'FirstKeyOnlyFilter() AND KeyOnlyFilter()'
+# filter中column field过滤条件的后缀与hbase filter string中比较符的对应关系
+COLUMN_FILTER_OPERATORS = {
+    'exact': '=',
+    'ne': '!=',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+}
 
 
 # 需要理解透cls，self 即类和实例之间区别，万物皆对象，cls和self是不同的对象，那么类属性和实例的属性则是分开的,
 # 这里可以把cls和self当成不同实例，cls用来取Field对应的名称和类型，self用来给Field对应名称来赋一个新值
-# 也需要理解__dict__中变量名和值的映射
+# 也需要理解__dict__中变量名和值的映射，field的定义由元类HBaseModelMeta收集到_fields中，实例的值存在__slots__里
 # 重要：目前版本，传入happybase的参数字符串不需要encode成bytes了（比如row_key，value等），但是从hbase读取到的值还是bytes，注意转换成相应类型
-class HBaseModel:
+class HBaseModelMeta(type):
+    """
+    HBaseModel的元类，在类创建时只做一次schema的编译，之后的序列化和反序列化都直接查表：
+    - _fields: field名称 -> HBaseField实例，包括从父类继承的field
+    - _row_key_fields: row key各组成部分的 (field名称, HBaseField实例)
+    - _row_key_codec: row key的编码方式，由Meta.row_key_codec指定，默认'string'，见row_key_codecs
+    - _legacy_model: Meta.legacy_table_name不为空时，表示正在把老表迁移到新的row key编码，
+      这里是用老表和字符串row key自动生成的model，用于双写和读取迁移前的数据
+    - _column_keys: column field名称 -> 'column_family:field名称'
+    - _column_field_names: b'column_family:field名称' -> field名称，用于反序列化hbase返回的列
+    - _column_families: 建表需要的列簇
+    - _serializers/_deserializers: field名称 -> 对应的序列化/反序列化函数
+    类属性中的HBaseField会被移到_fields中，实例改用__slots__存储field的值，scan大量数据时可以省内存，减少对象分配
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, '_fields', {}))
+        inherited_field_names = set(fields)
+        for field_name, field_type in list(attrs.items()):
+            if isinstance(field_type, HBaseField):
+                fields[field_name] = attrs.pop(field_name)
+        attrs.setdefault('__slots__', tuple(
+            field_name for field_name in fields if field_name not in inherited_field_names
+        ))
+        cls = super(HBaseModelMeta, mcs).__new__(mcs, name, bases, attrs)
+
+        cls._fields = fields
+        cls._serializers = {
+            field_name: field_type.make_serializer()
+            for field_name, field_type in fields.items()
+        }
+        cls._deserializers = {
+            field_name: field_type.make_deserializer()
+            for field_name, field_type in fields.items()
+        }
+        cls._row_key_fields = tuple(
+            (field_name, fields[field_name])
+            for field_name in cls.Meta.row_key
+        )
+        cls._row_key_codec = ROW_KEY_CODECS[getattr(cls.Meta, 'row_key_codec', StringRowKeyCodec.name)](
+            name,
+            cls._row_key_fields,
+        )
+        cls._column_keys = {
+            field_name: '{}:{}'.format(field_type.column_family, field_name)
+            for field_name, field_type in fields.items()
+            if field_type.column_family
+        }
+        cls._column_field_names = {
+            column_key.encode('utf-8'): field_name
+            for field_name, column_key in cls._column_keys.items()
+        }
+        cls._column_families = {
+            field_type.column_family: dict()
+            for field_type in fields.values()
+            if field_type.column_family
+        }
+
+        cls._legacy_model = None
+        legacy_table_name = getattr(cls.Meta, 'legacy_table_name', None)
+        if legacy_table_name:
+            class LegacyMeta:
+                table_name = legacy_table_name
+                row_key = cls.Meta.row_key
+                row_key_codec = StringRowKeyCodec.name
+
+            legacy_attrs = dict(fields)
+            legacy_attrs.update({'Meta': LegacyMeta, '__module__': cls.__module__})
+            # 直接继承HBaseModel，这样测试时会和其他model一样自动建表删表
+            cls._legacy_model = mcs('Legacy' + name, (HBaseModel, ), legacy_attrs)
+        return cls
+
+
+class HBaseModel(metaclass=HBaseModelMeta):
+    __slots__ = ()
+
     class Meta:
         row_key = ()
         table_name = None
 
     def __init__(self, **kwargs):
         """
-        实例化，需要对类属性的所有field进行赋值操作，来生成实例化的对象的对应属性
-        实例化对象的属性名称与类属性名相同，值是具体的值，比如整数或者字符串等，而HbaseModel类属性的值是HBaseField实例
+        实例化，需要对类的所有field进行赋值操作，来生成实例化的对象的对应属性
+        实例化对象的属性名称与field名相同，值是具体的值，比如整数或者字符串等，而field的定义（HBaseField实例）由元类存放在类的_fields中
         所以在init中要对实例化对象进行对应属性的赋值操作
         field_name表示类/实例对象中的HBaseField类型属性名称，
         field_value或者value表示对象属性field的值，
-        field_type表示类属性field的值，即HBaseField的实例
+        field_type表示field的定义，即HBaseField的实例
         """
-        field_maps = self.get_field_maps()
-        for field_name in field_maps.keys():
+        for field_name in self._fields:
             setattr(self, field_name, kwargs.get(field_name))
 
     @classmethod
     def get_field_maps(cls):
         """
-        获取HbaseModel类中所有的field，
+        获取HbaseModel类中所有的field，由元类在类创建时生成，调用方不要修改返回的dict
         return dict，key是field名称，value是field类型对应实例
         """
-        field_maps = dict()
-        for field_name, field_type in cls.__dict__.items():
-            if isinstance(field_type, HBaseField):
-                field_maps[field_name] = field_type
-        return field_maps
+        return cls._fields
+
+    def to_dict(self):
+        """
+        实例中所有field的值，实例使用__slots__，没有__dict__
+        """
+        return {field_name: getattr(self, field_name) for field_name in self._fields}
 
     @classmethod
-    def serialize_field(cls, field_type, value):
+    def serialize_field(cls, field_name, value):
         """
-        序列化单个字段field为字符串
+        序列化单个字段field为字符串，使用元类中生成的序列化函数
         int类型不足16位前置补0
         需要反转的字段进行反转
         """
-        value = str(value)
-        if isinstance(field_type, IntegerField):
-            while len(value) < 16:
-                value = '0' + value
-        if field_type.reverse:
-            value = value[::-1]
-        return value
+        return cls._serializers[field_name](value)
 
     @classmethod
     def deserialize_field(cls, field_name, field_value):
         """
         针对field的字符串值进行反序列化
         """
-        #field_value = column_value.decode('utf-8')
-        field_type = cls.get_field_maps()[field_name]
-        if field_type.reverse:
-            field_value = field_value[::-1]
-        if field_type.field_type in [IntegerField.field_type, TimestampField.field_type]:
-            return int(field_value)
-        return field_value
+        return cls._deserializers[field_name](field_value)
 
     @classmethod
     def serialize_row_key(cls, data, is_prefix=False):
         """
-        序列化row key成为字节格式，先转变为string，再encode到bytes
-        序列化格式为，多个属性的值用冒号:分割
+        序列化row key成为字节格式，具体格式由_row_key_codec决定
+        默认的字符串格式为，先转变为string，多个属性的值用冒号:分割，再encode到bytes
         is_prefix 为True则只serialize row_key的前缀部分然后跳出循环，不需要对所有row_key组成部分serialize
         {key1: val1} -> b"val1"
         {key1: val1, key2: val2} -> b"val1:val2"
         """
-        if not cls.Meta.row_key:
+        if not cls._row_key_fields:
             raise BadRowKeyError('Missing row key in Hbase Meta class')
-        row_key_values = []
-        field_maps = cls.get_field_maps()
-        for key in cls.Meta.row_key:
-            value = data.get(key)
-            if not value:
-                if not is_prefix:
-                    raise BadRowKeyError(f'{key} is missing in row key of {cls.__name__}')
-                # 若是前缀的话，遇到空的部分直接跳出返回
-                break
-            field_type = field_maps.get(key)
-            value = cls.serialize_field(field_type, value)
-            # 对于连接符":"的判断放到serialize_field_value() 中去？
-            if ':' in value:
-                raise BadRowKeyError(f'{key} should not contain ":" in its serialized value {value}')
-            row_key_values.append(value)
-        return bytes(':'.join(row_key_values), encoding='utf-8')
+        return cls._row_key_codec.encode(data, is_prefix=is_prefix)
 
     @classmethod
     def deserialize_row_key(cls, row_key):
@@ -103,17 +174,7 @@ class HBaseModel:
         "val1:val2:val3" -> {'key1':va1, 'key2': val2, 'key3': val3}
         若row_key不是二进制字节，可以直接处理字符串格式，否则进行转换
         """
-        if isinstance(row_key, bytes):
-            row_key = row_key.decode('utf-8')
-        field_data_maps = dict()
-        field_values = row_key.split(':')
-        index = 0
-        for field_name in cls.Meta.row_key:
-            if index >= len(field_values):
-                break
-            field_data_maps[field_name] = cls.deserialize_field(field_name, field_values[index])
-            index += 1
-        return field_data_maps
+        return cls._row_key_codec.decode(row_key)
 
     @classmethod
     def serialize_row_data(cls, data):
@@ -122,13 +183,11 @@ class HBaseModel:
         返回dict，key为column_family:column_qualifier进行列簇和列进行连接，value为对应的最新版本的值, 且要进行field序列化
         """
         row_data = {}
-        field_maps = cls.get_field_maps()
-        for field_name, field_type in field_maps.items():
-            if field_type.column_family:
-                column_key = "{}:{}".format(field_type.column_family, field_name)
-                value = data.get(field_name)
-                if value is not None:
-                    row_data[column_key] = cls.serialize_field(field_type, value)
+        serializers = cls._serializers
+        for field_name, column_key in cls._column_keys.items():
+            value = data.get(field_name)
+            if value is not None:
+                row_data[column_key] = serializers[field_name](value)
         return row_data
 
     @property
@@ -136,7 +195,7 @@ class HBaseModel:
         """
         属性方法，将row key视作一个属性
         """
-        return self.serialize_row_key(self.__dict__)
+        return self.serialize_row_key(self.to_dict())
 
     @classmethod
     def init_from_row(cls, row_key, row_data):
@@ -147,72 +206,157 @@ class HBaseModel:
         if len(row_data) == 0:
             return None
         field_data_maps = cls.deserialize_row_key(row_key)
+        column_field_names = cls._column_field_names
+        deserializers = cls._deserializers
         for column_key, column_value in row_data.items():
             # 分别把key和value反序列化，先把key先反序列化
-            field_name = column_key.decode('utf-8')
-            index = field_name.find(':')
-            # 没找到:时，直接把整个key当作field name
-            field_name = field_name[index + 1:]
+            field_name = column_field_names.get(column_key)
+            if field_name is None:
+                field_name = column_key.decode('utf-8')
+                # 没找到:时，直接把整个key当作field name
+                field_name = field_name[field_name.find(':') + 1:]
             # 把data中的value也反序列化
-            column_value = column_value.decode('utf-8')
-            field_value = cls.deserialize_field(field_name, column_value)
-            field_data_maps[field_name] = field_value
+            field_data_maps[field_name] = deserializers[field_name](column_value.decode('utf-8'))
         return cls(**field_data_maps)
 
     @classmethod
+    @contextmanager
     def get_table(cls):
         """
-        连接HBase数据库，获取对应数据表table
+        从连接池借出连接，获取对应数据表table，with 结束时连接归还连接池
+        with cls.get_table() as table:
         """
-        conn = HBaseClient.get_connection()
-        return conn.table(cls.get_table_name())
+        with HBaseClient.connection() as conn:
+            yield conn.table(cls.get_table_name())
 
     @classmethod
     def get(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row_data = table.row(row_key)
-        return cls.init_from_row(row_key, row_data)
+        with cls.get_table() as table:
+            row_data = table.row(row_key)
+        instance = cls.init_from_row(row_key, row_data)
+        if instance is None and cls._legacy_model is not None:
+            # 迁移过程中新表里没有的行，可能还没从老表迁移过来
+            instance = cls.from_legacy(cls._legacy_model.get(**kwargs))
+        return instance
+
+    @classmethod
+    def get_many(cls, row_keys, columns=None):
+        """
+        批量get，一次thrift请求拿到多行数据
+        row_keys 是dict的list，每个dict与get的参数相同，比如[{'user_id': 1, 'created_at': 123}, ...]
+        columns 需要返回的column field名称，None表示返回所有列，row key中的field总会返回
+        返回的实例顺序与row_keys一致，行不存在时对应位置为None
+        """
+        serialized_row_keys = [cls.serialize_row_key(data) for data in row_keys]
+        if not serialized_row_keys:
+            return []
+        with cls.get_table() as table:
+            rows = dict(table.rows(serialized_row_keys, columns=cls.get_columns(columns)))
+        instances = [
+            cls.init_from_row(row_key, rows[row_key]) if row_key in rows else None
+            for row_key in serialized_row_keys
+        ]
+        if cls._legacy_model is not None:
+            missing_indexes = [index for index, instance in enumerate(instances) if instance is None]
+            if missing_indexes:
+                legacy_instances = cls._legacy_model.get_many(
+                    [row_keys[index] for index in missing_indexes],
+                    columns=columns,
+                )
+                for index, legacy_instance in zip(missing_indexes, legacy_instances):
+                    instances[index] = cls.from_legacy(legacy_instance)
+        return instances
+
+    @classmethod
+    def get_columns(cls, field_names):
+        """
+        把field名称转化为hbase中的'column_family:field名称'，row key中的field不需要转换
+        """
+        if field_names is None:
+            return None
+        columns = []
+        for field_name in field_names:
+            if field_name in cls._column_keys:
+                columns.append(cls._column_keys[field_name])
+            elif field_name not in cls._fields:
+                raise BadColumnError(f'{field_name} is not a field of {cls.__name__}')
+        return columns
 
     def save(self, batch=None):
         """
         用类似django model的方式对实例对应的数据，进行保存修改
         """
 
-        row_data = self.serialize_row_data(self.__dict__)
+        row_data = self.serialize_row_data(self.to_dict())
         if not row_data:
             raise EmptyColumnError("columns should not be empty")
         if batch is not None:
             batch.put(self.row_key, row_data)
         else:
-            table = self.get_table()
-            table.put(self.row_key, row_data)
+            with self.get_table() as table:
+                table.put(self.row_key, row_data)
+            if self._legacy_model is not None:
+                self._legacy_model(**self.to_dict()).save()
 
     @classmethod
     def create(cls, batch=None, **kwargs):
         """
         用类似django model的方式，以类方法创建一个实例，如XXXHBaseModel.create(a=x,b=y,c=z)
         """
-        logger.info(f"Create cell in hbase table {cls.get_table_name()} with values {kwargs}")
         instance = cls(**kwargs)
         instance.save(batch=batch)
-        logger.info(f"Hbase created cell in table {cls.get_table_name()} with data: {instance}")
+        Tracer.event('hbase.create', level=logging.DEBUG, table=cls.Meta.table_name, values=kwargs)
         return instance
 
     @classmethod
-    def batch_create(cls, batch_data):
+    def batch(cls, batch_size=None, wal=True, write_legacy=True):
         """
-        批量创建
+        返回HBaseBatch，用with批量写入，batch_size默认为settings.HBASE_BATCH_SIZE，详见HBaseBatch
         """
-        logger.info(f"Batch create cell in hbase table {cls.get_table_name()} with batch data {batch_data}")
+        return HBaseBatch(cls, batch_size=batch_size, wal=wal, write_legacy=write_legacy)
 
-        table = cls.get_table()
-        batch = table.batch()
-        results = []
-        for data in batch_data:
-            results.append(cls.create(batch=batch, **data))
-        batch.send()
-        return results
+    @classmethod
+    def batch_create(cls, batch_data, batch_size=None, wal=True):
+        """
+        批量创建，每batch_size行发送一次thrift请求
+        """
+        Tracer.event('hbase.batch_create', table=cls.Meta.table_name, size=len(batch_data))
+        with cls.batch(batch_size=batch_size, wal=wal) as batch:
+            return [batch.create(**data) for data in batch_data]
+
+    @classmethod
+    def from_legacy(cls, legacy_instance):
+        if legacy_instance is None:
+            return None
+        return cls(**legacy_instance.to_dict())
+
+    @classmethod
+    def get_scan_model(cls):
+        """
+        scan时读哪张表，迁移过程中老表的数据是完整的，等迁移完成，
+        在settings.HBASE_ROW_KEY_MIGRATED_TABLES中加上新表名之后才改为scan新表
+        """
+        if cls._legacy_model is None or cls.Meta.table_name in settings.HBASE_ROW_KEY_MIGRATED_TABLES:
+            return cls
+        return cls._legacy_model
+
+    @classmethod
+    def migrate_row_keys(cls, batch_size=DEFAULT_SCAN_BATCH_SIZE, wal=True):
+        """
+        把老表中的数据用新的row key编码写到新表，可以在线执行，迁移期间新的写入会同时写两张表，重复写入同一行不影响结果
+        迁移可以重跑，所以可以用wal=False加快写入
+        返回迁移的行数
+        """
+        if cls._legacy_model is None:
+            raise BadRowKeyError(f'{cls.__name__} has no legacy_table_name in Meta class')
+        migrated = 0
+        with cls.batch(batch_size=batch_size, wal=wal, write_legacy=False) as batch:
+            for legacy_instance in cls._legacy_model.iter_filter(batch_size=batch_size):
+                batch.save(cls.from_legacy(legacy_instance))
+                migrated += 1
+        logger.info(f"Migrated {migrated} rows from {cls._legacy_model.get_table_name()} to {cls.get_table_name()}")
+        return migrated
 
     @classmethod
     def get_table_name(cls):
@@ -226,8 +370,8 @@ class HBaseModel:
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You cannot create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
 
     @classmethod
     def create_table(cls):
@@ -236,17 +380,12 @@ class HBaseModel:
         """
         if not settings.TESTING:
             raise Exception('You cannot create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        # convert bytes to string
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        if cls.get_table_name() in tables:
-            return
-        column_families = {
-            field_type.column_family: dict()
-            for field_name, field_type in cls.get_field_maps().items()
-            if field_type.column_family is not None
-        }
-        conn.create_table(cls.get_table_name(), column_families)
+        with HBaseClient.connection() as conn:
+            # convert bytes to string
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                return
+            conn.create_table(cls.get_table_name(), cls._column_families)
 
     @classmethod
     def serialize_row_key_from_tuple(cls, row_key_tuple):
@@ -262,7 +401,7 @@ class HBaseModel:
         return cls.serialize_row_key(data, is_prefix=True)
 
     @classmethod
-    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
+    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False, columns=None, **column_filters):
         """
         对表进行scan
         start, stop, prefix是针对于row_key，传入一个tuple，区间start，stop 左闭右开 [)，与python列表表示方式一致
@@ -270,32 +409,172 @@ class HBaseModel:
         不需要使用dict，因为我们在使用时并不关心row_key组成部分的名字，而只使用row_key组成部分的值
         limit 最大返回数量
         是否反向scan，比如start=10, stop=1, reverse=True则从10到1反向返回值
-        """
-        logger.info("filter table {}, start={}, stop={}, prefix={}, limit={}, reverse={}".format(
-            cls.get_table_name(),
-            start,
-            stop,
-            prefix,
-            limit,
-            reverse
+        columns 只返回这些column field，None表示返回所有列
+        column_filters 对column field的值进行过滤，在region server中执行，不满足条件的行不会传回来，
+        写法类似django的filter，比如to_user_id=2，to_user_id__gte=2，支持的后缀见COLUMN_FILTER_OPERATORS
+        所有结果会一次性放在list中返回，数据量大或者不需要全部结果时用iter_filter
+        """
+        Tracer.event(
+            'hbase.filter',
+            level=logging.DEBUG,
+            table=cls.Meta.table_name,
+            start=start,
+            stop=stop,
+            prefix=prefix,
+            limit=limit,
+            reverse=reverse,
+            columns=columns,
+            filters=column_filters,
+        )
+        results = list(cls.iter_filter(
+            start=start,
+            stop=stop,
+            prefix=prefix,
+            limit=limit,
+            reverse=reverse,
+            columns=columns,
+            **column_filters
         ))
-        row_start = cls.serialize_row_key_from_tuple(start)
-        row_stop = cls.serialize_row_key_from_tuple(stop)
-        row_prefix = cls.serialize_row_key_from_tuple(prefix)
-
-        # scan table
-        table = cls.get_table()
-        rows = table.scan(row_start, row_stop, row_prefix, limit=limit, reverse=reverse)
-
-        results = []
-        for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        logger.info(f"filter get results: {results}")
+        Tracer.payload('hbase.filter_results', results, table=cls.Meta.table_name)
         return results
 
+    @classmethod
+    def iter_filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False, columns=None,
+                    batch_size=DEFAULT_SCAN_BATCH_SIZE, scan_batching=None, **column_filters):
+        """
+        参数与filter相同，返回生成器，边从hbase读取边生成实例，内存占用只和batch_size有关，和scan的总行数无关
+        batch_size 每次thrift请求从scanner拿多少行，即hbase scan的caching
+        scan_batching 对应hbase scan的batching，一般不需要设置
+        调用方可以随时break提前结束，生成器被回收时会关闭scanner并归还连接，
+        注意生成器没迭代完之前会一直占用连接池中的一个连接
+        """
+        scan_model = cls.get_scan_model()
+        if scan_model is not cls:
+            for legacy_instance in scan_model.iter_filter(
+                start=start,
+                stop=stop,
+                prefix=prefix,
+                limit=limit,
+                reverse=reverse,
+                columns=columns,
+                batch_size=batch_size,
+                scan_batching=scan_batching,
+                **column_filters
+            ):
+                yield cls.from_legacy(legacy_instance)
+            return
+
+        yield from cls._scan_rows(
+            cls.serialize_row_key_from_tuple(start),
+            cls.serialize_row_key_from_tuple(stop),
+            cls.serialize_row_key_from_tuple(prefix),
+            limit=limit,
+            reverse=reverse,
+            columns=columns,
+            batch_size=batch_size,
+            scan_batching=scan_batching,
+            column_filters=column_filters,
+        )
+
+    @classmethod
+    def _scan_rows(cls, row_start, row_stop, row_prefix=None, limit=None, reverse=False, columns=None,
+                   batch_size=DEFAULT_SCAN_BATCH_SIZE, scan_batching=None, column_filters=None):
+        """
+        用已经序列化好的row key做scan，iter_filter和并行scan共用
+        """
+        filter_string = cls.build_filter_string(column_filters)
+        if columns is not None and column_filters:
+            # 被过滤的列不在返回的列中时，SingleColumnValueFilter会把所有行都过滤掉
+            columns = list(columns) + [key.split('__')[0] for key in column_filters]
+
+        with cls.get_table() as table:
+            rows = table.scan(
+                row_start,
+                row_stop,
+                row_prefix,
+                columns=cls.get_columns(columns),
+                filter=filter_string,
+                limit=limit,
+                reverse=reverse,
+                batch_size=batch_size,
+                scan_batching=scan_batching,
+            )
+            for row_key, row_data in rows:
+                yield cls.init_from_row(row_key, row_data)
+
+    @classmethod
+    def build_filter_string(cls, column_filters):
+        """
+        把{'to_user_id': 2, 'created_at__lt': 123}这样的过滤条件转化为hbase的filter string
+        每个条件对应一个SingleColumnValueFilter，多个条件之间是AND的关系
+        比较的是序列化之后的字符串，所以reverse的field只支持等于和不等于
+        """
+        if not column_filters:
+            return None
+        filters = []
+        for key, value in column_filters.items():
+            field_name, _, lookup = key.partition('__')
+            operator = COLUMN_FILTER_OPERATORS.get(lookup or 'exact')
+            if operator is None:
+                raise BadColumnError(f'Unsupported lookup {lookup} for {field_name}')
+            if field_name not in cls._column_keys:
+                raise BadColumnError(f'{field_name} is not a column field of {cls.__name__}')
+            field_type = cls._fields[field_name]
+            if field_type.reverse and operator not in ('=', '!='):
+                raise BadColumnError(f'{field_name} is reversed and only supports exact or ne lookups')
+            value = cls._serializers[field_name](value).replace("'", "''")
+            filters.append("SingleColumnValueFilter('{}', '{}', {}, 'binary:{}', true, true)".format(
+                field_type.column_family,
+                field_name,
+                operator,
+                value,
+            ))
+        return ' AND '.join(filters)
+
+    @classmethod
+    def count(cls, start=None, stop=None, prefix=None, limit=None, batch_size=DEFAULT_SCAN_BATCH_SIZE):
+        """
+        参数与filter相同，统计满足条件的行数
+        在region server端用KEY_ONLY_FILTER过滤，每行只传回row key，不传输具体数据，也不需要反序列化成实例
+        limit 计数的上限，比如只需要知道粉丝数是否超过某个值时，数到limit就停止scan
+        """
+        scan_model = cls.get_scan_model()
+        if scan_model is not cls:
+            return scan_model.count(start=start, stop=stop, prefix=prefix, limit=limit, batch_size=batch_size)
+
+        return cls._count_rows(
+            cls.serialize_row_key_from_tuple(start),
+            cls.serialize_row_key_from_tuple(stop),
+            cls.serialize_row_key_from_tuple(prefix),
+            limit=limit,
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def _count_rows(cls, row_start, row_stop, row_prefix=None, limit=None, batch_size=DEFAULT_SCAN_BATCH_SIZE):
+        with cls.get_table() as table:
+            rows = table.scan(
+                row_start,
+                row_stop,
+                row_prefix,
+                filter=KEY_ONLY_FILTER,
+                limit=limit,
+                batch_size=batch_size,
+            )
+            return sum(1 for _ in rows)
+
+    @classmethod
+    def parallel_scan(cls, partitions=None, max_workers=None):
+        """
+        返回HBaseParallelScan，把整张表按row key切分成partitions段并发scan，用于全表计数、回填等离线任务
+        HBaseNewsFeed.parallel_scan().count()
+        """
+        return HBaseParallelScan(cls, partitions=partitions, max_workers=max_workers)
+
     @classmethod
     def delete(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
+        with cls.get_table() as table:
+            table.delete(row_key)
+        if cls._legacy_model is not None:
+            cls._legacy_model.delete(**kwargs)
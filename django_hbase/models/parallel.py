@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django_hbase.client import HBaseClient
+
+
+class HBaseParallelScan:
+    """
+    把整张表的row key空间切分成partitions段，用线程池并发scan，每段在自己的线程中从连接池借一个连接，
+    各个region server可以同时处理，用于count_all，全表回填和迁移这类离线任务
+    切分点由row key编码决定，见row_key_codecs中的split_points，row key第一部分是反转的id时各段数据量基本均匀
+    max_workers 默认不超过连接池大小，否则多出来的线程只能等连接，调用方线程本身占着连接时还要再少一个
+        scan = HBaseNewsFeed.parallel_scan(partitions=16)
+        total = scan.count()
+        user_ids = scan.map(lambda feeds: {feed.user_id for feed in feeds})
+    """
+
+    def __init__(self, model_class, partitions=None, max_workers=None):
+        self.model_class = model_class
+        # 迁移row key编码的过程中，scan的是老表，用老表的编码来切分
+        self.scan_model = model_class.get_scan_model()
+        self.partitions = partitions or settings.HBASE_PARALLEL_SCAN_PARTITIONS
+        self.max_workers = min(max_workers or settings.HBASE_POOL_SIZE, self.partitions)
+
+    def get_ranges(self):
+        """
+        返回按row key升序排列的 [(row_start, row_stop), ...]，左闭右开，第一段没有start，最后一段没有stop
+        """
+        split_points = self.scan_model._row_key_codec.split_points(self.partitions)
+        bounds = [None] + split_points + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def get_worker_count(self):
+        """
+        实际使用的线程数，调用方线程已经占着连接池中的一个连接时少用一个，否则最后一个线程只能等到超时
+        """
+        pool = HBaseClient.get_pool()
+        if pool.is_held_by_current_thread():
+            return max(1, min(self.max_workers, pool.size - 1))
+        return self.max_workers
+
+    def _run(self, scan_range):
+        with ThreadPoolExecutor(max_workers=self.get_worker_count()) as executor:
+            return list(executor.map(scan_range, self.get_ranges()))
+
+    def map(self, func, columns=None, batch_size=None, **column_filters):
+        """
+        每一段调用一次func(instances)，instances是这一段中实例的生成器，
+        返回各段func的结果组成的list，按row key顺序排列，可以用来做聚合
+        columns, column_filters 与HBaseModel.filter相同
+        """
+        scan_kwargs = {'columns': columns, 'column_filters': column_filters}
+        if batch_size is not None:
+            scan_kwargs['batch_size'] = batch_size
+
+        def scan_range(row_range):
+            rows = self.scan_model._scan_rows(row_range[0], row_range[1], **scan_kwargs)
+            instances = rows
+            if self.scan_model is not self.model_class:
+                instances = map(self.model_class.from_legacy, rows)
+            try:
+                return func(instances)
+            finally:
+                # func没有迭代完时也要关闭scanner，归还这个线程借出的连接
+                rows.close()
+
+        return self._run(scan_range)
+
+    def filter(self, columns=None, batch_size=None, **column_filters):
+        """
+        返回全表满足条件的实例，顺序与顺序scan一致，结果全部放在内存中，只适合结果集不大的情况
+        """
+        results = []
+        for instances in self.map(list, columns=columns, batch_size=batch_size, **column_filters):
+            results.extend(instances)
+        return results
+
+    def count(self, batch_size=None):
+        """
+        全表行数，各段在region server端用KEY_ONLY_FILTER计数后相加
+        """
+        scan_kwargs = {} if batch_size is None else {'batch_size': batch_size}
+
+        def count_range(row_range):
+            return self.scan_model._count_rows(row_range[0], row_range[1], **scan_kwargs)
+
+        return sum(self._run(count_range))
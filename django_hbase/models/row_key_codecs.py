@@ -0,0 +1,144 @@
+from .exceptions import BadRowKeyError
+from .fields import IntegerField, TimestampField
+
+import struct
+
+
+class StringRowKeyCodec:
+    """
+    默认的row key格式，每部分都是字符串，int补齐16位，需要反转的field做字符串反转，各部分用:连接
+    {key1: 1, key2: 2} -> b"0000000000000001:0000000000000002"
+    """
+    name = 'string'
+
+    def __init__(self, model_name, row_key_fields):
+        """
+        row_key_fields 是row key各组成部分的 (field名称, HBaseField实例)
+        """
+        self.model_name = model_name
+        self.encoders = [(field_name, field_type.make_serializer()) for field_name, field_type in row_key_fields]
+        self.decoders = [(field_name, field_type.make_deserializer()) for field_name, field_type in row_key_fields]
+
+    def encode(self, data, is_prefix=False):
+        row_key_values = []
+        for key, serializer in self.encoders:
+            value = data.get(key)
+            if not value:
+                if not is_prefix:
+                    raise BadRowKeyError(f'{key} is missing in row key of {self.model_name}')
+                # 若是前缀的话，遇到空的部分直接跳出返回
+                break
+            value = serializer(value)
+            if ':' in value:
+                raise BadRowKeyError(f'{key} should not contain ":" in its serialized value {value}')
+            row_key_values.append(value)
+        return bytes(':'.join(row_key_values), encoding='utf-8')
+
+    def decode(self, row_key):
+        if isinstance(row_key, bytes):
+            row_key = row_key.decode('utf-8')
+        # zip 在较短的一方结束，row_key只有前缀部分时后面的field不会出现在结果中
+        return {
+            field_name: deserializer(field_value)
+            for (field_name, deserializer), field_value in zip(self.decoders, row_key.split(':'))
+        }
+
+    @staticmethod
+    def split_points(partitions):
+        """
+        并行scan时把row key空间切成partitions段的分割点，按row key开头两位数字 00-99 均匀切分
+        第一部分是反转的id时末位数字在最前面，各段的数据量基本均匀，最多切成100段
+        """
+        partitions = min(partitions, 100)
+        return sorted({
+            '{:02d}'.format(i * 100 // partitions).encode('utf-8')
+            for i in range(1, partitions)
+        })
+
+
+# 把一个字节的8个bit反转，比如 0b00000001 -> 0b10000000
+BIT_REVERSE_TABLE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+UINT64 = struct.Struct('>Q')
+
+
+def _encode_uint64(value):
+    return UINT64.pack(int(value))
+
+
+def _encode_bit_reversed_uint64(value):
+    # 整个64位整数按bit反转，相邻的user id会被打散到整个key空间，作用和字符串反转一样，避免写热点
+    return UINT64.pack(int(value))[::-1].translate(BIT_REVERSE_TABLE)
+
+
+def _decode_uint64(value):
+    return UINT64.unpack(value)[0]
+
+
+def _decode_bit_reversed_uint64(value):
+    return UINT64.unpack(value[::-1].translate(BIT_REVERSE_TABLE))[0]
+
+
+class BinaryRowKeyCodec:
+    """
+    紧凑的二进制row key格式，每部分都是定长8字节的big-endian无符号整数，不需要分隔符
+    需要反转的field做64位的bit反转
+    非反转的部分字节序与数值大小顺序一致，定长保证了前缀相同的行仍然连续，
+    所以按(user_id, created_at)做前缀scan和区间scan（paginate_hbase）的顺序与字符串格式一致，
+    {key1: 1, key2: 2} -> 16字节，字符串格式需要33字节
+    """
+    name = 'binary'
+    width = UINT64.size
+
+    def __init__(self, model_name, row_key_fields):
+        self.model_name = model_name
+        self.encoders = []
+        self.decoders = []
+        for field_name, field_type in row_key_fields:
+            if field_type.field_type not in (IntegerField.field_type, TimestampField.field_type):
+                raise BadRowKeyError(
+                    f'{field_name} of {model_name} must be an integer field to use binary row key'
+                )
+            if field_type.reverse:
+                self.encoders.append((field_name, _encode_bit_reversed_uint64))
+                self.decoders.append((field_name, _decode_bit_reversed_uint64))
+            else:
+                self.encoders.append((field_name, _encode_uint64))
+                self.decoders.append((field_name, _decode_uint64))
+
+    def encode(self, data, is_prefix=False):
+        row_key_values = []
+        for key, encoder in self.encoders:
+            value = data.get(key)
+            if not value:
+                if not is_prefix:
+                    raise BadRowKeyError(f'{key} is missing in row key of {self.model_name}')
+                break
+            row_key_values.append(encoder(value))
+        return b''.join(row_key_values)
+
+    def decode(self, row_key):
+        width = self.width
+        data = {}
+        for index, (field_name, decoder) in enumerate(self.decoders):
+            value = row_key[index * width: (index + 1) * width]
+            if len(value) < width:
+                break
+            data[field_name] = decoder(value)
+        return data
+
+    @staticmethod
+    def split_points(partitions):
+        """
+        按row key开头两个字节 0x0000-0xffff 均匀切分，第一部分是bit反转的id时各段的数据量基本均匀
+        """
+        partitions = min(partitions, 0x10000)
+        return sorted({
+            (i * 0x10000 // partitions).to_bytes(2, 'big')
+            for i in range(1, partitions)
+        })
+
+
+ROW_KEY_CODECS = {
+    StringRowKeyCodec.name: StringRowKeyCodec,
+    BinaryRowKeyCodec.name: BinaryRowKeyCodec,
+}
@@ -0,0 +1,336 @@
+from django.conf import settings
+from django.test import override_settings
+from django_hbase import models
+from django_hbase.backends.memory import MemoryConnection
+from django_hbase.client import HBaseClient, HBaseConnectionPool, NoConnectionsAvailable, get_connection_class
+from django_hbase.models.exceptions import BadRowKeyError
+from django_hbase.models.row_key_codecs import BinaryRowKeyCodec, StringRowKeyCodec
+from friendships.models import HBaseFollowing
+from testing.testcases import TestCase
+from thriftpy2.thrift import TException
+from unittest import mock
+
+import random
+import threading
+
+
+class HBaseBinaryFollowing(models.HBaseModel):
+    from_user_id = models.IntegerField(reverse=True)
+    created_at = models.TimestampField()
+    to_user_id = models.IntegerField(column_family='cf')
+
+    class Meta:
+        table_name = 'weitter_binary_followings'
+        legacy_table_name = 'weitter_legacy_followings'
+        row_key = ('from_user_id', 'created_at')
+        row_key_codec = 'binary'
+
+
+class HBaseConnectionPoolTests(TestCase):
+
+    def create_pool(self, **kwargs):
+        return HBaseConnectionPool(
+            connection_class=get_connection_class(settings.HBASE_BACKEND),
+            host=settings.HBASE_HOST,
+            **kwargs
+        )
+
+    def test_nested_checkout_reuses_connection(self):
+        pool = self.create_pool(size=1, timeout=0.1)
+        with pool.connection() as conn1:
+            with pool.connection() as conn2:
+                self.assertIs(conn1, conn2)
+        stats = pool.get_stats()
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+        # 归还后的连接会被复用
+        with pool.connection() as conn3:
+            self.assertIs(conn1, conn3)
+        self.assertEqual(pool.get_stats()['created'], 1)
+        pool.close_all()
+
+    def test_pool_size_is_bounded(self):
+        pool = self.create_pool(size=1, timeout=0.1)
+        errors = []
+
+        def checkout_in_other_thread():
+            try:
+                with pool.connection():
+                    pass
+            except NoConnectionsAvailable as e:
+                errors.append(e)
+
+        with pool.connection():
+            thread = threading.Thread(target=checkout_in_other_thread)
+            thread.start()
+            thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(pool.get_stats()['timeouts'], 1)
+
+        # 连接归还之后其他线程可以拿到连接
+        thread = threading.Thread(target=checkout_in_other_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        pool.close_all()
+
+    def test_idle_connection_eviction(self):
+        pool = self.create_pool(size=2, timeout=0.1, max_idle_time=0)
+        with pool.connection() as conn1:
+            pass
+        with pool.connection() as conn2:
+            self.assertIsNot(conn1, conn2)
+        stats = pool.get_stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['created'], 2)
+        pool.close_all()
+
+    def test_client_uses_shared_pool(self):
+        self.assertIs(HBaseClient.get_pool(), HBaseClient.get_pool())
+        with HBaseClient.connection() as conn:
+            self.assertTrue(conn.transport.is_open())
+        self.assertEqual(HBaseClient.get_pool_stats()['size'], settings.HBASE_POOL_SIZE)
+
+
+class HBaseModelMetaTests(TestCase):
+
+    def test_compiled_schema(self):
+        self.assertEqual(set(HBaseFollowing.get_field_maps()), {'from_user_id', 'created_at', 'to_user_id'})
+        self.assertEqual(HBaseFollowing._column_keys, {'to_user_id': 'cf:to_user_id'})
+        self.assertEqual(HBaseFollowing._column_field_names, {b'cf:to_user_id': 'to_user_id'})
+        self.assertEqual(HBaseFollowing._column_families, {'cf': {}})
+        self.assertEqual(HBaseFollowing.serialize_field('from_user_id', 123), '3210000000000000')
+        self.assertEqual(HBaseFollowing.deserialize_field('from_user_id', '3210000000000000'), 123)
+        self.assertEqual(
+            [field_name for field_name, _ in HBaseFollowing._row_key_fields],
+            ['from_user_id', 'created_at'],
+        )
+
+    def test_instances_use_slots(self):
+        following = HBaseFollowing(from_user_id=123, created_at=456, to_user_id=7)
+        self.assertFalse(hasattr(following, '__dict__'))
+        self.assertEqual(following.to_dict(), {'from_user_id': 123, 'created_at': 456, 'to_user_id': 7})
+        with self.assertRaises(AttributeError):
+            following.not_a_field = 1
+
+    def test_row_round_trip(self):
+        following = HBaseFollowing(from_user_id=123, created_at=456, to_user_id=7)
+        self.assertEqual(following.row_key, b'3210000000000000:456')
+        row_data = {
+            key.encode('utf-8'): value.encode('utf-8')
+            for key, value in following.serialize_row_data(following.to_dict()).items()
+        }
+        instance = HBaseFollowing.init_from_row(following.row_key, row_data)
+        self.assertEqual(instance.to_dict(), following.to_dict())
+
+
+class BinaryRowKeyTests(TestCase):
+    hbase_models = (HBaseBinaryFollowing, HBaseBinaryFollowing._legacy_model)
+
+    def test_tables_only_created_for_this_class(self):
+        self.assertIn(HBaseBinaryFollowing._legacy_model, self.get_hbase_models())
+        self.assertNotIn(HBaseBinaryFollowing, HBaseModelMetaTests.get_hbase_models())
+        self.assertNotIn(HBaseBinaryFollowing._legacy_model, HBaseModelMetaTests.get_hbase_models())
+        self.assertIn(HBaseFollowing, HBaseModelMetaTests.get_hbase_models())
+
+    def test_encode_and_decode(self):
+        following = HBaseBinaryFollowing(from_user_id=1, created_at=1666000000000000, to_user_id=2)
+        self.assertEqual(len(following.row_key), 2 * BinaryRowKeyCodec.width)
+        self.assertEqual(
+            HBaseBinaryFollowing.deserialize_row_key(following.row_key),
+            {'from_user_id': 1, 'created_at': 1666000000000000},
+        )
+        prefix = HBaseBinaryFollowing.serialize_row_key_from_tuple((1, None))
+        self.assertEqual(len(prefix), BinaryRowKeyCodec.width)
+        self.assertTrue(following.row_key.startswith(prefix))
+        # paginate_hbase传入的时间戳是query params中的字符串
+        self.assertEqual(
+            HBaseBinaryFollowing.serialize_row_key({'from_user_id': '1', 'created_at': '1666000000000000'}),
+            following.row_key,
+        )
+
+    def test_sort_order(self):
+        row_keys = sorted(
+            HBaseBinaryFollowing.serialize_row_key({'from_user_id': user_id, 'created_at': created_at})
+            for user_id in range(1, 30)
+            for created_at in random.sample(range(1, 10 ** 16), 5)
+        )
+        # 同一个用户的行是连续的，且按照created_at升序排列
+        user_timestamps = {}
+        last_user_id = None
+        for row_key in row_keys:
+            data = HBaseBinaryFollowing.deserialize_row_key(row_key)
+            if data['from_user_id'] != last_user_id:
+                self.assertNotIn(data['from_user_id'], user_timestamps)
+                last_user_id = data['from_user_id']
+                user_timestamps[last_user_id] = []
+            user_timestamps[last_user_id].append(data['created_at'])
+        for timestamps in user_timestamps.values():
+            self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_dual_write_and_migration(self):
+        legacy_model = HBaseBinaryFollowing._legacy_model
+        self.assertEqual(legacy_model.Meta.table_name, 'weitter_legacy_followings')
+
+        # 迁移前老表中已有的数据
+        legacy_model.create(from_user_id=1, created_at=100, to_user_id=2)
+        legacy_model.create(from_user_id=1, created_at=200, to_user_id=3)
+        self.assertEqual(HBaseBinaryFollowing.get(from_user_id=1, created_at=100).to_user_id, 2)
+        self.assertEqual(
+            [f and f.to_user_id for f in HBaseBinaryFollowing.get_many([
+                {'from_user_id': 1, 'created_at': 200},
+                {'from_user_id': 1, 'created_at': 300},
+            ])],
+            [3, None],
+        )
+
+        # 新的写入双写两张表
+        HBaseBinaryFollowing.create(from_user_id=1, created_at=300, to_user_id=4)
+        self.assertEqual(legacy_model.get(from_user_id=1, created_at=300).to_user_id, 4)
+        self.assertEqual(
+            [f.to_user_id for f in HBaseBinaryFollowing.filter(prefix=(1, ))],
+            [2, 3, 4],
+        )
+
+        with override_settings(HBASE_ROW_KEY_MIGRATED_TABLES=['weitter_binary_followings']):
+            self.assertEqual(HBaseBinaryFollowing.count(prefix=(1, )), 1)
+            self.assertEqual(HBaseBinaryFollowing.migrate_row_keys(batch_size=2), 3)
+            followings = HBaseBinaryFollowing.filter(prefix=(1, ), reverse=True)
+            self.assertEqual([f.to_user_id for f in followings], [4, 3, 2])
+
+        HBaseBinaryFollowing.delete(from_user_id=1, created_at=300)
+        self.assertEqual(legacy_model.get(from_user_id=1, created_at=300), None)
+        self.assertEqual(HBaseBinaryFollowing.get(from_user_id=1, created_at=300), None)
+
+        # 没有配置legacy_table_name的model不能迁移
+        with self.assertRaises(BadRowKeyError):
+            HBaseFollowing.migrate_row_keys()
+
+
+    def test_batch_send_failure_releases_connection(self):
+        pool = HBaseClient.get_pool()
+        transport_errors = pool.get_stats()['transport_errors']
+        with self.assertRaises(TException):
+            with HBaseBinaryFollowing.batch() as batch:
+                batch.create(from_user_id=1, created_at=100, to_user_id=2)
+                batch._batch.send = mock.Mock(side_effect=TException('send failed'))
+        # 老表的batch也退出了，连接已经归还，出错的连接没有放回池中
+        self.assertIsNone(getattr(pool._local, 'pooled', None))
+        self.assertEqual(pool.get_stats()['transport_errors'], transport_errors + 1)
+        self.assertEqual(pool.get_stats()['in_use'], 0)
+
+
+class MemoryBackendTests(TestCase):
+
+    def setUp(self):
+        super(MemoryBackendTests, self).setUp()
+        self.conn = MemoryConnection()
+        self.conn.create_table('test_memory_table', {'cf': {}})
+        self.table = self.conn.table('test_memory_table')
+        for key in [b'a1', b'a2', b'a3', b'b1', b'b2']:
+            self.table.put(key, {b'cf:value': key[1:]})
+
+    def tearDown(self):
+        self.conn.delete_table('test_memory_table', True)
+        super(MemoryBackendTests, self).tearDown()
+
+    def scan_keys(self, **kwargs):
+        return [key for key, _ in self.table.scan(**kwargs)]
+
+    def test_row_and_rows(self):
+        self.assertEqual(self.table.row('a1'), {b'cf:value': b'1'})
+        self.assertEqual(self.table.row('c1'), {})
+        self.assertEqual(
+            self.table.rows([b'b2', b'c1', b'a1']),
+            [(b'b2', {b'cf:value': b'2'}), (b'a1', {b'cf:value': b'1'})],
+        )
+        self.assertIn(b'test_memory_table', self.conn.tables())
+
+    def test_scan_range_and_prefix(self):
+        self.assertEqual(self.scan_keys(), [b'a1', b'a2', b'a3', b'b1', b'b2'])
+        self.assertEqual(self.scan_keys(row_start=b'a2', row_stop=b'b2'), [b'a2', b'a3', b'b1'])
+        self.assertEqual(self.scan_keys(row_prefix=b'a'), [b'a1', b'a2', b'a3'])
+        self.assertEqual(self.scan_keys(row_prefix=b'a', limit=2), [b'a1', b'a2'])
+        # 反向scan时start在后，包含start不包含stop
+        self.assertEqual(self.scan_keys(row_start=b'b1', row_stop=b'a1', reverse=True), [b'b1', b'a3', b'a2'])
+        self.assertEqual(self.scan_keys(row_prefix=b'a', reverse=True, limit=2), [b'a3', b'a2'])
+        self.assertEqual(self.scan_keys(row_start=b'a3', reverse=True), [b'a3', b'a2', b'a1'])
+
+    def test_scan_filters(self):
+        self.assertEqual(
+            self.scan_keys(filter="SingleColumnValueFilter('cf','value',>=,'binary:2',true,true)"),
+            [b'a2', b'a3', b'b2'],
+        )
+        rows = list(self.table.scan(row_prefix=b'b', filter='FirstKeyOnlyFilter() AND KeyOnlyFilter()'))
+        self.assertEqual(rows, [(b'b1', {b'cf:value': b''}), (b'b2', {b'cf:value': b''})])
+
+    def test_batch_and_delete(self):
+        with self.table.batch(batch_size=2) as batch:
+            batch.put(b'c1', {b'cf:value': b'1'})
+            batch.delete(b'a1')
+            self.assertEqual(self.table.row(b'a1'), {})
+            batch.put(b'c2', {b'cf:value': b'2'})
+            self.assertEqual(self.table.row(b'c2'), {})
+        self.assertEqual(self.scan_keys(row_prefix=b'c'), [b'c1', b'c2'])
+        self.table.delete(b'b1')
+        self.assertEqual(self.scan_keys(), [b'a2', b'a3', b'b2', b'c1', b'c2'])
+
+    def test_model_on_memory_backend(self):
+        real_pool = HBaseClient._pool
+        HBaseClient._pool = HBaseConnectionPool(size=1, connection_class=MemoryConnection)
+        try:
+            HBaseFollowing.create_table()
+            for created_at in range(1, 6):
+                HBaseFollowing.create(from_user_id=1, created_at=created_at, to_user_id=created_at + 10)
+            # 写入的值放在values中，field名不会和Tracer.event的参数冲突
+            with self.assertLogs('django', level='DEBUG') as logs:
+                HBaseFollowing.create(from_user_id=2, created_at=1, to_user_id=20)
+            self.assertIn('values=', logs.records[-1].getMessage())
+            followings = HBaseFollowing.filter(prefix=(1, None), reverse=True, limit=2)
+            self.assertEqual([f.to_user_id for f in followings], [15, 14])
+            self.assertEqual(HBaseFollowing.count(prefix=(1, None)), 5)
+            self.assertEqual(HBaseFollowing.get(from_user_id=2, created_at=1).to_user_id, 20)
+            if settings.HBASE_BACKEND != 'memory':
+                # 使用memory backend时，这张表与TestCase建的是同一张表，由tearDown删除
+                HBaseFollowing.drop_table()
+        finally:
+            HBaseClient._pool = real_pool
+
+
+class ParallelScanTests(TestCase):
+
+    def test_split_points(self):
+        self.assertEqual(StringRowKeyCodec.split_points(4), [b'25', b'50', b'75'])
+        self.assertEqual(BinaryRowKeyCodec.split_points(2), [b'\x80\x00'])
+        self.assertEqual(len(StringRowKeyCodec.split_points(200)), 99)
+        ranges = HBaseFollowing.parallel_scan(partitions=3).get_ranges()
+        self.assertEqual(ranges, [(None, b'33'), (b'33', b'66'), (b'66', None)])
+
+    def test_parallel_count_and_filter(self):
+        for from_user_id in range(1, 40):
+            HBaseFollowing.batch_create([
+                {'from_user_id': from_user_id, 'created_at': created_at, 'to_user_id': created_at}
+                for created_at in range(1, from_user_id % 3 + 2)
+            ])
+        scan = HBaseFollowing.parallel_scan(partitions=7, max_workers=3)
+        self.assertEqual(scan.max_workers, 3)
+        self.assertEqual(scan.count(), HBaseFollowing.count())
+        self.assertEqual(
+            [following.to_dict() for following in scan.filter(to_user_id__gte=2)],
+            [following.to_dict() for following in HBaseFollowing.filter(to_user_id__gte=2)],
+        )
+        # 每段返回聚合结果
+        user_ids = set()
+        for part in scan.map(lambda followings: {following.from_user_id for following in followings}):
+            user_ids |= part
+        self.assertEqual(user_ids, set(range(1, 40)))
+
+        # 调用方线程占着一个连接时少用一个线程，不会有线程一直等不到连接
+        scan = HBaseFollowing.parallel_scan(partitions=settings.HBASE_POOL_SIZE * 2)
+        self.assertEqual(scan.get_worker_count(), settings.HBASE_POOL_SIZE)
+        with HBaseFollowing.get_table():
+            self.assertEqual(scan.get_worker_count(), settings.HBASE_POOL_SIZE - 1)
+            self.assertEqual(scan.count(), HBaseFollowing.count())
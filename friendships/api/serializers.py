@@ -5,6 +5,7 @@ from friendships.models import Friendship
 from friendships.services import FriendshipServices
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from utils.serializers import PrefetchListSerializer
 
 
 class BaseFriendshipSerializer(serializers.Serializer):
@@ -12,12 +13,19 @@ class BaseFriendshipSerializer(serializers.Serializer):
     created_at = serializers.SerializerMethodField()
     has_followed = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = PrefetchListSerializer
+
     def update(self, instance, validated_data):
         pass
 
     def create(self, validated_data):
         pass
 
+    def prefetch(self, friendships):
+        # 一页的user和profile批量读取，get_user中的UserService.get_user_by_id直接从prefetch_scope中返回
+        UserService.prefetch_users([self.get_user_id(friendship) for friendship in friendships])
+
     # 先在instance层面上cache，没有的话再去FriendshipSerivces中请求
     # FriendshipServices.get_following_user_id_set也会先访问cache判断是否已经存在了
     # key point:
@@ -29,12 +29,18 @@ class FriendshipServices(object):
 
     @classmethod
     def get_followers_id(cls, to_user_id):
-        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+        return list(cls.iter_followers_id(to_user_id))
 
-            friendships = HBaseFollower.filter(prefix=(to_user_id, None))
+    @classmethod
+    def iter_followers_id(cls, to_user_id):
+        # 明星用户的粉丝可能有上百万，边读边返回，不把所有粉丝一次性加载到内存里
+        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            for friendship in HBaseFollower.iter_filter(prefix=(to_user_id, None)):
+                yield friendship.from_user_id
         else:
-            friendships = Friendship.objects.filter(to_user_id=to_user_id)
-        return [friendship.from_user_id for friendship in friendships]
+            yield from Friendship.objects.filter(
+                to_user_id=to_user_id,
+            ).values_list('from_user_id', flat=True).iterator()
 
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
@@ -110,11 +116,9 @@ class FriendshipServices(object):
 
     @classmethod
     def get_follow_instance(cls, from_user_id, to_user_id):
-        followings = HBaseFollowing.filter(prefix=(from_user_id, ))
-        for follow in followings:
-            if follow.to_user_id == to_user_id:
-                return follow
-        return None
+        # 在region server中按to_user_id过滤，不需要把所有followings都传回来
+        followings = HBaseFollowing.filter(prefix=(from_user_id, ), limit=1, to_user_id=to_user_id)
+        return followings[0] if followings else None
 
     @classmethod
     def has_followed(cls, from_user_id, to_user_id):
@@ -135,6 +139,5 @@ class FriendshipServices(object):
         if not GateKeeper.is_switch_on("switch_friendship_to_hbase"):
             return Friendship.objects.filter(from_user_id=from_user_id).count()
 
-        followings = HBaseFollowing.filter(prefix=(from_user_id, ))
-        return len(followings)
+        return HBaseFollowing.count(prefix=(from_user_id, ))
 
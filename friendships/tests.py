@@ -1,4 +1,4 @@
-from django_hbase.models import BadRowKeyError, EmptyColumnError
+from django_hbase.models import BadColumnError, BadRowKeyError, EmptyColumnError
 from friendships.models import Friendship, HBaseFollower, HBaseFollowing
 from friendships.services import FriendshipServices
 from testing.testcases import TestCase
@@ -140,3 +140,127 @@ class HBaseTests(TestCase):
         self.assertEqual(len(followings), 2)
         self.assertEqual(followings[0].to_user_id, 3)
         self.assertEqual(followings[1].to_user_id, 2)
+
+    def test_iter_filter(self):
+        for to_user_id in range(2, 7):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+
+        # 结果与filter一致
+        followings = HBaseFollowing.iter_filter(prefix=(1, ), batch_size=2)
+        self.assertEqual([f.to_user_id for f in followings], [2, 3, 4, 5, 6])
+
+        followings = HBaseFollowing.iter_filter(prefix=(1, ), limit=3, reverse=True, batch_size=1)
+        self.assertEqual([f.to_user_id for f in followings], [6, 5, 4])
+
+        # 提前结束
+        to_user_ids = []
+        for following in HBaseFollowing.iter_filter(prefix=(1, ), batch_size=2):
+            to_user_ids.append(following.to_user_id)
+            if len(to_user_ids) == 2:
+                break
+        self.assertEqual(to_user_ids, [2, 3])
+
+        follower_ids = FriendshipServices.iter_followers_id(1)
+        self.assertEqual(list(follower_ids), [])
+
+    def test_get_many(self):
+        ts1 = self.ts_now
+        ts2, ts3 = ts1 + 1, ts1 + 2
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts1)
+        HBaseFollowing.create(from_user_id=1, to_user_id=3, created_at=ts2)
+
+        followings = HBaseFollowing.get_many([
+            {'from_user_id': 1, 'created_at': ts2},
+            {'from_user_id': 1, 'created_at': ts3},
+            {'from_user_id': 1, 'created_at': ts1},
+        ])
+        self.assertEqual(len(followings), 3)
+        self.assertEqual(followings[0].to_user_id, 3)
+        self.assertEqual(followings[1], None)
+        self.assertEqual(followings[2].to_user_id, 2)
+        self.assertEqual(followings[2].created_at, ts1)
+
+        followings = HBaseFollowing.get_many([{'from_user_id': 1, 'created_at': ts1}], columns=['to_user_id'])
+        self.assertEqual(followings[0].to_user_id, 2)
+        self.assertEqual(HBaseFollowing.get_many([]), [])
+
+        with self.assertRaises(BadColumnError):
+            HBaseFollowing.get_many([{'from_user_id': 1, 'created_at': ts1}], columns=['not_a_field'])
+
+    def test_count(self):
+        ts = self.ts_now
+        for i in range(4):
+            HBaseFollowing.create(from_user_id=1, to_user_id=i + 2, created_at=ts + i)
+        HBaseFollowing.create(from_user_id=2, to_user_id=1, created_at=ts)
+
+        self.assertEqual(HBaseFollowing.count(prefix=(1, )), 4)
+        self.assertEqual(HBaseFollowing.count(prefix=(2, )), 1)
+        self.assertEqual(HBaseFollowing.count(prefix=(3, )), 0)
+        self.assertEqual(HBaseFollowing.count(), 5)
+        self.assertEqual(HBaseFollowing.count(prefix=(1, ), limit=2), 2)
+        self.assertEqual(HBaseFollowing.count(start=(1, ts + 1), stop=(1, ts + 3)), 2)
+        self.assertEqual(FriendshipServices.get_following_count(1), 4)
+
+    def test_filter_with_columns_and_column_filters(self):
+        ts = self.ts_now
+        for i in range(4):
+            HBaseFollowing.create(from_user_id=1, to_user_id=i + 2, created_at=ts + i)
+
+        followings = HBaseFollowing.filter(prefix=(1, ), to_user_id=3)
+        self.assertEqual([f.created_at for f in followings], [ts + 1])
+
+        followings = HBaseFollowing.filter(prefix=(1, ), to_user_id__gte=4)
+        self.assertEqual([f.to_user_id for f in followings], [4, 5])
+
+        followings = HBaseFollowing.filter(prefix=(1, ), to_user_id__ne=3, to_user_id__lt=5)
+        self.assertEqual([f.to_user_id for f in followings], [2, 4])
+
+        followings = HBaseFollowing.filter(prefix=(1, ), columns=['to_user_id'], to_user_id=100)
+        self.assertEqual(followings, [])
+
+        followings = HBaseFollowing.filter(prefix=(1, ), columns=['to_user_id'], limit=1)
+        self.assertEqual(followings[0].to_user_id, 2)
+
+        with self.assertRaises(BadColumnError):
+            HBaseFollowing.filter(prefix=(1, ), from_user_id=1)
+        with self.assertRaises(BadColumnError):
+            HBaseFollowing.filter(prefix=(1, ), to_user_id__in=[1, 2])
+
+        self.assertEqual(FriendshipServices.get_follow_instance(1, 4).created_at, ts + 2)
+        self.assertEqual(FriendshipServices.get_follow_instance(1, 100), None)
+
+    def test_batch(self):
+        ts = self.ts_now
+        with HBaseFollowing.batch(batch_size=2) as batch:
+            for i in range(5):
+                batch.create(from_user_id=1, to_user_id=i + 2, created_at=ts + i)
+            # batch_size=2，前4行已经自动发送了
+            self.assertEqual(HBaseFollowing.count(prefix=(1, )), 4)
+        self.assertEqual(HBaseFollowing.count(prefix=(1, )), 5)
+
+        with HBaseFollowing.batch(wal=False) as batch:
+            batch.delete(from_user_id=1, created_at=ts)
+            batch.delete(from_user_id=1, created_at=ts + 1)
+            batch.create(from_user_id=1, to_user_id=100, created_at=ts + 10)
+        followings = HBaseFollowing.filter(prefix=(1, ))
+        self.assertEqual([f.to_user_id for f in followings], [4, 5, 6, 100])
+
+        # with中抛出异常时，没有发送的部分会被丢弃
+        try:
+            with HBaseFollowing.batch() as batch:
+                batch.create(from_user_id=2, to_user_id=1, created_at=ts)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(HBaseFollowing.count(prefix=(2, )), 0)
+
+        with self.assertRaises(EmptyColumnError):
+            with HBaseFollowing.batch() as batch:
+                batch.create(from_user_id=2, created_at=ts)
+
+        followings = HBaseFollowing.batch_create([
+            {'from_user_id': 3, 'to_user_id': 1, 'created_at': ts},
+            {'from_user_id': 3, 'to_user_id': 2, 'created_at': ts + 1},
+        ], batch_size=1)
+        self.assertEqual(len(followings), 2)
+        self.assertEqual(HBaseFollowing.count(prefix=(3, )), 2)
@@ -8,7 +8,7 @@ class GateKeeper(object):
         """
         从redis中拿到对应gatekeeper的值
         """
-        conn = RedisClient.get_connection()
+        conn = RedisClient.get_connection('gatekeeper')
         name = f'gatekeeper:{gk_name}'
         if not conn.exists(name):
             return {'percent': 0, 'description': ''}
@@ -22,7 +22,7 @@ class GateKeeper(object):
 
     @classmethod
     def set_kv(cls, gk_name, key, value):
-        conn = RedisClient.get_connection()
+        conn = RedisClient.get_connection('gatekeeper')
         name = f'gatekeeper:{gk_name}'
         conn.hset(name, key, value)
 
@@ -1,12 +1,33 @@
 from accounts.api.serializers import UserSerializerForLike
 from comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
+from accounts.services import UserService
 from likes.models import Like
+from likes.serivces import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from utils.serializers import PrefetchListSerializer
 from weits.models import Weit
 
 
+class HasLikedPrefetchMixin:
+    """
+    prefetch时用LikeService.get_liked_keys一次查询得到这一页哪些object被当前用户点过赞，存在context中
+    """
+
+    def prefetch_has_liked(self, instances):
+        liked_keys = self.context.setdefault('prefetched_liked_keys', set())
+        prefetched = self.context.setdefault('prefetched_liked_targets', set())
+        liked_keys.update(LikeService.get_liked_keys(self.context['request'].user, instances))
+        prefetched.update(LikeService.get_liked_key(instance) for instance in instances)
+
+    def get_has_liked(self, obj):
+        key = LikeService.get_liked_key(obj)
+        if key in self.context.get('prefetched_liked_targets', ()):
+            return key in self.context['prefetched_liked_keys']
+        return LikeService.has_liked(self.context['request'].user, obj)
+
+
 class LikeSerializer(serializers.ModelSerializer):
     # use cache from UserService functions here, but we have to implement get_user func for each like serializer which used UserSerializer
     # so we can use 'source' instead
@@ -19,6 +40,10 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, likes):
+        UserService.prefetch_users([like.user_id for like in likes])
 
     # def get_user(self, obj):
     #     from accounts.services import UserService
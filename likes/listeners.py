@@ -1,4 +1,5 @@
 from django.db.models import F
+from gatekeeper.models import GateKeeper
 from utils.redis_helper import RedisHelper
 
 
@@ -8,6 +9,11 @@ def incr_likes_count(sender, instance, created, **kwargs):
 
     if not created:
         return
+    # 热门weit的点赞不直接更新数据库，由celery beat定期合并写回
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        RedisHelper.incr_pending_count(instance.content_object, 'likes_count', 1)
+        return
+
     model_class = instance.content_type.model_class()
     if model_class != Weit:
         Comment.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
@@ -42,6 +48,10 @@ def decr_likes_count(sender, instance, **kwargs):
     from comments.models import Comment
     from weits.models import Weit
 
+    if GateKeeper.is_switch_on('switch_counter_write_behind'):
+        RedisHelper.incr_pending_count(instance.content_object, 'likes_count', -1)
+        return
+
     model_class = instance.content_type.model_class()
     if model_class != Weit:
         Comment.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
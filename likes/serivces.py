@@ -13,3 +13,28 @@ class LikeService(object):
             object_id=target.id,
             user=user,
         ).exists()
+
+    @classmethod
+    def get_liked_keys(cls, user, targets):
+        """
+        批量版本的has_liked，每种model一次查询
+        返回user点过赞的 (content_type_id, object_id) 的set，见get_liked_key
+        """
+        if user.is_anonymous:
+            return set()
+        object_ids = {}
+        for target in targets:
+            content_type = ContentType.objects.get_for_model(target)
+            object_ids.setdefault(content_type.id, set()).add(target.id)
+        liked_keys = set()
+        for content_type_id, ids in object_ids.items():
+            liked_keys.update(Like.objects.filter(
+                content_type_id=content_type_id,
+                object_id__in=ids,
+                user=user,
+            ).values_list('content_type_id', 'object_id'))
+        return liked_keys
+
+    @classmethod
+    def get_liked_key(cls, target):
+        return ContentType.objects.get_for_model(target).id, target.id
@@ -1,11 +1,23 @@
 from rest_framework import serializers
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 from weits.api.serializers import WeitSerializer
+from weits.models import Weit
 
 
 class NewsFeedSerializer(serializers.Serializer):
     weit = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, newsfeeds):
+        # 一页newsfeed中的weit一次批量读取，再批量读取这些weit的user，计数和has_liked
+        # get_weit中的WeitSerializer共用同一个context，cached_weit和cached_user都直接从prefetch_scope中返回
+        weits = MemcachedHelper.prefetch_objects(Weit, [newsfeed.weit_id for newsfeed in newsfeeds])
+        WeitSerializer(context=self.context).prefetch(weits)
+
     def create(self, validated_data):
         pass
 
@@ -1,4 +1,5 @@
 from django.utils.decorators import method_decorator
+from functools import partial
 from gatekeeper.models import GateKeeper
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
@@ -18,9 +19,11 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='3/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds = NewsFeedServices.get_cached_newsfeeds(request.user.id)
         paginator = self.paginator
-        page = paginator.paginate_cached_list(cached_newsfeeds, request)
+        page = paginator.paginate_cached_timeline(
+            partial(NewsFeedServices.get_cached_newsfeeds_page, request.user.id),
+            request,
+        )
         # page is None means 目前数据不在cache里（超过了cache的size), 直接去数据库取
         if page is None:
             if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
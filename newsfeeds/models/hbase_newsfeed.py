@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from django_hbase import models
 from weits.models import Weit
+from utils.compact_serializer import CompactSerializer
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -23,3 +24,6 @@ class HBaseNewsFeed(models.HBaseModel):
     @property
     def cached_user(self):
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
+
+
+CompactSerializer.register(HBaseNewsFeed, tag=3)
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_save
 from newsfeeds.listeners import push_newsfeed_to_cache
+from utils.compact_serializer import CompactSerializer
 from utils.memcached_helper import MemcachedHelper
 from weits.models import Weit
 
@@ -28,3 +29,4 @@ class NewsFeed(models.Model):
 # 2. 若某个user的信息改变了，比如昵称，那我们redis cache中的数据不会有负面影响，因为newsfeed是存的user_id和weit_id，
 # 对于其中weit中的user，会去找cached_user和cached_profile，他们都会在model层面更新时invalidate，所以不会有影响。
 post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
+CompactSerializer.register(NewsFeed, tag=2)
@@ -1,9 +1,9 @@
 from gatekeeper.models import GateKeeper
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
 from newsfeeds.tasks import fanout_newsfeed_main_task
-from utils.loggers import logger
-from utils.redis_helper import RedisHelper
-from utils.redis_serializers import HBaseModelSerializer, DjangoModelSerializer
+from utils.tracing import Tracer
+from utils.time_helpers import timestamp_to_datetime
+from utils.timeline_cache import TimelineCache
 from weits.models import Weit
 from weitter.cache import USER_NEWSFEEDS_PATTERN
 
@@ -21,6 +21,30 @@ def lazy_load_newsfeeds(user_id):
     return _lazy_load
 
 
+class NewsFeedTimelineCache(TimelineCache):
+    """
+    同一个用户的newsfeed中weit不会重复，所以redis中只存weit id，score是newsfeed的created_at，
+    不需要再读取newsfeed本身，直接用user_id，weit_id和created_at构造出newsfeed，weit的内容通过cached_weit从memcached中读取
+    """
+    key_pattern = USER_NEWSFEEDS_PATTERN
+
+    @classmethod
+    def get_member(cls, newsfeed):
+        return newsfeed.weit_id
+
+    @classmethod
+    def build_objects(cls, owner_id, members, scores):
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            return [
+                HBaseNewsFeed(user_id=owner_id, created_at=score, weit_id=weit_id)
+                for weit_id, score in zip(members, scores)
+            ]
+        return [
+            NewsFeed(user_id=owner_id, weit_id=weit_id, created_at=timestamp_to_datetime(score))
+            for weit_id, score in zip(members, scores)
+        ]
+
+
 class NewsFeedServices(object):
 
     # 对于明星，粉丝很多，比如超过1kw的，每个weit都会fanout给所有的followers，这样会有很大空间和时间开销
@@ -35,35 +59,37 @@ class NewsFeedServices(object):
         # 无delay是同步任务
         # fanout_newsfeed_task(weit.id)
         # 加delay为异步任务, testing 时由于配置过了，会不用delay直接同步执行
-        logger.info('weit_id:{}, timestamp:{}, user_id:{}'.format(weit.id, weit.timestamp, weit.user_id))
+        Tracer.event('newsfeed.fanout', weit_id=weit.id, timestamp=weit.timestamp, user_id=weit.user_id)
         fanout_newsfeed_main_task.delay(weit.id, weit.timestamp, weit.user_id)
 
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
         # queryset lazy loading
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            serializer = HBaseModelSerializer
-        else:
-            serializer = DjangoModelSerializer
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, lazy_load_newsfeeds(user_id), serializer=serializer)
+        return NewsFeedTimelineCache.load(user_id, lazy_load_newsfeeds(user_id))
+
+    @classmethod
+    def get_cached_newsfeeds_page(cls, user_id, max_score=None, min_score=None, limit=None):
+        # 按时间戳区间读取一页，用于EndlessPagination.paginate_cached_timeline
+        return NewsFeedTimelineCache.load_page(
+            user_id,
+            lazy_load_newsfeeds(user_id),
+            max_score=max_score,
+            min_score=min_score,
+            limit=limit,
+        )
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, lazy_load_newsfeeds(newsfeed.user_id))
+        NewsFeedTimelineCache.push(newsfeed.user_id, newsfeed, lazy_load_newsfeeds(newsfeed.user_id))
 
     @classmethod
     def create(cls, **kwargs):
-        logger.info("Enter newsfeed create")
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            logger.info("HBaseNewsFeed create")
             newsfeed = HBaseNewsFeed.create(**kwargs)
             # push to cache as there's no listener on hbase create
             cls.push_newsfeed_to_cache(newsfeed)
         else:
             del kwargs['created_at']
-            logger.info(f'kwargs are {kwargs}')
             newsfeed = NewsFeed.objects.create(**kwargs)
         return newsfeed
 
@@ -85,7 +111,7 @@ class NewsFeedServices(object):
     def count(cls, user_id=None):
         # for unit test only
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            return len(HBaseNewsFeed.filter(prefix=(user_id, )))
+            return HBaseNewsFeed.count(prefix=(user_id, ))
         else:
             return NewsFeed.objects.filter(user_id=user_id).count()
 
@@ -93,6 +119,6 @@ class NewsFeedServices(object):
     def count_all(cls):
         # for unit test only
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            return len(HBaseNewsFeed.filter())
+            return HBaseNewsFeed.parallel_scan().count()
         else:
             return NewsFeed.objects.count()
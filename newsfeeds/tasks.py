@@ -36,17 +36,24 @@ def fanout_newsfeed_main_task(weit_id, created_at, weit_user_id):
     # 将自己的刚发的weit排在最前面
     NewsFeedServices.create(user_id=weit_user_id, created_at=created_at, weit_id=weit_id)
 
-    follower_ids = FriendshipServices.get_followers_id(weit_user_id)
-    logger.info(f"Get user {weit_user_id} follower_ids {follower_ids}")
-
-    index = 0
-    while index < len(follower_ids):
-        batch_follower_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
+    # 边scan粉丝边分批创建任务，内存里最多只有一个batch的follower_ids
+    followers_count, batches_count = 0, 0
+    batch_follower_ids = []
+    for follower_id in FriendshipServices.iter_followers_id(weit_user_id):
+        batch_follower_ids.append(follower_id)
+        if len(batch_follower_ids) == FANOUT_BATCH_SIZE:
+            fanout_newsfeed_batch_task.delay(weit_id, created_at, batch_follower_ids)
+            followers_count += len(batch_follower_ids)
+            batches_count += 1
+            batch_follower_ids = []
+    if batch_follower_ids:
         fanout_newsfeed_batch_task.delay(weit_id, created_at, batch_follower_ids)
-        index += FANOUT_BATCH_SIZE
+        followers_count += len(batch_follower_ids)
+        batches_count += 1
+    logger.info(f"Get user {weit_user_id} {followers_count} followers")
 
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        followers_count,
+        batches_count,
     )
 
@@ -1,7 +1,14 @@
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from gatekeeper.models import GateKeeper
+from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.services import NewsFeedServices
 from newsfeeds.tasks import fanout_newsfeed_main_task
+from rest_framework.test import APIRequestFactory
 from testing.testcases import TestCase
+from utils.local_cache import LocalCacheHelper
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_client import RedisClient
 from weitter.cache import USER_NEWSFEEDS_PATTERN
 
@@ -36,6 +43,32 @@ class NewsFeedServiceTests(TestCase):
         newsfeed_timestamps.insert(0, new_newsfeed.created_at)
         self.assertEqual([f.created_at for f in newsfeeds], newsfeed_timestamps)
 
+    def test_newsfeed_serializer_prefetch(self):
+        request = APIRequestFactory().get('/api/newsfeeds/')
+        request.user = self.user1
+        for i in range(3):
+            author = self.create_user('author{}'.format(i))
+            weit = self.create_weit(author)
+            self.create_newsfeed(self.user1, weit)
+            if i % 2 == 0:
+                self.create_like(self.user1, weit)
+        newsfeeds = NewsFeedServices.get_cached_newsfeeds(self.user1.id)
+        expected = [NewsFeedSerializer(newsfeed, context={'request': request}).data for newsfeed in newsfeeds]
+        self.assertEqual([data['weit']['has_liked'] for data in expected], [True, False, True])
+
+        # memcached全部miss时，一页newsfeed的weit，user，profile和has_liked各只需要一次查询
+        caches['testing'].clear()
+        LocalCacheHelper.clear()
+        with CaptureQueriesContext(connection) as queries:
+            data = NewsFeedSerializer(newsfeeds, many=True, context={'request': request}).data
+        self.assertEqual(data, expected)
+        for table in ('"weits_weit"', '"auth_user"', '"accounts_userprofile"', '"likes_like"'):
+            self.assertEqual(len([q for q in queries if 'FROM {}'.format(table) in q['sql']]), 1)
+
+        # prefetch_scope之外不会复用读到的object
+        weit = MemcachedHelper.prefetch_objects(type(newsfeeds[0].cached_weit), [newsfeeds[0].weit_id])[0]
+        self.assertIsNot(newsfeeds[0].cached_weit, weit)
+
     def test_create_new_newsfeed_before_get_cached_newsfeeds(self):
         feed1 = self.create_newsfeed(self.user1, self.create_weit(self.user1))
         self.clear_cache()
@@ -49,6 +82,34 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedServices.get_cached_newsfeeds(self.user1.id)
         self.assertEqual([f.created_at for f in feeds], [feed2.created_at, feed1.created_at])
 
+    def test_cached_newsfeeds_ordered_by_timestamp(self):
+        feeds = [self.create_newsfeed(self.user1, self.create_weit(self.user2)) for _ in range(3)]
+        # 预热cache
+        NewsFeedServices.get_cached_newsfeeds(self.user1.id)
+
+        # 延迟执行的fanout任务在更新的数据之后才push较早的newsfeed，重复push也不会产生重复数据
+        late_feed = NewsFeedServices.create(
+            user_id=self.user1.id,
+            weit_id=self.create_weit(self.user2).id,
+            created_at=feeds[0].created_at - 1,
+        )
+        NewsFeedServices.push_newsfeed_to_cache(feeds[1])
+        timestamps = [feeds[2].created_at, feeds[1].created_at, feeds[0].created_at, late_feed.created_at]
+        newsfeeds = NewsFeedServices.get_cached_newsfeeds(self.user1.id)
+        self.assertEqual([f.created_at for f in newsfeeds], timestamps)
+
+        # 按时间戳区间读取
+        page, scores, cached_count = NewsFeedServices.get_cached_newsfeeds_page(
+            self.user1.id,
+            max_score=feeds[2].created_at,
+            limit=2,
+        )
+        self.assertEqual([f.created_at for f in page], timestamps[1:3])
+        self.assertEqual(scores, timestamps[1:3])
+        self.assertEqual(cached_count, 4)
+        page, _, _ = NewsFeedServices.get_cached_newsfeeds_page(self.user1.id, min_score=feeds[0].created_at)
+        self.assertEqual([f.created_at for f in page], timestamps[:2])
+
 
 class NewsFeedTaskTests(TestCase):
 
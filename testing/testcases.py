@@ -9,18 +9,29 @@ from gatekeeper.models import GateKeeper
 from likes.models import Like
 from newsfeeds.services import NewsFeedServices
 from rest_framework.test import APIClient
+from utils.local_cache import LocalCacheHelper
 from utils.redis_client import RedisClient
 from weits.models import Weit
 
 
 class TestCase(DjangoTestCase):
     hbase_table_created = False
+    # 只有这个测试类用到的hbase model，比如tests模块中定义的model，只在这个测试类中建表删表
+    hbase_models = ()
+
+    @classmethod
+    def get_hbase_models(cls):
+        # tests模块中定义的model不在每个测试都建表删表的范围内，由用到它的测试类放在hbase_models中
+        return [
+            hbase_models_class for hbase_models_class in HBaseModel.__subclasses__()
+            if hbase_models_class.__module__.rsplit('.', 1)[-1] != 'tests'
+        ] + list(cls.hbase_models)
 
     def setUp(self):
         self.clear_cache()
         try:
             self.hbase_table_created = True
-            for hbase_models_class in HBaseModel.__subclasses__():
+            for hbase_models_class in self.get_hbase_models():
                 hbase_models_class.create_table()
         except Exception:
             self.tearDown()
@@ -30,11 +41,12 @@ class TestCase(DjangoTestCase):
     def tearDown(self):
         if not self.hbase_table_created:
             return
-        for hbase_models_class in HBaseModel.__subclasses__():
+        for hbase_models_class in self.get_hbase_models():
             hbase_models_class.drop_table()
 
     def clear_cache(self):
         caches['testing'].clear()
+        LocalCacheHelper.clear()
         RedisClient.clear()
         # open hbase switch for friendship and newsfeed
         GateKeeper.turn_on('switch_friendship_to_hbase')
@@ -0,0 +1,118 @@
+from datetime import timedelta
+from django.db import models
+from django_hbase.models import HBaseModel
+from utils.time_helpers import EPOCH, datetime_to_timestamp
+
+import hashlib
+import pickle
+
+
+def _encode_datetime(value):
+    return None if value is None else datetime_to_timestamp(value)
+
+
+def _decode_datetime(value):
+    return None if value is None else EPOCH + timedelta(microseconds=value)
+
+
+def _encode_file(value):
+    # FieldFile只存文件名，from_db时由FileField的descriptor重新包装
+    return value.name
+
+
+class CompactSerializer:
+    """
+    紧凑的序列化格式，只存 (type tag, field1的值, field2的值, ...) 组成的tuple，用pickle打包成bytes，
+    不存model名和field名，datetime存成微秒时间戳，
+    比pickle整个model实例或者DjangoModelSerializer的json小很多，反序列化时也不需要经过django的DeserializedObject
+    支持django model和HBaseModel，需要先用register给model分配一个全局唯一的type tag，
+    tag一旦使用就不能改，也不能分给别的model，已使用：1 Weit，2 NewsFeed，3 HBaseNewsFeed，4 User，5 UserProfile
+    tuple中值的顺序就是field的定义顺序，所以cache的key中要带上get_schema_version（见MemcachedHelper.get_key），
+    它由tag，field名称和类型得到，增删或修改field之后自动换成新的key，老的数据不会被错误的解析，tag保持不变
+    """
+    # 所有pickle protocol 2以上的数据都以这个字节开头，json格式的数据不会以它开头，用来区分compact格式
+    MAGIC = b'\x80'
+    PROTOCOL = 4
+    # tag -> (model class, field名称列表, 每个field的解码函数)
+    _schemas = {}
+    # model class -> (tag, field名称列表, 每个field的编码函数)
+    _tags = {}
+    # model class -> schema version，由tag，field名称和类型得到
+    _versions = {}
+
+    @classmethod
+    def register(cls, model_class, tag):
+        if tag in cls._schemas and cls._schemas[tag][0] is not model_class:
+            raise ValueError(f'Compact serializer tag {tag} is already used by {cls._schemas[tag][0].__name__}')
+        if issubclass(model_class, HBaseModel):
+            field_names = list(model_class.get_field_maps())
+            encoders = [None] * len(field_names)
+            decoders = [None] * len(field_names)
+        else:
+            fields = model_class._meta.concrete_fields
+            field_names = [field.attname for field in fields]
+            encoders, decoders = [], []
+            for field in fields:
+                if isinstance(field, models.DateTimeField):
+                    encoders.append(_encode_datetime)
+                    decoders.append(_decode_datetime)
+                elif isinstance(field, models.FileField):
+                    encoders.append(_encode_file)
+                    decoders.append(None)
+                else:
+                    encoders.append(None)
+                    decoders.append(None)
+        cls._tags[model_class] = (tag, field_names, encoders)
+        cls._schemas[tag] = (model_class, field_names, decoders)
+        cls._versions[model_class] = cls._compute_schema_version(model_class, tag, field_names)
+        return model_class
+
+    @classmethod
+    def _compute_schema_version(cls, model_class, tag, field_names):
+        if issubclass(model_class, HBaseModel):
+            field_types = [type(field).__name__ for field in model_class.get_field_maps().values()]
+        else:
+            field_types = [type(field).__name__ for field in model_class._meta.concrete_fields]
+        schema = '{}:{}'.format(tag, ','.join(
+            '{}={}'.format(name, field_type) for name, field_type in zip(field_names, field_types)
+        ))
+        return hashlib.md5(schema.encode('utf-8')).hexdigest()[:8]
+
+    @classmethod
+    def get_schema_version(cls, model_class):
+        """
+        没有注册的model返回None
+        """
+        return cls._versions.get(model_class)
+
+    @classmethod
+    def is_registered(cls, instance):
+        return instance.__class__ in cls._tags
+
+    @classmethod
+    def is_compact(cls, serialized_data):
+        return isinstance(serialized_data, bytes) and serialized_data[:1] == cls.MAGIC
+
+    @classmethod
+    def serialize(cls, instance):
+        tag, field_names, encoders = cls._tags[instance.__class__]
+        values = [tag]
+        for field_name, encoder in zip(field_names, encoders):
+            value = getattr(instance, field_name)
+            values.append(value if encoder is None else encoder(value))
+        return pickle.dumps(tuple(values), protocol=cls.PROTOCOL)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        values = pickle.loads(serialized_data)
+        model_class, field_names, decoders = cls._schemas[values[0]]
+        if len(values) != len(field_names) + 1:
+            raise ValueError(f'Compact data of {model_class.__name__} does not match its fields {field_names}')
+        values = [
+            value if decoder is None else decoder(value)
+            for value, decoder in zip(values[1:], decoders)
+        ]
+        if issubclass(model_class, HBaseModel):
+            return model_class(**dict(zip(field_names, values)))
+        # 与从数据库中读出来的实例一样，_state.adding为False
+        return model_class.from_db(None, field_names, values)
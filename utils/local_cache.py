@@ -0,0 +1,205 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+import redis
+from utils.redis_client import RedisClient
+from utils.tracing import Tracer
+from weitter.cache import LOCAL_CACHE_INVALIDATION_CHANNEL
+
+
+class LocalCache:
+    """
+    进程内的LRU cache，最多max_size个key，每个key最多缓存timeout秒
+    存的是pickle之后的bytes，每次get都得到一个新的object，和从memcached读到的一样，
+    调用方修改读到的object（比如user上的_cached_user_profile）不会影响其他请求
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        # key -> (过期的时间点, pickle之后的value)，最近用过的在最后
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _get(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expire_at, value = item
+        if expire_at <= now:
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key, time.monotonic())
+        return None if value is None else pickle.loads(value)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            values = {key: self._get(key, now) for key in keys}
+        return {key: pickle.loads(value) for key, value in values.items() if value is not None}
+
+    def set_many(self, mapping):
+        expire_at = time.monotonic() + self.timeout
+        # 在锁外面pickle
+        items = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in mapping.items()]
+        with self._lock:
+            for key, value in items:
+                self._data[key] = (expire_at, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 4) if requests else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class LocalCacheHelper:
+    """
+    memcached前面的一级cache，热点的object（比如大V的user和profile）不需要每个请求都访问memcached
+    - 每个进程一个LocalCache，大小和过期时间见settings中的LOCAL_CACHE_SIZE和LOCAL_CACHE_TIMEOUT
+    - object修改之后invalidate，在redis的LOCAL_CACHE_INVALIDATION_CHANNEL上广播要删除的key，
+      每个进程的订阅线程收到之后删除自己的那一份
+    - 订阅线程每隔LOCAL_CACHE_STATS_INTERVAL秒记录一次命中率和淘汰数（local_cache.stats），用来调整大小
+    invalidation消息丢失时（比如订阅的连接断开）最多读到LOCAL_CACHE_TIMEOUT秒的旧数据，重新订阅时会清空
+    """
+    _cache = None
+    _pid = None
+    _init_lock = threading.Lock()
+
+    @classmethod
+    def is_enabled(cls):
+        return settings.LOCAL_CACHE_SIZE > 0
+
+    @classmethod
+    def get_cache(cls):
+        # fork之后子进程重新创建，订阅线程不会被fork
+        if cls._pid == os.getpid():
+            return cls._cache
+        with cls._init_lock:
+            if cls._pid != os.getpid():
+                cls._cache = LocalCache(settings.LOCAL_CACHE_SIZE, settings.LOCAL_CACHE_TIMEOUT)
+                cls._pid = os.getpid()
+                # 测试时只有一个进程，invalidate时已经删除了本进程的那一份
+                if not settings.TESTING:
+                    threading.Thread(target=cls._subscribe, name='local-cache-invalidation', daemon=True).start()
+        return cls._cache
+
+    @classmethod
+    def get(cls, key):
+        if not cls.is_enabled():
+            return None
+        return cls.get_cache().get(key)
+
+    @classmethod
+    def get_many(cls, keys):
+        if not cls.is_enabled():
+            return {}
+        return cls.get_cache().get_many(keys)
+
+    @classmethod
+    def set(cls, key, value):
+        if cls.is_enabled():
+            cls.get_cache().set(key, value)
+
+    @classmethod
+    def set_many(cls, mapping):
+        if cls.is_enabled() and mapping:
+            cls.get_cache().set_many(mapping)
+
+    @classmethod
+    def invalidate(cls, *keys):
+        """
+        删除本进程的那一份，并通知其他进程删除
+        """
+        if not cls.is_enabled():
+            return
+        cls.get_cache().delete_many(keys)
+        conn = RedisClient.get_connection('local_cache')
+        for key in keys:
+            conn.publish(LOCAL_CACHE_INVALIDATION_CHANNEL, key)
+
+    @classmethod
+    def handle_message(cls, message):
+        if message['type'] != 'message':
+            return
+        key = message['data']
+        cls.get_cache().delete_many([key.decode('utf-8') if isinstance(key, bytes) else key])
+
+    @classmethod
+    def stats(cls):
+        return cls.get_cache().stats()
+
+    @classmethod
+    def clear(cls):
+        if cls._cache is not None:
+            cls._cache.clear()
+
+    @classmethod
+    def _listen(cls, pubsub):
+        next_stats_at = time.monotonic() + settings.LOCAL_CACHE_STATS_INTERVAL
+        while True:
+            # timeout要比连接池的socket_timeout短
+            message = pubsub.get_message(timeout=0.5)
+            if message is not None:
+                cls.handle_message(message)
+            if time.monotonic() >= next_stats_at:
+                Tracer.event('local_cache.stats', pid=os.getpid(), **cls.stats())
+                next_stats_at = time.monotonic() + settings.LOCAL_CACHE_STATS_INTERVAL
+
+    @classmethod
+    def _subscribe(cls):
+        while True:
+            pubsub = None
+            try:
+                pubsub = RedisClient.get_connection('local_cache').pubsub()
+                pubsub.subscribe(LOCAL_CACHE_INVALIDATION_CHANNEL)
+                # 没有订阅的这段时间可能错过了invalidation
+                cls.clear()
+                cls._listen(pubsub)
+            except redis.RedisError as e:
+                Tracer.event('local_cache.subscribe_error', level=logging.WARNING, error=e)
+                time.sleep(1)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
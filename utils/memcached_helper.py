@@ -1,28 +1,189 @@
+import threading
+from contextlib import contextmanager
+
 from django.conf import settings
 from django.core.cache import caches
+from utils.compact_serializer import CompactSerializer
+from utils.local_cache import LocalCacheHelper
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
+# 数据库中不存在的object在cache中存这个值（negative cache），见get_object_through_cache
+DOES_NOT_EXIST = '__does_not_exist__'
+# cache.get没有命中时的返回值，与cache中存的任何值都不同
+_MISSING = object()
+
+# prefetch_scope中已经读到的object，memcached key -> object，每个线程（请求）一份
+_prefetched = threading.local()
+
 
 class MemcachedHelper:
+    """
+    object的cache，先读进程内的LocalCacheHelper，再读memcached，最后读数据库
+    注册过CompactSerializer的model在两级cache中都只存field的值（见encode），不pickle整个实例，
+    key中带有schema version，model的field改变之后上线时不会读到老格式的数据
+    """
+
     @classmethod
     def get_key(cls, model_class, object_id):
-        return '{}:{}'.format(model_class.__name__, object_id)
+        version = CompactSerializer.get_schema_version(model_class)
+        if version is None:
+            return '{}:{}'.format(model_class.__name__, object_id)
+        return '{}:{}:{}'.format(model_class.__name__, version, object_id)
+
+    @classmethod
+    def encode(cls, obj):
+        """
+        存到cache中的值，没有注册CompactSerializer的model还是pickle整个实例
+        实例上另外加的属性（比如user上的_cached_user_profile）不会存到cache中
+        """
+        if CompactSerializer.is_registered(obj):
+            return CompactSerializer.serialize(obj)
+        return obj
+
+    @classmethod
+    def decode(cls, value):
+        if CompactSerializer.is_compact(value):
+            return CompactSerializer.deserialize(value)
+        return value
+
+    @classmethod
+    def is_does_not_exist(cls, obj):
+        return isinstance(obj, str) and obj == DOES_NOT_EXIST
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
+        """
+        object不存在时抛出model_class.DoesNotExist，不存在的结果也会缓存MEMCACHED_NEGATIVE_CACHE_TIMEOUT秒，
+        比如外键SET_NULL之后的user_id，或者不断请求一个已经删除的id，不会每次都查询数据库
+        """
+        if object_id is None:
+            raise model_class.DoesNotExist('{} matching query does not exist.'.format(model_class.__name__))
+
         key = cls.get_key(model_class, object_id)
-        # cache hit
+        objects = getattr(_prefetched, 'objects', None)
+        obj = objects.get(key) if objects is not None else None
+        if obj is None:
+            obj = cls._get_through_cache(model_class, object_id, key)
+            if objects is not None:
+                objects[key] = obj
+        if cls.is_does_not_exist(obj):
+            raise model_class.DoesNotExist('{} matching query does not exist.'.format(model_class.__name__))
+        return obj
+
+    @classmethod
+    def _get_through_cache(cls, model_class, object_id, key):
+        # 用None/_MISSING判断是否命中，而不是object的真假
+        value = LocalCacheHelper.get(key)
+        if value is not None:
+            return cls.decode(value)
 
-        obj = cache.get(key)
-        if obj:
-            return obj
+        # cache hit
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            LocalCacheHelper.set(key, value)
+            return cls.decode(value)
 
-        obj = model_class.objects.get(id=object_id)
-        cache.set(key, obj)
+        try:
+            obj = model_class.objects.get(id=object_id)
+            value = cls.encode(obj)
+            cache.set(key, value)
+        except model_class.DoesNotExist:
+            obj = value = DOES_NOT_EXIST
+            cache.set(key, value, settings.MEMCACHED_NEGATIVE_CACHE_TIMEOUT)
+        LocalCacheHelper.set(key, value)
         return obj
 
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
+        # 新建object时也要调用，删除之前缓存的不存在的结果
         key = cls.get_key(model_class, object_id)
         cache.delete(key)
+        LocalCacheHelper.invalidate(key)
+
+    @classmethod
+    def _get_many_through_cache(cls, model_class, object_ids):
+        """
+        返回 {memcached key: object}，数据库中不存在的id对应DOES_NOT_EXIST
+        """
+        keys = {cls.get_key(model_class, object_id): object_id for object_id in object_ids if object_id is not None}
+        values = LocalCacheHelper.get_many(list(keys))
+        missing_keys = [key for key in keys if key not in values]
+        if missing_keys:
+            cached_values = cache.get_many(missing_keys)
+            LocalCacheHelper.set_many(cached_values)
+            values.update(cached_values)
+        objects = {key: cls.decode(value) for key, value in values.items()}
+        missing_ids = [object_id for key, object_id in keys.items() if key not in objects]
+        if missing_ids:
+            db_objects = {
+                cls.get_key(model_class, obj.id): obj
+                for obj in model_class.objects.filter(id__in=missing_ids)
+            }
+            db_values = {key: cls.encode(obj) for key, obj in db_objects.items()}
+            not_found = {
+                cls.get_key(model_class, object_id): DOES_NOT_EXIST
+                for object_id in missing_ids
+                if cls.get_key(model_class, object_id) not in db_objects
+            }
+            cache.set_many(db_values)
+            cache.set_many(not_found, settings.MEMCACHED_NEGATIVE_CACHE_TIMEOUT)
+            LocalCacheHelper.set_many(db_values)
+            LocalCacheHelper.set_many(not_found)
+            objects.update(db_objects)
+            objects.update(not_found)
+        return objects
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        批量版本的get_object_through_cache，进程内cache没命中的用一次get_many，
+        memcached也没命中的用一次id__in查询，再用set_many回填
+        返回与object_ids顺序一致的list，不存在的id直接跳过
+        """
+        objects = cls._get_many_through_cache(model_class, object_ids)
+        return [
+            objects[cls.get_key(model_class, object_id)]
+            for object_id in object_ids
+            if object_id is not None and not cls.is_does_not_exist(objects[cls.get_key(model_class, object_id)])
+        ]
+
+    @classmethod
+    @contextmanager
+    def prefetch_scope(cls):
+        """
+        在scope中用prefetch_objects批量读取的object，之后get_object_through_cache直接返回，
+        不再单独访问memcached，比如序列化一页weit时先批量读出所有的user
+        scope可以嵌套，只在最外层退出时清空，所以读到的object最多只在一次序列化中复用
+        """
+        if getattr(_prefetched, 'objects', None) is not None:
+            yield
+            return
+        _prefetched.objects = {}
+        try:
+            yield
+        finally:
+            _prefetched.objects = None
+
+    @classmethod
+    def prefetch_objects(cls, model_class, object_ids):
+        """
+        用get_objects_through_cache批量读取，在prefetch_scope中时记录下来供get_object_through_cache使用
+        返回与去重之后的object_ids顺序一致的list
+        """
+        object_ids = list(dict.fromkeys(object_id for object_id in object_ids if object_id is not None))
+        objects = getattr(_prefetched, 'objects', None)
+        if objects is None:
+            return cls.get_objects_through_cache(model_class, object_ids)
+
+        # 不存在的结果也记录下来，之后get_object_through_cache直接抛出DoesNotExist
+        missing_ids = [
+            object_id for object_id in object_ids
+            if cls.get_key(model_class, object_id) not in objects
+        ]
+        objects.update(cls._get_many_through_cache(model_class, missing_ids))
+        return [
+            objects[cls.get_key(model_class, object_id)]
+            for object_id in object_ids
+            if not cls.is_does_not_exist(objects[cls.get_key(model_class, object_id)])
+        ]
@@ -3,7 +3,19 @@ from django.conf import settings
 from django_hbase.models import HBaseModel
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
+from utils.redis_helper import RedisHelper
 from utils.time_constants import MAX_TIMESTAMP
+from utils.time_helpers import datetime_to_timestamp
+
+
+def parse_timestamp_cursor(value):
+    """
+    把created_at__gt/created_at__lt转化为微秒时间戳，mysql的created_at是iso格式，hbase是微秒时间戳
+    纯数字的cursor直接当作时间戳，不需要先尝试解析iso格式
+    """
+    if isinstance(value, int) or value.lstrip('-').isdigit():
+        return int(value)
+    return datetime_to_timestamp(parser.isoparse(value))
 
 
 class EndlessPagination(BasePagination):
@@ -16,44 +28,7 @@ class EndlessPagination(BasePagination):
     def to_html(self):
         pass
 
-    def paginate_ordered_list(self, reversed_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            # 兼容iso和int格式的时间戳, TODO: 最好还是统一时间戳格式
-            try:
-                created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            except ValueError:
-                created_at__gt = int(request.query_params['created_at__gt'])
-
-            objects = []
-            for obj in reversed_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
-            self.has_next_page = False
-            return objects
-        index = 0
-        if 'created_at__lt' in request.query_params:
-            try:
-                created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            except ValueError:
-                created_at__lt = int(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reversed_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # 没找到满足条件的objects，return None
-                reversed_ordered_list = []
-        self.has_next_page = len(reversed_ordered_list) > index + self.page_size
-        return reversed_ordered_list[index: index + self.page_size]
-
     def paginate_queryset(self, queryset, request, view=None):
-        # if queryset is a list, which means paginate redis cached queryset list
-        # use paginate_ordered_list method
-        # deprecated after cache limit is set
-        # if type(queryset) == list:
-        #     return self.paginate_ordered_list(queryset, request)
-
         # 下拉向上翻页，直接返回比当前第一个更新的weits，
         # 若长时间没有上翻过，则不应用上翻更新了，而是应该重新加载最新的weits
         if 'created_at__gt' in request.query_params:
@@ -72,19 +47,36 @@ class EndlessPagination(BasePagination):
         self.has_next_page = len(queryset) > self.page_size
         return queryset[:self.page_size]
 
-    def paginate_cached_list(self, cached_list, request):
-        paginated_list = self.paginate_ordered_list(cached_list, request)
-        # 若是上翻页，则是希望返回最新的数据，可以直接返回
+    def paginate_cached_timeline(self, load_page, request):
+        """
+        翻页cache中的timeline，cache是按时间戳排序的sorted set，见TimelineCache.load_page
+        load_page(max_score=None, min_score=None, limit=None) 返回 (objects, 每一行的时间戳, cache中一共有多少个)
+        cursor直接转化为score区间，由redis定位，不需要从头遍历cache中的数据
+        """
         if 'created_at__gt' in request.query_params:
-            return paginated_list
-        # 下翻页，且cache里还有下一页的话，也是直接返回
+            # 上翻页不做分页，直接返回所有更新的数据
+            objects, _, _ = load_page(min_score=parse_timestamp_cursor(request.query_params['created_at__gt']))
+            self.has_next_page = False
+            return objects
+
+        max_score = None
+        if 'created_at__lt' in request.query_params:
+            max_score = parse_timestamp_cursor(request.query_params['created_at__lt'])
+        # 多取一个，用来查看是否有下一页
+        objects, scores, cached_count = load_page(max_score=max_score, limit=self.page_size + 1)
+        # 用cache中读到的行数判断，而不是得到的objects，已经删除的object被跳过时不会提前结束翻页
+        self.has_next_page = len(scores) > self.page_size
         if self.has_next_page:
-            return paginated_list
-        # 没有下一页的话，若cache list未达到最大值，也可以直接返回，此时说明数据库里也没有了
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
-            return paginated_list
+            # 这一页是前page_size行，不返回多取的那一行
+            last_score = scores[self.page_size - 1]
+            page = [obj for obj in objects if RedisHelper.get_score(obj) >= last_score]
+            # 这一页的object都已经删除了，客户端拿不到下一页的cursor，去数据库里面取
+            return page or None
+        # 没有下一页的话，若cache未达到最大值，说明数据库里也没有了
+        if cached_count < settings.REDIS_LIST_LENGTH_LIMIT:
+            return objects
 
-        # cache_list 满了，且没有下一页了，则直接返回None，后面需要去数据库里面取了
+        # cache 满了，且没有下一页了，则直接返回None，后面需要去数据库里面取了
         return None
 
     def get_paginated_response(self, data):
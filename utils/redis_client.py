@@ -1,27 +1,110 @@
+import bisect
+import hashlib
+
 from django.conf import settings
 import redis
 
 
+class ConsistentHashRing:
+    """
+    一致性哈希，每个节点在环上有replicas个虚拟节点，key落在顺时针方向的第一个虚拟节点上
+    增加或者减少一个节点时，只有这个节点相邻的那部分key需要重新加载，其他key的节点不变
+    """
+
+    def __init__(self, nodes, replicas=160):
+        # 节点名 -> 节点，比如 '127.0.0.1:6379/0' -> redis.Redis
+        self.nodes = nodes
+        ring = sorted(
+            (self.hash('{}#{}'.format(name, index)), name)
+            for name in nodes
+            for index in range(replicas)
+        )
+        self._hashes = [value for value, _ in ring]
+        self._names = [name for _, name in ring]
+
+    @classmethod
+    def hash(cls, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def get_node_name(self, key):
+        index = bisect.bisect(self._hashes, self.hash(key)) % len(self._hashes)
+        return self._names[index]
+
+    def get_node(self, key):
+        return self.nodes[self.get_node_name(key)]
+
+
 class RedisClient:
-    _conn = None
+    # 用途 -> redis.Redis，配置了多个节点的用途是ConsistentHashRing
+    # 每个用途有自己的连接池，见settings中的REDIS_POOLS，没有配置的用途使用default
+    _connections = {}
 
     @classmethod
-    def get_connection(cls):
-        # singleton pattern for each web request
-        if cls._conn:
-            return cls._conn
-        cls._conn = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-        )
+    def _create_connection(cls, config):
+        # 连接池满时最多等待timeout秒，而不是无限制地新建连接
+        return redis.Redis(connection_pool=redis.BlockingConnectionPool(**config))
 
-        return cls._conn
+    @classmethod
+    def _get(cls, role):
+        if role in cls._connections:
+            return cls._connections[role]
+
+        config = settings.REDIS_POOLS.get(role)
+        if config is None:
+            if role == 'default':
+                raise ValueError('REDIS_POOLS should have a default pool')
+            connection = cls._get('default')
+        elif 'nodes' in config:
+            connection = ConsistentHashRing({
+                '{}:{}/{}'.format(node['host'], node['port'], node['db']): cls._create_connection(node)
+                for node in config['nodes']
+            })
+        else:
+            connection = cls._create_connection(config)
+        cls._connections[role] = connection
+        return connection
+
+    @classmethod
+    def get_connection(cls, role='default'):
+        # singleton pattern for each process, redis.Redis 是线程安全的，每个命令从连接池中借一个连接
+        connection = cls._get(role)
+        if isinstance(connection, ConsistentHashRing):
+            raise ValueError(f'redis pool {role} has multiple nodes, use get_connection_for_key instead')
+        return connection
+
+    @classmethod
+    def get_connection_for_key(cls, key, role='default'):
+        """
+        key所在节点的连接，只配置了一个节点时与get_connection相同
+        同一个key的所有操作（包括lua脚本）都要用这个连接
+        """
+        connection = cls._get(role)
+        if isinstance(connection, ConsistentHashRing):
+            return connection.get_node(key)
+        return connection
+
+    @classmethod
+    def get_all_connections(cls):
+        connections = []
+        for role in settings.REDIS_POOLS:
+            connection = cls._get(role)
+            if isinstance(connection, ConsistentHashRing):
+                connections.extend(connection.nodes.values())
+            else:
+                connections.append(connection)
+        return connections
+
+    @classmethod
+    def reset(cls):
+        # 修改REDIS_POOLS之后重新创建连接池，比如测试中
+        for connection in cls.get_all_connections():
+            connection.connection_pool.disconnect()
+        cls._connections = {}
 
     @classmethod
     def clear(cls):
         # clear all keys in redis for testing purpose, we can't clear production redis
         if not settings.TESTING:
             raise Exception("You can not flush redis in production environment")
-        conn = cls.get_connection()
-        conn.flushdb()
+        for connection in cls.get_all_connections():
+            connection.flushdb()
@@ -1,115 +1,414 @@
+import time
+import uuid
+from collections import defaultdict
+
+from django.apps import apps
 from django.conf import settings
-from django_hbase.models import HBaseModel
-from utils.loggers import logger
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Subquery
+from utils.tracing import Tracer
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.time_helpers import datetime_to_timestamp
+from weitter.cache import FLUSH_ID_KEY, FLUSHING_COUNTS_KEY, PENDING_COUNTS_KEY
+
+
+# 以下lua脚本在redis server端原子执行，每个操作只需要一次网络往返，
+# 也不会出现先EXISTS检查，再写入之间key刚好过期的竞争
+# key存在时加上ARGV[1]并返回新的值，不存在时返回nil，由调用方从数据库回填
+# KEYS[1]: count key, ARGV[1]: 增量
+INCR_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+# 只有key不存在时才回填，多个进程同时cache miss时不会重复写入同一份数据
+# KEYS[1]: sorted set key, ARGV[1]: 过期时间, ARGV[2:]: score1, member1, score2, member2...
+LOAD_SORTED_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+# key存在时按score插入，只保留score最大的ARGV[3]个，返回1；不存在时返回0，由调用方从数据库回填
+# KEYS[1]: sorted set key, ARGV[1]: score, ARGV[2]: member, ARGV[3]: 长度上限
+PUSH_SORTED_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+return 1
+"""
+# 不管key是否存在都合并进sorted set，只保留score最大的ARGV[2]个，用于soft expire之后的重建，
+# 重建期间push进来的数据不会丢失
+# KEYS[1]: sorted set key, ARGV[1]: 过期时间, ARGV[2]: 长度上限, ARGV[3:]: score1, member1, score2, member2...
+MERGE_SORTED_SET_SCRIPT = """
+redis.call('ZADD', KEYS[1], unpack(ARGV, 3))
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+# write-behind：增量记在pending hash中，count cache存在时同时更新，返回新的值；不存在时返回nil，由调用方回填
+# KEYS[1]: count key, KEYS[2]: pending hash, ARGV[1]: hash field, ARGV[2]: 增量
+INCR_PENDING_COUNT_SCRIPT = """
+redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+return redis.call('INCRBY', KEYS[1], ARGV[2])
+"""
+# 回填count cache，数据库中的值加上还没有写回数据库的增量，key已经存在时以已有的值为准
+# flushing hash的flush_id不比ARGV[4]大时，数据库中的值已经包含了它的增量，不再重复加上
+# KEYS[1]: count key, KEYS[2]: pending hash, KEYS[3]: flushing hash
+# ARGV[1]: hash field, ARGV[2]: 数据库中的值, ARGV[3]: 过期时间, ARGV[4]: 读取数据库中的值时已经写回的最大flush_id
+BACKFILL_COUNT_SCRIPT = """
+local count = tonumber(ARGV[2])
+count = count + tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0)
+local flush_id = redis.call('HGET', KEYS[3], 'flush_id')
+if not flush_id or tonumber(flush_id) > tonumber(ARGV[4]) then
+    count = count + tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+end
+if redis.call('SET', KEYS[1], count, 'EX', ARGV[3], 'NX') then
+    return count
+end
+return tonumber(redis.call('GET', KEYS[1]))
+"""
+# 取出要写回数据库的增量：上一次写回中途失败时flushing hash还没有applied字段，先重新写回它；
+# 否则把pending hash改名为flushing hash（覆盖已经写回的那一个），之后的增量写到新的pending hash中
+# 每一批增量有一个自增的flush_id，写回时用来判断这一批是否已经写回过，
+# 新的flush_id总是比数据库中已经写回的大，redis中的计数器丢失之后也不会和已经写回的重复
+# KEYS[1]: pending hash, KEYS[2]: flushing hash, KEYS[3]: flush_id计数器, ARGV[1]: 数据库中已经写回的最大flush_id
+# 返回 'flush_id', flush_id, field1, delta1, field2, delta2...
+TAKE_PENDING_COUNTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 or redis.call('HEXISTS', KEYS[2], 'applied') == 1 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+if redis.call('HEXISTS', KEYS[2], 'flush_id') == 0 then
+    local flush_id = redis.call('INCR', KEYS[3])
+    if flush_id <= tonumber(ARGV[1]) then
+        flush_id = tonumber(ARGV[1]) + 1
+        redis.call('SET', KEYS[3], flush_id)
+    end
+    redis.call('HSET', KEYS[2], 'flush_id', flush_id)
+end
+return redis.call('HGETALL', KEYS[2])
+"""
+# 标记flushing hash已经写回数据库，flush_id不同时说明已经被别的worker换成了下一批，不做修改
+# KEYS[1]: flushing hash, ARGV[1]: flush_id
+MARK_FLUSH_APPLIED_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'flush_id') == ARGV[1] then
+    return redis.call('HSET', KEYS[1], 'applied', 1)
+end
+return 0
+"""
+# 只删除自己加的锁，锁已经超时被别人拿到时不会误删
+# KEYS[1]: lock key, ARGV[1]: token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 
 class RedisHelper:
+    # 脚本名 -> redis-py的Script对象，只在第一次使用时注册，之后用EVALSHA调用，
+    # redis server重启丢失脚本缓存时Script会自动重新SCRIPT LOAD
+    _scripts = {}
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects, serializer):
-        # cache miss 时，需要从数据库即queryset中取数据，存到cache中
+    def run_script(cls, script, keys, args, client=None):
+        # client可以是pipeline，多个脚本在同一次往返中执行
         conn = RedisClient.get_connection()
-        serialized_list = []
-        logger.info(f"Cache miss and load objects data {objects} to redis")
-        for obj in objects:
-            serialized_data = serializer.serialize(obj)
-            serialized_list.append(serialized_data)
+        if script not in cls._scripts:
+            cls._scripts[script] = conn.register_script(script)
+        return cls._scripts[script](keys=keys, args=args, client=client or conn)
 
-        logger.info(f"Serialized list data {serialized_list} are loading to redis")
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+    @classmethod
+    def acquire_lock(cls, key, timeout=None, client=None):
+        """
+        重建key的锁，拿到时返回token，否则返回None
+        锁有过期时间（毫秒，默认REDIS_REBUILD_LOCK_TIMEOUT），拿到锁的进程挂掉之后不会一直锁住
+        client是key所在的redis，以下几个方法相同，默认是default连接池
+        """
+        conn = client or RedisClient.get_connection()
+        token = uuid.uuid4().hex
+        timeout = timeout or settings.REDIS_REBUILD_LOCK_TIMEOUT
+        if conn.set('{}:rebuild_lock'.format(key), token, px=timeout, nx=True):
+            return token
+        return None
 
     @classmethod
-    def load_objects(cls, key, lazy_load_objects, serializer=DjangoModelSerializer):
-        # 最多只cache REDIS_LIST_LENGTH_LIMIT个数据，比如200个，超过这个的就去数据库里面读
-        # 此时的数据量不会太大，所以可以直接访问数据库
+    def release_lock(cls, key, token, client=None):
+        cls.run_script(RELEASE_LOCK_SCRIPT, ['{}:rebuild_lock'.format(key)], [token], client=client)
 
-        conn = RedisClient.get_connection()
-        # if cache hit, return it directly
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            logger.info(f'Get key:{key} from redis: {serialized_list}')
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = serializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            logger.info(f'Cache return deserialized {objects}')
-            return objects
-
-        # cache miss
-        logger.info(f'Get key:{key} missing!')
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
-        # 与存在redis里面的数据统一，都是list, 因为cache hit时也返回的一个queryset list
-        return list(objects)
-
-    @classmethod
-    def push_object(cls, key, obj, lazy_load_objects):
-        if isinstance(obj, HBaseModel):
-            logger.info(f'Push hbase model with key:{key}, data: {obj}')
-            serializer = HBaseModelSerializer
-        else:
-            logger.info(f'Push mysql model with key:{key}, data: {obj}')
-            serializer = DjangoModelSerializer
-        conn = RedisClient.get_connection()
-        if not conn.exists(key):
-            logger.info(f'Cache miss for key {key}')
-            objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-            cls._load_objects_to_cache(key, objects, serializer)
-            return
+    @classmethod
+    def load_once(cls, key, read_cache, rebuild, client=None):
+        """
+        single flight：cache miss时同一个key同时只有一个进程去数据库重建，其他进程等待重建完成后读cache
+        read_cache() 读取cache，miss时返回None；rebuild() 从数据库读取，回填cache并返回结果
+        拿到锁之后再读一次cache，等锁的过程中可能已经被别人回填了
+        等待超过REDIS_REBUILD_WAIT_TIMEOUT毫秒还没有回填时（比如重建的进程挂了），自己去数据库读，
+        回填的脚本只在key不存在时写入，不会产生重复的数据
+        """
+        deadline = time.monotonic() + settings.REDIS_REBUILD_WAIT_TIMEOUT / 1000
+        while True:
+            token = cls.acquire_lock(key, client=client)
+            if token is not None:
+                try:
+                    result = read_cache()
+                    if result is not None:
+                        return result
+                    return rebuild()
+                finally:
+                    cls.release_lock(key, token, client=client)
+
+            if time.monotonic() >= deadline:
+                Tracer.event('redis.rebuild_wait_timeout', key=key)
+                return rebuild()
+            time.sleep(settings.REDIS_REBUILD_POLL_INTERVAL / 1000)
+            result = read_cache()
+            if result is not None:
+                return result
 
-        serialized_data = serializer.serialize(obj)
-        logger.info(f'Push serialized data {serialized_data} to redis list key {key}')
-        conn.lpush(key, serialized_data)
-        # redis 的区间是开区间，包括最后一个
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+    @classmethod
+    def revalidate(cls, key, rebuild, client=None):
+        """
+        stale-while-revalidate：cache已经过了soft expire时间时，只有拿到锁的进程去重建，返回rebuild()的结果，
+        其他进程不等待，返回None，由调用方继续使用旧的数据
+        """
+        token = cls.acquire_lock(key, client=client)
+        if token is None:
+            return None
+        try:
+            return rebuild()
+        finally:
+            cls.release_lock(key, token, client=client)
+
+    @classmethod
+    def get_fresh_key(cls, key):
+        # 这个key存在说明key还在soft expire时间内
+        return '{}:fresh'.format(key)
+
+    @classmethod
+    def mark_fresh(cls, key, client=None):
+        if settings.REDIS_SOFT_EXPIRE_TIME:
+            conn = client or RedisClient.get_connection()
+            conn.set(cls.get_fresh_key(key), 1, ex=settings.REDIS_SOFT_EXPIRE_TIME)
+
+    @classmethod
+    def get_score(cls, obj):
+        """
+        timeline中按created_at的微秒时间戳排序，hbase model的created_at本身就是微秒时间戳
+        """
+        if isinstance(obj.created_at, int):
+            return obj.created_at
+        return datetime_to_timestamp(obj.created_at)
+
+    @classmethod
+    def filter_by_score(cls, objects, max_score=None, min_score=None, limit=None):
+        # 与ZREVRANGEBYSCORE相同的过滤，用于cache miss时从数据库读到的按时间倒序的objects
+        page = [
+            obj for obj in objects
+            if (max_score is None or cls.get_score(obj) < max_score)
+            and (min_score is None or cls.get_score(obj) > min_score)
+        ]
+        return page[:limit]
 
     @classmethod
     def get_count_key(cls, obj, attr):
         return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
 
+    @classmethod
+    def get_pending_count_field(cls, obj, attr):
+        # pending hash中的field，比如 'weits.Weit:1:likes_count'
+        return '{}:{}:{}'.format(obj._meta.label, obj.id, attr)
+
+    @classmethod
+    def _annotate_applied_flush_id(cls, queryset):
+        # 与计数在同一条SELECT中读出已经写回的最大flush_id，两者是同一个时间点的数据，
+        # 回填时据此判断数据库中的值是否已经包含了flushing hash中的增量
+        counter_flush_model = apps.get_model('weits', 'CounterFlush')
+        return queryset.annotate(applied_flush_id=Subquery(
+            counter_flush_model.objects.order_by('-flush_id').values('flush_id')[:1],
+        ))
+
+    @classmethod
+    def _backfill_count(cls, obj, attr, db_count=None, applied_flush_id=None, client=None):
+        # back fill cache from db
+        # 并发回填时先写入的为准，两边读到的都是数据库里最新的值加上还没写回数据库的增量
+        if db_count is None:
+            # 只读取这一个字段，不需要refresh_from_db重新读取整行
+            queryset = cls._annotate_applied_flush_id(obj.__class__.objects.filter(id=obj.id))
+            db_count, applied_flush_id = queryset.values_list(attr, 'applied_flush_id').first() or (None, None)
+        return cls.run_script(
+            BACKFILL_COUNT_SCRIPT,
+            [cls.get_count_key(obj, attr), PENDING_COUNTS_KEY, FLUSHING_COUNTS_KEY],
+            # 老数据的计数可能是null
+            [
+                cls.get_pending_count_field(obj, attr),
+                db_count or 0,
+                settings.REDIS_KEY_EXPIRE_TIME,
+                applied_flush_id or 0,
+            ],
+            client=client or RedisClient.get_connection('counters'),
+        )
+
     @classmethod
     def incr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
         key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return conn.incr(key)
+        count = cls.run_script(INCR_IF_EXISTS_SCRIPT, [key], [1], client=RedisClient.get_connection('counters'))
+        if count is not None:
+            return count
 
-        # back fill cache from db
         # 不执行+1操作，因为必须保证调用incr_count之前，数据库层面obj.attr已经+1了
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+        return cls._backfill_count(obj, attr)
 
     @classmethod
     def decr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
         key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return conn.decr(key)
+        count = cls.run_script(INCR_IF_EXISTS_SCRIPT, [key], [-1], client=RedisClient.get_connection('counters'))
+        if count is not None:
+            return count
         # 不执行-1操作，因为必须保证调用incr_count之前，数据库层面obj.attr已经-1了
         # 从这里我们也能看出，每次更新cache时，若cache不在，则直接去数据库里面取，此时无须更改，因为数据库已经是最新的
         # 若cache存在，则针对cache进行更新改动
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+        return cls._backfill_count(obj, attr)
 
     @classmethod
     def get_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
+        conn = RedisClient.get_connection('counters')
         key = cls.get_count_key(obj, attr)
         count = conn.get(key)
         if count is not None:
             return int(count)
 
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
+        return cls._backfill_count(obj, attr)
+
+    @classmethod
+    def get_counts(cls, objs, attrs):
+        """
+        批量版本的get_count，用于一页的数据：一次MGET读出所有的计数，
+        没命中的用一次values_list查询读出来，再在一个pipeline中回填，一共最多两次redis往返和一次数据库查询
+        objs需要是同一个model，返回 {count key: 计数}，数据库中已经不存在的object不在返回值中
+        """
+        keys = [(obj, attr, cls.get_count_key(obj, attr)) for obj in objs for attr in attrs]
+        if not keys:
+            return {}
+        conn = RedisClient.get_connection('counters')
+        counts, missing = {}, []
+        for (obj, attr, key), count in zip(keys, conn.mget([key for _, _, key in keys])):
+            if count is None:
+                missing.append((obj, attr, key))
+            else:
+                counts[key] = int(count)
+        if not missing:
+            return counts
+
+        missing_attrs = sorted({attr for _, attr, _ in missing})
+        rows = cls._annotate_applied_flush_id(objs[0].__class__.objects.filter(
+            id__in={obj.id for obj, _, _ in missing},
+        )).values_list('id', 'applied_flush_id', *missing_attrs)
+        db_counts = {row[0]: (row[1], dict(zip(missing_attrs, row[2:]))) for row in rows}
+
+        pipeline = conn.pipeline(transaction=False)
+        backfilled = [(obj, attr, key) for obj, attr, key in missing if obj.id in db_counts]
+        for obj, attr, key in backfilled:
+            applied_flush_id, values = db_counts[obj.id]
+            cls._backfill_count(
+                obj,
+                attr,
+                db_count=values[attr] or 0,
+                applied_flush_id=applied_flush_id,
+                client=pipeline,
+            )
+        for (_, _, key), count in zip(backfilled, pipeline.execute()):
+            counts[key] = count
+        return counts
+
+    @classmethod
+    def incr_pending_count(cls, obj, attr, delta):
+        """
+        write-behind：不更新数据库，增量记在redis的pending hash中，由flush_pending_counts定期合并写回数据库，
+        热门weit的点赞不会都去抢数据库中同一行的行锁
+        返回更新之后的计数
+        """
+        key = cls.get_count_key(obj, attr)
+        field = cls.get_pending_count_field(obj, attr)
+        count = cls.run_script(
+            INCR_PENDING_COUNT_SCRIPT,
+            [key, PENDING_COUNTS_KEY],
+            [field, delta],
+            client=RedisClient.get_connection('counters'),
+        )
+        if count is not None:
+            return count
+        # 增量已经记在pending hash中了，回填时会加上
+        return cls._backfill_count(obj, attr)
 
+    @classmethod
+    def _apply_pending_counts(cls, flush_id, object_ids):
+        """
+        在一个事务中写回一批增量并记录它的flush_id，这一批已经写回过时什么都不做，返回是否写回了
+        flush_id是自增的，数据库中有不比它小的flush_id说明已经写回过
+        """
+        counter_flush_model = apps.get_model('weits', 'CounterFlush')
+        try:
+            with transaction.atomic():
+                if counter_flush_model.objects.filter(flush_id__gte=flush_id).exists():
+                    return False
+                counter_flush_model.objects.create(flush_id=flush_id)
+                counter_flush_model.objects.filter(flush_id__lt=flush_id).delete()
+                for (label, attr, delta), ids in object_ids.items():
+                    apps.get_model(label).objects.filter(id__in=ids).update(**{attr: F(attr) + delta})
+        except IntegrityError:
+            # 锁过期之后另一个worker同时写回了同一批
+            return False
+        return True
+
+    @classmethod
+    def flush_pending_counts(cls):
+        """
+        把pending hash中的增量合并写回数据库，返回写回了多少个计数
+        同一个model，字段和增量的object用一条 UPDATE ... WHERE id IN (...) 写回
+        每一批增量有一个flush_id，与UPDATE在同一个事务中记录到数据库，提交之后才在flushing hash上标记applied，
+        中途挂掉时下一次会重新写回这一批，已经提交过的不会重复写回，增量不会丢失也不会重复
+        """
+        # 同时只有一个worker在写回，锁的过期时间比任务的time_limit长
+        conn = RedisClient.get_connection('counters')
+        token = cls.acquire_lock(PENDING_COUNTS_KEY, timeout=settings.COUNTER_FLUSH_LOCK_TIMEOUT, client=conn)
+        if token is None:
+            return 0
+        try:
+            pending = cls.run_script(
+                TAKE_PENDING_COUNTS_SCRIPT,
+                [PENDING_COUNTS_KEY, FLUSHING_COUNTS_KEY, FLUSH_ID_KEY],
+                [apps.get_model('weits', 'CounterFlush').objects.aggregate(Max('flush_id'))['flush_id__max'] or 0],
+                client=conn,
+            )
+            if not pending:
+                return 0
+            pending = dict(zip(pending[::2], pending[1::2]))
+            flush_id = int(pending.pop(b'flush_id'))
+            # (model label, 字段, 增量) -> object ids
+            object_ids = defaultdict(list)
+            for field, delta in pending.items():
+                label, object_id, attr = field.decode('utf-8').split(':')
+                if int(delta):
+                    object_ids[(label, attr, int(delta))].append(int(object_id))
 
+            applied = cls._apply_pending_counts(flush_id, object_ids)
+            cls.run_script(MARK_FLUSH_APPLIED_SCRIPT, [FLUSHING_COUNTS_KEY], [flush_id], client=conn)
+            if not applied:
+                Tracer.event('counters.flush_skipped', flush_id=flush_id)
+                return 0
+            Tracer.event('counters.flush', flush_id=flush_id, counts=len(pending), updates=len(object_ids))
+            return len(pending)
+        finally:
+            cls.release_lock(PENDING_COUNTS_KEY, token, client=conn)
@@ -20,20 +20,24 @@ class DjangoModelSerializer:
 
 
 class HBaseModelSerializer:
+    # model_class_name -> HBaseModel子类，避免每次反序列化都遍历__subclasses__()
+    _model_classes = {}
 
     @classmethod
     def get_model_class(cls, model_class_name):
+        model_class = cls._model_classes.get(model_class_name)
+        if model_class is not None:
+            return model_class
         for subclass in HBaseModel.__subclasses__():
             if subclass.__name__ == model_class_name:
+                cls._model_classes[model_class_name] = subclass
                 return subclass
         raise Exception('HBaseModel {} not found'.format(model_class_name))
 
     @classmethod
     def serialize(cls, instance: HBaseModel):
         json_data = {'model_class_name': instance.__class__.__name__}
-        for key in instance.get_field_maps():
-            value = getattr(instance, key)
-            json_data[key] = value
+        json_data.update(instance.to_dict())
         return json.dumps(json_data)
 
     @classmethod
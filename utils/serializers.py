@@ -0,0 +1,41 @@
+from django.db import models
+from rest_framework import serializers
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_helper import RedisHelper
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    many=True时，先调用child.prefetch(instances)批量读取这一页都要用到的数据，再逐个序列化，
+    避免每个object单独访问一次redis/数据库
+    整个序列化过程在MemcachedHelper.prefetch_scope中，prefetch时用MemcachedHelper.prefetch_objects
+    读到的object（比如cached_user），逐个序列化时不会再访问memcached
+    在serializer的Meta中设置 list_serializer_class = PrefetchListSerializer，并实现prefetch
+    """
+
+    def to_representation(self, data):
+        instances = list(data.all() if isinstance(data, models.Manager) else data)
+        with MemcachedHelper.prefetch_scope():
+            prefetch = getattr(self.child, 'prefetch', None)
+            if prefetch is not None and instances:
+                prefetch(instances)
+            return super().to_representation(instances)
+
+
+class CountsPrefetchMixin:
+    """
+    count_fields中的计数（比如likes_count）在prefetch时用RedisHelper.get_counts批量读取，
+    存在context中，嵌套的serializer（比如newsfeed中的weit）共用同一个context也能读到
+    """
+    count_fields = ()
+
+    def prefetch(self, instances):
+        counts = self.context.setdefault('prefetched_counts', {})
+        counts.update(RedisHelper.get_counts(instances, self.count_fields))
+
+    def get_cached_count(self, obj, attr):
+        counts = self.context.get('prefetched_counts', {})
+        key = RedisHelper.get_count_key(obj, attr)
+        if key in counts:
+            return counts[key]
+        return RedisHelper.get_count(obj, attr)
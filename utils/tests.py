@@ -1,5 +1,29 @@
+import logging
+import pickle
+import threading
+from unittest import mock
+
+from accounts.services import UserService
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from gatekeeper.models import GateKeeper
+from newsfeeds.models import HBaseNewsFeed
 from testing.testcases import TestCase
-from utils.redis_client import RedisClient
+from django.conf import settings
+from utils.compact_serializer import CompactSerializer
+from utils.local_cache import LocalCache, LocalCacheHelper
+from utils.memcached_helper import MemcachedHelper
+from utils.paginations import parse_timestamp_cursor
+from utils.redis_client import ConsistentHashRing, RedisClient
+from utils.redis_helper import RedisHelper
+from utils.redis_serializers import DjangoModelSerializer
+from utils.loggers import logger
+from utils.timeline_cache import TimelineCache
+from utils.tracing import Tracer
+from weits.models import CounterFlush, Weit
+from weits.services import WeitService, WeitTimelineCache
+from weits.tasks import flush_pending_counts_task
+from weitter.cache import FLUSH_ID_KEY, FLUSHING_COUNTS_KEY, LOCAL_CACHE_INVALIDATION_CHANNEL, PENDING_COUNTS_KEY
 
 
 class UtilsTests(TestCase):
@@ -18,3 +42,376 @@ class UtilsTests(TestCase):
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
 
+    def test_tracer(self):
+        formatted = []
+
+        class Payload:
+            def __repr__(self):
+                formatted.append(self)
+                return 'payload'
+
+        # 日志级别没有开启时不会格式化
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            Tracer.event('test.event', value=Payload())
+            Tracer.payload('test.payload', [Payload()])
+        finally:
+            logger.setLevel(level)
+        self.assertEqual(formatted, [])
+
+        # 默认只记录大小，采样到时才记录完整的payload
+        with self.assertLogs('django', level='DEBUG') as logs:
+            with self.settings(TRACE_PAYLOAD_SAMPLE_RATE=0):
+                Tracer.payload('test.payload', [Payload(), Payload()], key='k')
+            with self.settings(TRACE_PAYLOAD_SAMPLE_RATE=1):
+                Tracer.payload('test.payload', (Payload() for _ in range(1)), key='k')
+            Tracer.event('test.event', key='k', size=3)
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            'test.payload key=k size=2',
+            'test.payload key=k size=1 payload=[payload]',
+            'test.event key=k size=3',
+        ])
+
+    def test_local_cache(self):
+        local_cache = LocalCache(max_size=2, timeout=5)
+        with mock.patch('utils.local_cache.time.monotonic', return_value=100):
+            local_cache.set('a', {'value': 1})
+            local_cache.set('b', {'value': 2})
+            # 每次读到的都是新的object
+            obj = local_cache.get('a')
+            obj['value'] = 3
+            self.assertEqual(local_cache.get('a'), {'value': 1})
+            # 超过max_size时淘汰最久没有用过的b
+            local_cache.set('c', {'value': 3})
+            self.assertEqual(local_cache.get_many(['a', 'b', 'c']), {'a': {'value': 1}, 'c': {'value': 3}})
+        with mock.patch('utils.local_cache.time.monotonic', return_value=105):
+            self.assertIsNone(local_cache.get('a'))
+        self.assertEqual(local_cache.stats(), {
+            'size': 1,
+            'max_size': 2,
+            'hits': 4,
+            'misses': 2,
+            'hit_rate': 0.6667,
+            'evictions': 1,
+            'expirations': 1,
+        })
+
+    def test_local_cache_invalidation(self):
+        user = self.create_user('local_cache_user')
+        key = MemcachedHelper.get_key(type(user), user.id)
+        MemcachedHelper.get_object_through_cache(type(user), user.id)
+        self.assertEqual(MemcachedHelper.decode(LocalCacheHelper.get(key)).username, 'local_cache_user')
+
+        # 修改之后删除本进程的那一份，并广播给其他进程
+        pubsub = RedisClient.get_connection('local_cache').pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(LOCAL_CACHE_INVALIDATION_CHANNEL)
+        pubsub.get_message(timeout=1)
+        user.username = 'local_cache_user2'
+        user.save()
+        self.assertIsNone(LocalCacheHelper.get(key))
+        message = pubsub.get_message(timeout=1)
+        self.assertEqual(message['data'], key.encode('utf-8'))
+        pubsub.close()
+
+        # 其他进程收到广播之后删除
+        self.assertEqual(MemcachedHelper.get_object_through_cache(type(user), user.id).username, 'local_cache_user2')
+        LocalCacheHelper.handle_message(message)
+        self.assertIsNone(LocalCacheHelper.get(key))
+        with self.settings(LOCAL_CACHE_SIZE=0):
+            self.assertIsNone(LocalCacheHelper.get(key))
+            MemcachedHelper.get_object_through_cache(type(user), user.id)
+        self.assertIsNone(LocalCacheHelper.get(key))
+
+    def test_memcached_negative_cache(self):
+        user = self.create_user('negative_cache_user')
+        missing_id = user.id + 100
+        for _ in range(2):
+            with self.assertRaises(User.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(User, missing_id)
+            LocalCacheHelper.clear()
+        # 不存在的结果缓存在memcached中，不再查询数据库
+        with self.assertNumQueries(0):
+            with self.assertRaises(User.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(User, missing_id)
+            with self.assertRaises(User.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(User, None)
+            self.assertEqual(MemcachedHelper.get_objects_through_cache(User, [missing_id]), [])
+
+        # 批量读取时不存在的id也会缓存
+        weit = self.create_weit(user)
+        weit_id = weit.id
+        weit.delete()
+        self.assertEqual(MemcachedHelper.get_objects_through_cache(Weit, [weit_id, missing_id]), [])
+        LocalCacheHelper.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(MemcachedHelper.get_objects_through_cache(Weit, [weit_id, missing_id]), [])
+            with self.assertRaises(Weit.DoesNotExist):
+                MemcachedHelper.get_object_through_cache(Weit, weit_id)
+
+        # 新建之后post_save删除不存在的结果
+        User.objects.create(id=missing_id, username='negative_cache_user2')
+        self.assertEqual(MemcachedHelper.get_object_through_cache(User, missing_id).username, 'negative_cache_user2')
+
+    def test_memcached_compact_codec(self):
+        user = self.create_user('compact_codec_user')
+        user.profile.nickname = 'compact'
+        user.profile.save()
+        # 实例上另外加的属性不会存到cache中
+        self.assertTrue(hasattr(user, '_cached_user_profile'))
+        data = MemcachedHelper.encode(user)
+        self.assertTrue(CompactSerializer.is_compact(data))
+        self.assertLess(len(data), len(pickle.dumps(user)))
+        cached_user = MemcachedHelper.decode(data)
+        self.assertFalse(hasattr(cached_user, '_cached_user_profile'))
+        self.assertFalse(cached_user._state.adding)
+        for field in User._meta.concrete_fields:
+            self.assertEqual(getattr(cached_user, field.attname), getattr(user, field.attname))
+
+        # field改变之后schema version和key都会改变，不会读到老格式的数据
+        version = CompactSerializer.get_schema_version(User)
+        self.assertEqual(MemcachedHelper.get_key(User, user.id), 'User:{}:{}'.format(version, user.id))
+        self.assertNotEqual(
+            CompactSerializer._compute_schema_version(User, 4, ['id', 'username']),
+            version,
+        )
+
+        # 通过cache读到的profile与数据库中的一致
+        for _ in range(2):
+            profile = UserService.get_profile_through_cache(user.id)
+            self.assertEqual(profile.nickname, 'compact')
+            self.assertEqual(profile.user_id, user.id)
+        self.assertTrue(CompactSerializer.is_compact(caches['testing'].get(UserService.get_profile_key(user.id))))
+
+    def test_consistent_hash_ring(self):
+        keys = ['user_newsfeed_ids:{}'.format(user_id) for user_id in range(1000)]
+        ring = ConsistentHashRing({name: name for name in ('a', 'b', 'c')})
+        nodes = {key: ring.get_node(key) for key in keys}
+        for name in ('a', 'b', 'c'):
+            self.assertGreater(list(nodes.values()).count(name), 200)
+
+        # 增加一个节点时，只有分到新节点上的key换了节点
+        ring = ConsistentHashRing({name: name for name in ('a', 'b', 'c', 'd')})
+        moved = [key for key in keys if ring.get_node(key) != nodes[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(ring.get_node(key) == 'd' for key in moved))
+
+    def test_sharded_timelines(self):
+        default = settings.REDIS_POOLS['default']
+        nodes = [dict(default, db=default['db'] + 1), dict(default, db=default['db'] + 2)]
+        user = self.create_user('sharded_user')
+        weit = self.create_weit(user)
+        with self.settings(REDIS_POOLS={'default': default, 'timelines': {'nodes': nodes}}):
+            RedisClient.reset()
+            try:
+                RedisClient.clear()
+                with self.assertRaises(ValueError):
+                    RedisClient.get_connection('timelines')
+                self.assertEqual([w.id for w in WeitService.get_cached_weits(user.id)], [weit.id])
+                new_weit = self.create_weit(user)
+                self.assertEqual([w.id for w in WeitService.get_cached_weits(user.id)], [new_weit.id, weit.id])
+
+                # timeline只存在key所在的节点上
+                key = WeitTimelineCache.get_key(user.id)
+                conn = RedisClient.get_connection_for_key(key, 'timelines')
+                self.assertEqual(conn.zcard(key), 2)
+                other = [c for c in RedisClient.get_all_connections()[1:] if c is not conn]
+                self.assertEqual([c.exists(key) for c in other], [0])
+                # 其他用途仍然使用default
+                self.assertIs(RedisClient.get_connection('counters'), RedisClient.get_connection())
+                RedisClient.clear()
+            finally:
+                RedisClient.reset()
+
+    def test_redis_helper_count(self):
+        weit = self.create_weit(self.create_user('redis_helper_user'))
+        conn = RedisClient.get_connection()
+
+        self.assertEqual(RedisHelper.incr_count(weit, 'likes_count'), 0)
+        self.assertEqual(RedisHelper.incr_count(weit, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.decr_count(weit, 'likes_count'), 0)
+        self.assertEqual(RedisHelper.get_count(weit, 'likes_count'), 0)
+        self.assertGreater(conn.ttl(RedisHelper.get_count_key(weit, 'likes_count')), 0)
+
+    def test_redis_helper_single_flight(self):
+        conn = RedisClient.get_connection()
+        key = 'redis_helper:single_flight'
+        loaded = []
+
+        def read_cache():
+            return conn.get(key)
+
+        def rebuild():
+            loaded.append(key)
+            conn.set(key, b'db')
+            return b'db'
+
+        # 别的进程正在重建，等它回填之后直接读cache，不访问数据库
+        token = RedisHelper.acquire_lock(key)
+        self.assertIsNotNone(token)
+        self.assertIsNone(RedisHelper.acquire_lock(key))
+        other_rebuild = threading.Timer(0.1, conn.set, (key, b'other'))
+        other_rebuild.start()
+        self.assertEqual(RedisHelper.load_once(key, read_cache, rebuild), b'other')
+        other_rebuild.join()
+        self.assertEqual(loaded, [])
+
+        # 锁只能被加锁的人释放
+        RedisHelper.release_lock(key, 'other token')
+        self.assertIsNone(RedisHelper.acquire_lock(key))
+        RedisHelper.release_lock(key, token)
+
+        # 没有人在重建时自己回填
+        conn.delete(key)
+        self.assertEqual(RedisHelper.load_once(key, read_cache, rebuild), b'db')
+        self.assertEqual(len(loaded), 1)
+        self.assertIsNotNone(RedisHelper.acquire_lock(key))
+
+    def test_timeline_stale_while_revalidate(self):
+        user = self.create_user('stale_user')
+        weits = [self.create_weit(user) for _ in range(2)]
+        conn = RedisClient.get_connection()
+        loaded = []
+
+        class WeitTimeline(TimelineCache):
+            key_pattern = 'stale_timeline:{user_id}'
+
+            @classmethod
+            def get_member(cls, obj):
+                return obj.id
+
+            @classmethod
+            def build_objects(cls, owner_id, members, scores):
+                return list(members)
+
+        def lazy_load_weits(limit):
+            loaded.append(limit)
+            return Weit.objects.filter(user=user).order_by('-created_at')[:limit]
+
+        key = WeitTimeline.get_key(user.id)
+        with self.settings(REDIS_SOFT_EXPIRE_TIME=60):
+            WeitTimeline.load(user.id, lazy_load_weits)
+            self.assertTrue(conn.exists(RedisHelper.get_fresh_key(key)))
+            self.assertEqual(WeitTimeline.load(user.id, lazy_load_weits), [w.id for w in reversed(weits)])
+            self.assertEqual(len(loaded), 1)
+
+            # 过了soft expire时间，别的进程正在重建时继续返回旧的数据
+            conn.delete(RedisHelper.get_fresh_key(key))
+            new_weit = self.create_weit(user)
+            token = RedisHelper.acquire_lock(key)
+            self.assertEqual(WeitTimeline.load(user.id, lazy_load_weits), [w.id for w in reversed(weits)])
+            self.assertEqual(len(loaded), 1)
+            RedisHelper.release_lock(key, token)
+
+            # 拿到锁的进程合并数据库中最新的数据
+            page, _, cached_count = WeitTimeline.load_page(user.id, lazy_load_weits, limit=1)
+            self.assertEqual([w.id for w in page], [new_weit.id])
+            self.assertEqual(len(loaded), 2)
+            self.assertEqual(WeitTimeline.load(user.id, lazy_load_weits), [new_weit.id, weits[1].id, weits[0].id])
+            self.assertEqual(len(loaded), 2)
+
+    def test_redis_helper_get_counts(self):
+        user = self.create_user('get_counts_user')
+        weits = [self.create_weit(user) for _ in range(3)]
+        self.create_like(user, weits[0])
+        self.create_comment(user, weits[1])
+        conn = RedisClient.get_connection()
+        conn.delete(*[RedisHelper.get_count_key(weit, attr) for weit in weits for attr in ('likes_count', 'comments_count')])
+        # 命中的部分直接返回，不会再读数据库
+        conn.set(RedisHelper.get_count_key(weits[2], 'likes_count'), 5)
+        deleted_weit = self.create_weit(user)
+        deleted_weit.delete()
+
+        counts = RedisHelper.get_counts(weits + [deleted_weit], ('likes_count', 'comments_count'))
+        self.assertEqual(
+            [(counts[RedisHelper.get_count_key(weit, 'likes_count')],
+              counts[RedisHelper.get_count_key(weit, 'comments_count')]) for weit in weits],
+            [(1, 0), (0, 1), (5, 0)],
+        )
+        self.assertNotIn(RedisHelper.get_count_key(deleted_weit, 'likes_count'), counts)
+        # 回填的计数有过期时间
+        self.assertGreater(conn.ttl(RedisHelper.get_count_key(weits[0], 'likes_count')), 0)
+        self.assertEqual(RedisHelper.get_counts([], ('likes_count',)), {})
+
+    def test_write_behind_counts(self):
+        GateKeeper.turn_on('switch_counter_write_behind')
+        user = self.create_user('write_behind_user')
+        weit = self.create_weit(user)
+        comment = self.create_comment(user, weit)
+        likes = [self.create_like(self.create_user('liker{}'.format(i)), weit) for i in range(3)]
+        self.create_like(user, comment)
+        likes[0].delete()
+        conn = RedisClient.get_connection()
+
+        # 数据库还没有更新，cache中是最新的计数
+        weit.refresh_from_db()
+        self.assertEqual((weit.likes_count, weit.comments_count), (0, 0))
+        self.assertEqual(RedisHelper.get_count(weit, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.get_count(weit, 'comments_count'), 1)
+        self.assertEqual(RedisHelper.get_count(comment, 'likes_count'), 1)
+
+        # cache过期时用数据库中的值加上还没写回的增量回填
+        conn.delete(RedisHelper.get_count_key(weit, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(weit, 'likes_count'), 2)
+
+        self.assertEqual(flush_pending_counts_task(), '3 pending counts flushed')
+        weit.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual((weit.likes_count, weit.comments_count, comment.likes_count), (2, 1, 1))
+        self.assertFalse(conn.exists(PENDING_COUNTS_KEY))
+        self.assertEqual(conn.hget(FLUSHING_COUNTS_KEY, 'applied'), b'1')
+        self.assertEqual(RedisHelper.flush_pending_counts(), 0)
+        # flushing hash已经写回，回填时不会再加上它的增量
+        conn.delete(RedisHelper.get_count_key(weit, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(weit, 'likes_count'), 2)
+
+        # 上一次写回中途失败时，先重新写回剩下的增量，之后的增量在下一次写回
+        self.create_like(user, weit)
+        conn.rename(PENDING_COUNTS_KEY, FLUSHING_COUNTS_KEY)
+        self.create_comment(user, weit)
+        self.assertEqual(RedisHelper.get_count(weit, 'comments_count'), 2)
+        conn.delete(RedisHelper.get_count_key(weit, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(weit, 'likes_count'), 3)
+        self.assertEqual(RedisHelper.flush_pending_counts(), 1)
+        self.assertEqual(RedisHelper.flush_pending_counts(), 1)
+        weit.refresh_from_db()
+        self.assertEqual((weit.likes_count, weit.comments_count), (3, 2))
+
+        # 数据库提交之后，标记applied之前挂掉，重新写回时跳过，回填时也不会重复加上
+        conn.hdel(FLUSHING_COUNTS_KEY, 'applied')
+        conn.delete(RedisHelper.get_count_key(weit, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(weit, 'likes_count'), 3)
+        self.assertEqual(RedisHelper.flush_pending_counts(), 0)
+        weit.refresh_from_db()
+        self.assertEqual((weit.likes_count, weit.comments_count), (3, 2))
+        self.assertEqual(CounterFlush.objects.count(), 1)
+
+        # redis中的flush_id计数器丢失之后，新的flush_id仍然比已经写回的大
+        conn.delete(FLUSH_ID_KEY)
+        self.create_like(self.create_user('liker_after_reset'), weit)
+        self.assertEqual(RedisHelper.flush_pending_counts(), 1)
+        weit.refresh_from_db()
+        self.assertEqual(weit.likes_count, 4)
+
+    def test_parse_timestamp_cursor(self):
+        # mysql的created_at是iso格式的cursor，hbase是微秒时间戳
+        weit = self.create_weit(self.create_user('pagination_user'))
+        self.assertEqual(parse_timestamp_cursor(weit.created_at.isoformat()), weit.timestamp)
+        self.assertEqual(parse_timestamp_cursor(str(weit.timestamp)), weit.timestamp)
+        self.assertEqual(parse_timestamp_cursor(weit.timestamp), weit.timestamp)
+
+    def test_compact_serializer(self):
+        weit = self.create_weit(self.create_user('compact_user'), 'compact content')
+        data = CompactSerializer.serialize(weit)
+        self.assertTrue(CompactSerializer.is_compact(data))
+        self.assertLess(len(data), len(DjangoModelSerializer.serialize(weit)))
+        cached_weit = CompactSerializer.deserialize(data)
+        self.assertEqual(cached_weit.id, weit.id)
+        self.assertEqual(cached_weit.user_id, weit.user_id)
+        self.assertEqual(cached_weit.content, weit.content)
+        self.assertEqual(cached_weit.created_at, weit.created_at)
+        self.assertEqual(cached_weit.timestamp, weit.timestamp)
+        self.assertFalse(cached_weit._state.adding)
+
+        newsfeed = HBaseNewsFeed(user_id=1, created_at=weit.timestamp, weit_id=weit.id)
+        self.assertEqual(CompactSerializer.deserialize(CompactSerializer.serialize(newsfeed)).to_dict(), newsfeed.to_dict())
@@ -1,6 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
 def utc_now():
     return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def datetime_to_timestamp(value):
+    # 微秒时间戳，用整数计算，避免 value.timestamp() 浮点数乘以 10^6 之后的舍入误差
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def timestamp_to_datetime(timestamp):
+    return EPOCH + timedelta(microseconds=timestamp)
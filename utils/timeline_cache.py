@@ -0,0 +1,199 @@
+from django.conf import settings
+from utils.tracing import Tracer
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
+from utils.redis_helper import (
+    LOAD_SORTED_SET_SCRIPT,
+    MERGE_SORTED_SET_SCRIPT,
+    PUSH_SORTED_SET_SCRIPT,
+    RedisHelper,
+)
+
+
+class TimelineCache:
+    """
+    两级的timeline cache
+    - 一级是redis sorted set，member只存id，score是created_at的微秒时间戳，按时间排序，最多REDIS_LIST_LENGTH_LIMIT个
+    - 二级是memcached，存object的内容，所有人的timeline共用一份，见MemcachedHelper.get_objects_through_cache
+    object修改之后只需要invalidate memcached中的那一份，不会在每个粉丝的timeline里留下过期的副本，
+    每个timeline也只占用存id的内存
+    cache miss时同一个timeline只有一个进程去数据库重建，设置了REDIS_SOFT_EXPIRE_TIME时，
+    超过soft expire时间的timeline由拿到锁的请求在返回之前从数据库读取并合并最新的数据，
+    其他请求不等待，继续读旧的数据
+    timeline使用redis的timelines连接池，配置了多个节点时按key分布在不同的节点上
+    子类需要设置key_pattern，实现get_member和build_objects
+    """
+    key_pattern = None
+
+    @classmethod
+    def get_key(cls, owner_id):
+        return cls.key_pattern.format(user_id=owner_id)
+
+    @classmethod
+    def get_connection(cls, key):
+        # 同一个timeline的数据，重建锁和soft expire标记都在key所在的节点上
+        return RedisClient.get_connection_for_key(key, 'timelines')
+
+    @classmethod
+    def get_member(cls, obj):
+        """
+        object在sorted set中存的id
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def build_objects(cls, owner_id, members, scores):
+        """
+        用redis中读到的id和时间戳得到object的list，顺序与members一致，已经不存在的object可以跳过
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def _load_to_cache(cls, key, objects, merge=False):
+        pairs = []
+        for obj in objects:
+            pairs.append(RedisHelper.get_score(obj))
+            pairs.append(cls.get_member(obj))
+        Tracer.event('timeline.load', key=key, size=len(pairs) // 2, merge=merge)
+        conn = cls.get_connection(key)
+        if pairs:
+            if merge:
+                args = [settings.REDIS_KEY_EXPIRE_TIME, settings.REDIS_LIST_LENGTH_LIMIT] + pairs
+                RedisHelper.run_script(MERGE_SORTED_SET_SCRIPT, [key], args, client=conn)
+            else:
+                args = [settings.REDIS_KEY_EXPIRE_TIME] + pairs
+                RedisHelper.run_script(LOAD_SORTED_SET_SCRIPT, [key], args, client=conn)
+        RedisHelper.mark_fresh(key, client=conn)
+
+    @classmethod
+    def _rebuild(cls, key, lazy_load_objects, merge=False):
+        objects = list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
+        cls._load_to_cache(key, objects, merge)
+        return objects
+
+    @classmethod
+    def _build_from_rows(cls, owner_id, rows):
+        members = [int(member) for member, _ in rows]
+        scores = [int(score) for _, score in rows]
+        return cls.build_objects(owner_id, members, scores)
+
+    @classmethod
+    def _read(cls, key, read_rows):
+        """
+        read_rows(pipeline)在pipeline中加入读取的命令，开启soft expire时在同一个pipeline中检查是否过期
+        返回 (pipeline的结果, 是否已经过了soft expire时间)
+        """
+        conn = cls.get_connection(key)
+        pipeline = conn.pipeline(transaction=False)
+        read_rows(pipeline)
+        if settings.REDIS_SOFT_EXPIRE_TIME:
+            pipeline.exists(RedisHelper.get_fresh_key(key))
+            *results, fresh = pipeline.execute()
+            return results, not fresh
+        return pipeline.execute(), False
+
+    @classmethod
+    def load(cls, owner_id, lazy_load_objects):
+        """
+        返回timeline中所有的object，按时间倒序
+        """
+        key = cls.get_key(owner_id)
+
+        def read_rows(pipeline):
+            pipeline.zrevrange(key, 0, -1, withscores=True)
+
+        def read_cache():
+            (rows,), _ = cls._read(key, read_rows)
+            return cls._build_from_rows(owner_id, rows) if rows else None
+
+        (rows,), stale = cls._read(key, read_rows)
+        if not rows:
+            Tracer.event('timeline.miss', key=key)
+            return RedisHelper.load_once(
+                key,
+                read_cache,
+                lambda: cls._rebuild(key, lazy_load_objects),
+                client=cls.get_connection(key),
+            )
+        if stale:
+            objects = RedisHelper.revalidate(
+                key,
+                lambda: cls._rebuild(key, lazy_load_objects, merge=True),
+                client=cls.get_connection(key),
+            )
+            if objects is not None:
+                return objects
+        return cls._build_from_rows(owner_id, rows)
+
+    @classmethod
+    def load_page(cls, owner_id, lazy_load_objects, max_score=None, min_score=None, limit=None):
+        """
+        按时间倒序读取 min_score < score < max_score 的最多limit个，用ZREVRANGEBYSCORE直接定位到cursor，
+        不需要把cursor之前的数据都读出来
+        返回 (objects, scores, cache中一共有多少个)
+        scores是redis中读到的每一行的时间戳，已经不存在的object在objects中被跳过，但仍然在scores中，
+        调用方用它判断是否还有下一页，用cache中一共有多少个判断cache中没有的部分是否需要去数据库取
+        一次redis往返读出这一页的id，再批量得到object
+        """
+        key = cls.get_key(owner_id)
+
+        def read_rows(pipeline):
+            pipeline.zcard(key)
+            pipeline.zrevrangebyscore(
+                key,
+                '+inf' if max_score is None else '({}'.format(max_score),
+                '-inf' if min_score is None else '({}'.format(min_score),
+                start=None if limit is None else 0,
+                num=limit,
+                withscores=True,
+            )
+
+        def read_cache():
+            (cached_count, rows), _ = cls._read(key, read_rows)
+            if not cached_count:
+                return None
+            return cls._build_from_rows(owner_id, rows), [int(score) for _, score in rows], cached_count
+
+        def rebuild(merge=False):
+            # 从数据库读到的是完整的timeline，在内存中过滤
+            objects = cls._rebuild(key, lazy_load_objects, merge)
+            page = RedisHelper.filter_by_score(objects, max_score, min_score, limit)
+            return page, [RedisHelper.get_score(obj) for obj in page], len(objects)
+
+        (cached_count, rows), stale = cls._read(key, read_rows)
+        if not cached_count:
+            Tracer.event('timeline.miss', key=key)
+            return RedisHelper.load_once(key, read_cache, rebuild, client=cls.get_connection(key))
+        if stale:
+            result = RedisHelper.revalidate(key, lambda: rebuild(merge=True), client=cls.get_connection(key))
+            if result is not None:
+                return result
+        return cls._build_from_rows(owner_id, rows), [int(score) for _, score in rows], cached_count
+
+    @classmethod
+    def push(cls, owner_id, obj, lazy_load_objects):
+        """
+        按时间戳插入id，重复push同一个object不会产生重复的数据，cache不存在时从数据库回填
+        """
+        key = cls.get_key(owner_id)
+        args = [RedisHelper.get_score(obj), cls.get_member(obj), settings.REDIS_LIST_LENGTH_LIMIT]
+        if RedisHelper.run_script(PUSH_SORTED_SET_SCRIPT, [key], args, client=cls.get_connection(key)):
+            return
+
+        Tracer.event('timeline.push_miss', key=key)
+        cls._rebuild(key, lazy_load_objects)
+
+
+class ModelTimelineCache(TimelineCache):
+    """
+    member是model的id，object的内容通过memcached批量读取
+    """
+    model_class = None
+
+    @classmethod
+    def get_member(cls, obj):
+        return obj.id
+
+    @classmethod
+    def build_objects(cls, owner_id, members, scores):
+        return MemcachedHelper.get_objects_through_cache(cls.model_class, members)
@@ -0,0 +1,44 @@
+import logging
+import random
+
+from django.conf import settings
+from utils.loggers import logger
+
+
+class TraceRecord:
+    """
+    一条trace日志，只有在logger真正输出时才会调用__str__格式化，
+    日志级别没有开启或者被handler丢弃时不需要格式化
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + ['{}={}'.format(key, value) for key, value in self.fields.items()])
+
+
+class Tracer:
+    """
+    cache和hbase等热点路径上的结构化日志，比如
+        Tracer.event('redis.miss', key=key)
+        Tracer.payload('redis.hit', serialized_list, key=key)
+    默认只记录payload的大小，完整的payload按TRACE_PAYLOAD_SAMPLE_RATE采样记录，
+    避免每个请求都把几百个object格式化成字符串
+    """
+
+    @classmethod
+    def event(cls, name, level=logging.INFO, **fields):
+        if logger.isEnabledFor(level):
+            logger.log(level, '%s', TraceRecord(name, fields))
+
+    @classmethod
+    def payload(cls, name, payload, level=logging.DEBUG, **fields):
+        if not logger.isEnabledFor(level):
+            return
+        payload = list(payload) if not hasattr(payload, '__len__') else payload
+        fields['size'] = len(payload)
+        if random.random() < settings.TRACE_PAYLOAD_SAMPLE_RATE:
+            fields['payload'] = payload
+        logger.log(level, '%s', TraceRecord(name, fields))
@@ -1,22 +1,24 @@
 from accounts.api.serializers import UserSerializerForWeit
+from accounts.services import UserService
 from comments.api.serializers import CommentSerializer
-from likes.api.serializers import LikeSerializer
-from likes.serivces import LikeService
+from likes.api.serializers import HasLikedPrefetchMixin, LikeSerializer
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from weits.constants import WEIT_PHOTOS_UPLOAD_LIMIT
 from weits.models import Weit
 from weits.services import WeitService
-from utils.redis_helper import RedisHelper
+from utils.serializers import CountsPrefetchMixin, PrefetchListSerializer
 
 
-class WeitSerializer(serializers.ModelSerializer):
+class WeitSerializer(HasLikedPrefetchMixin, CountsPrefetchMixin, serializers.ModelSerializer):
     # need to get not only user id but also user other info
     user = UserSerializerForWeit(source='cached_user')
     has_liked = serializers.SerializerMethodField()
     comments_count = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
     photo_urls = serializers.SerializerMethodField()
+    # 一页weit的计数用一次MGET读取，见CountsPrefetchMixin
+    count_fields = ('comments_count', 'likes_count')
 
     class Meta:
         model = Weit
@@ -30,18 +32,22 @@ class WeitSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchListSerializer
 
-    def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+    def prefetch(self, weits):
+        # user，计数和has_liked各批量读取一次
+        UserService.prefetch_users([weit.user_id for weit in weits])
+        self.prefetch_has_liked(weits)
+        super().prefetch(weits)
 
     def get_comments_count(self, obj):
         # name_set track the 'name' objects whose foreign are weit, 反查机制
         # return obj.comment_set.count()
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self.get_cached_count(obj, 'comments_count')
 
     def get_likes_count(self, obj):
         # return obj.like_set.count()
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self.get_cached_count(obj, 'likes_count')
 
     def get_photo_urls(self, obj):
         photo_urls = []
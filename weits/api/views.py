@@ -1,4 +1,5 @@
 from django.utils.decorators import method_decorator
+from functools import partial
 from newsfeeds.services import NewsFeedServices
 from ratelimit.decorators import ratelimit
 from rest_framework import viewsets
@@ -29,8 +30,10 @@ class WeitViewSet(viewsets.GenericViewSet):
         # ).prefetch_related('user').order_by('-created_at')
         # use cache for listing weits
         user_id = request.query_params['user_id']
-        cached_weits = WeitService.get_cached_weits(user_id)
-        page = self.paginator.paginate_cached_list(cached_weits, request)
+        page = self.paginator.paginate_cached_timeline(
+            partial(WeitService.get_cached_weits_page, user_id),
+            request,
+        )
         # page is None means 目前数据不在cache里（超过了cache的size), 直接去数据库取
         if page is None:
             queryset = Weit.objects.filter(user_id=user_id).order_by('-created_at')
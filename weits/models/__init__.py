@@ -1,2 +1,3 @@
+from .counter_flush import CounterFlush
 from .weit import Weit
 from .weit_photo import WeitPhoto
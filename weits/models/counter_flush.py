@@ -0,0 +1,14 @@
+from django.db import models
+
+
+class CounterFlush(models.Model):
+    """
+    已经写回数据库的write-behind计数，见RedisHelper.flush_pending_counts
+    与计数的UPDATE在同一个事务中插入，同一个flush_id不会被重复写回
+    只需要保留最新的一行，写回时删掉之前的
+    """
+    flush_id = models.BigIntegerField(unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.flush_id}: {self.created_at}'
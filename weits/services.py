@@ -1,6 +1,6 @@
 from weits.models import Weit, WeitPhoto
 from weitter.cache import USER_WEITS_PATTERN
-from utils.redis_helper import RedisHelper
+from utils.timeline_cache import ModelTimelineCache
 
 
 def lazy_load_weits(user_id):
@@ -9,6 +9,12 @@ def lazy_load_weits(user_id):
     return _lazy_load
 
 
+class WeitTimelineCache(ModelTimelineCache):
+    # redis中只存weit id，weit的内容从memcached中读取
+    key_pattern = USER_WEITS_PATTERN
+    model_class = Weit
+
+
 class WeitService(object):
 
     @classmethod
@@ -29,14 +35,23 @@ class WeitService(object):
         # queryset lazy loading, so we don't execute sql when we define the queryset
         # queryset = Weit.objects.filter(user_id=user_id).order_by('-created_at')
 
-        key = USER_WEITS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, lazy_load_weits(user_id))
+        return WeitTimelineCache.load(user_id, lazy_load_weits(user_id))
+
+    @classmethod
+    def get_cached_weits_page(cls, user_id, max_score=None, min_score=None, limit=None):
+        # 按时间戳区间读取一页，用于EndlessPagination.paginate_cached_timeline
+        return WeitTimelineCache.load_page(
+            user_id,
+            lazy_load_weits(user_id),
+            max_score=max_score,
+            min_score=min_score,
+            limit=limit,
+        )
 
     @classmethod
     def push_weit_to_cache(cls, weit):
         # queryset = Weit.objects.filter(user_id=weit.user_id).order_by('-created_at')
-        key = USER_WEITS_PATTERN.format(user_id=weit.user_id)
-        RedisHelper.push_object(key, weit, lazy_load_weits(weit.user_id))
+        WeitTimelineCache.push(weit.user_id, weit, lazy_load_weits(weit.user_id))
 
 
 
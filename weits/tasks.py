@@ -0,0 +1,10 @@
+from celery import shared_task
+from django.conf import settings
+from utils.redis_helper import RedisHelper
+
+
+@shared_task(routing_key='default', time_limit=settings.COUNTER_FLUSH_TIME_LIMIT)
+def flush_pending_counts_task():
+    # 由celery beat定期执行，见settings中的CELERY_BEAT_SCHEDULE
+    count = RedisHelper.flush_pending_counts()
+    return '{} pending counts flushed'.format(count)
@@ -1,5 +1,9 @@
 from datetime import timedelta
+from functools import partial
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
 from testing.testcases import TestCase
+from utils.paginations import EndlessPagination
 from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer
 from utils.time_helpers import utc_now
@@ -95,3 +99,47 @@ class WeitServiceTest(TestCase):
 
         weits = WeitService.get_cached_weits(self.user.id)
         self.assertEqual([w.id for w in weits], [weit2.id, weit1.id])
+
+    def test_cached_weits_store_ids_only(self):
+        weits = [self.create_weit(self.user, 'weit {}'.format(i)) for i in range(3)]
+        self.assertEqual([w.id for w in WeitService.get_cached_weits(self.user.id)], [w.id for w in weits[::-1]])
+
+        # redis中只存weit id
+        conn = RedisClient.get_connection()
+        key = USER_WEITS_PATTERN.format(user_id=self.user.id)
+        self.assertEqual(conn.zrevrange(key, 0, -1), [str(w.id).encode() for w in weits[::-1]])
+
+        # 修改weit只需要invalidate memcached中的那一份
+        weits[1].content = 'edited'
+        weits[1].save()
+        cached_weits = WeitService.get_cached_weits(self.user.id)
+        self.assertEqual([w.content for w in cached_weits], ['weit 2', 'edited', 'weit 0'])
+
+        # 已经删除的weit直接跳过
+        weits[0].delete()
+        page, scores, cached_count = WeitService.get_cached_weits_page(self.user.id, limit=3)
+        self.assertEqual([w.id for w in page], [weits[2].id, weits[1].id])
+        # scores中仍然有已经删除的那一行
+        self.assertEqual(len(scores), 3)
+        self.assertEqual(cached_count, 3)
+
+    def test_cached_weits_pagination_skips_deleted(self):
+        user = self.create_user('pagination_user')
+        weits = [self.create_weit(user, 'weit {}'.format(i)) for i in range(5)][::-1]
+        # 第一页多取的那一行已经删除，仍然有下一页
+        weits[2].delete()
+
+        paginator = EndlessPagination()
+        paginator.page_size = 2
+        load_page = partial(WeitService.get_cached_weits_page, user.id)
+        page = paginator.paginate_cached_timeline(load_page, Request(APIRequestFactory().get('/')))
+        self.assertEqual([w.id for w in page], [weits[0].id, weits[1].id])
+        self.assertTrue(paginator.has_next_page)
+
+        # 一直翻到最后一页，没有删除的weit都能读到，不会重复
+        weit_ids = [w.id for w in page]
+        while paginator.has_next_page:
+            request = Request(APIRequestFactory().get('/', {'created_at__lt': page[-1].created_at.isoformat()}))
+            page = paginator.paginate_cached_timeline(load_page, request)
+            weit_ids += [w.id for w in page]
+        self.assertEqual(weit_ids, [weits[0].id, weits[1].id, weits[3].id, weits[4].id])
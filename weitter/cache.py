@@ -1,4 +1,15 @@
 FOLLOWINGS_PATTERN = 'followings:{user_id}'
-USER_PROFILE_PATTERN = 'userprofile:{user_id}'
-USER_WEITS_PATTERN = 'user_weits:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# version是UserProfile的schema version，见UserService.get_profile_key
+USER_PROFILE_PATTERN = 'userprofile:{version}:{user_id}'
+# 按微秒时间戳排序的sorted set，只存id，object的内容在memcached中，见utils/timeline_cache.py
+# 之前存的是object的内容，换了key名避免上线时把老数据当作id读取
+USER_WEITS_PATTERN = 'user_weit_ids:{user_id}'
+USER_NEWSFEEDS_PATTERN = 'user_newsfeed_ids:{user_id}'
+# likes_count/comments_count的write-behind，还没有写回数据库的增量，见RedisHelper.incr_pending_count
+PENDING_COUNTS_KEY = 'pending_counts'
+# 正在写回数据库的增量，flush_id字段是这一批的编号，写回之后加上applied字段
+FLUSHING_COUNTS_KEY = 'pending_counts:flushing'
+# 自增的flush_id
+FLUSH_ID_KEY = 'pending_counts:flush_id'
+# 进程内cache（utils/local_cache.py）的invalidation，发布要删除的memcached key，每个进程都订阅
+LOCAL_CACHE_INVALIDATION_CHANNEL = 'local_cache:invalidations'
@@ -199,8 +199,53 @@ CACHES = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# 每个用途一个连接池，用 RedisClient.get_connection(role) 获取，没有配置的用途使用default
+# max_connections: 每个进程最多多少个连接，连接池用完时最多等待timeout秒
+# socket_timeout/socket_connect_timeout: redis卡住时尽快失败，而不是一直阻塞web进程
+REDIS_POOLS = {
+    'default': {
+        'host': REDIS_HOST,
+        'port': REDIS_PORT,
+        'db': REDIS_DB,
+        'max_connections': 50,
+        'timeout': 1,
+        'socket_timeout': 1,
+        'socket_connect_timeout': 1,
+    },
+}
+# 目前用到的用途：timelines（weit和newsfeed的timeline cache），counters（likes_count等计数和还没写回数据库的增量），
+# gatekeeper，local_cache（进程内cache的invalidation广播），可以分别放在不同的redis上，比如：
+# REDIS_POOLS['counters'] = dict(REDIS_POOLS['default'], host='10.0.0.2')
+# timelines可以配置多个节点，timeline的key按一致性哈希分布在这些节点上，内存和请求量可以水平扩展：
+# REDIS_POOLS['timelines'] = {
+#     'nodes': [dict(REDIS_POOLS['default'], host='10.0.0.3'), dict(REDIS_POOLS['default'], host='10.0.0.4')],
+# }
+# celery的broker单独配置，见CELERY_BROKER_URL
 REDIS_KEY_EXPIRE_TIME = 7 * 86400
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20
+# cache miss时同一个key同时只有一个进程去数据库重建，见RedisHelper.load_once，以下单位都是毫秒
+# 重建锁的过期时间，要比一次重建（读数据库+回填）的时间长
+REDIS_REBUILD_LOCK_TIMEOUT = 5000
+# 其他进程最多等待多久，超时后自己去数据库读
+REDIS_REBUILD_WAIT_TIMEOUT = 3000
+# 等待时每隔多久读一次cache
+REDIS_REBUILD_POLL_INTERVAL = 50
+# timeline的soft expire时间（秒），超过之后只有拿到锁的请求在自己的请求中去数据库重建，
+# 其他请求不等待，继续读旧的数据（stale-while-revalidate）
+# None表示不开启，只在REDIS_KEY_EXPIRE_TIME过期之后重建
+REDIS_SOFT_EXPIRE_TIME = None
+
+# 数据库中不存在的object（比如已经删除的weit）在memcached中缓存多少秒，见MemcachedHelper.get_object_through_cache
+# 新建User和Weit时post_save中的invalidate_object_cache会删除这个结果，没有连接post_save的model最多这么久之后才能读到新建的object
+MEMCACHED_NEGATIVE_CACHE_TIMEOUT = 60
+
+# memcached前面的进程内cache（LRU），缓存热点的user，profile和weit，见utils/local_cache.py
+# 每个进程最多缓存多少个object，0表示不开启
+LOCAL_CACHE_SIZE = 1000
+# 每个object在进程内最多缓存多少秒，invalidation广播丢失时最多读到这么久的旧数据
+LOCAL_CACHE_TIMEOUT = 5
+# 每隔多少秒在日志中记录一次命中率和淘汰数（local_cache.stats），用来调整LOCAL_CACHE_SIZE
+LOCAL_CACHE_STATS_INTERVAL = 60
 
 # https://docs.celeryq.dev/en/stable/django/first-steps-with-django.html?highlight=django
 # Celery configuration
@@ -214,6 +259,21 @@ CELERY_TASK_ALWAYS_EAGER = TESTING
 # For debug
 # CELERY_TASK_ALWAYS_EAGER = True
 
+# 打开 switch_counter_write_behind 之后，likes_count/comments_count的增量先记在redis中，
+# 由celery beat每隔COUNTER_FLUSH_INTERVAL秒合并写回数据库，需要运行beat：
+# nohup celery -A weitter beat -l INFO > celery_beat.logs &
+COUNTER_FLUSH_INTERVAL = 10
+# 写回任务的time_limit（秒），超时的任务会被杀掉
+COUNTER_FLUSH_TIME_LIMIT = 30
+# 写回数据库时加锁的过期时间（毫秒），要比COUNTER_FLUSH_TIME_LIMIT长，任务还在运行时锁不会过期
+COUNTER_FLUSH_LOCK_TIMEOUT = 60 * 1000
+CELERY_BEAT_SCHEDULE = {
+    'flush-pending-counts': {
+        'task': 'weits.tasks.flush_pending_counts_task',
+        'schedule': COUNTER_FLUSH_INTERVAL,
+    },
+}
+
 CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
@@ -232,6 +292,10 @@ RATELIMIT_USE_CACHE = 'ratelimit'
 RATELIMIT_CACHE_PREFIX = 'rl'
 RATELIMIT_ENABLE = not TESTING
 
+# cache和hbase等热点路径上的日志（utils/tracing.py）默认只记录大小，
+# 开启DEBUG日志时，完整的payload按这个比例采样记录
+TRACE_PAYLOAD_SAMPLE_RATE = 0.01
+
 # Hbase 安装
 # 1。 安装jdk 8，设置java环境变量 https://dlcdn.apache.org/hbase/
 # 2。 解压后修改 hbase配置文件：conf/hbase-env.sh 修改 export JAVA_HOME
@@ -246,6 +310,29 @@ RATELIMIT_ENABLE = not TESTING
 # 11. thrift 连接默认60s会timeout断开，可以去conf/hbase-site.xml中设置hbase.thrift.server.socket.read.timeout这个property来更改，记得重启thrift服务
 # 12。一段时间后hbase会将所有连接（不管有没有在使用）都默认为idle的状态导致连接再次断开，可以设置hbase.thrift.connection.max-idletime去更改idle的最大时间，记得重启thrift服务
 HBASE_HOST = '127.0.0.1'
+# happybase: 连接真实的 hbase thrift server
+# memory: 进程内的 hbase 替身（django_hbase/backends/memory.py），不需要安装 hbase 就可以跑测试和 benchmark，
+# 例如 HBASE_BACKEND=memory python manage.py test
+HBASE_BACKEND = os.environ.get('HBASE_BACKEND', 'happybase')
+# HBase 连接池，每个进程一个连接池，web 进程按线程数设置，fanout 的 celery worker 进程一般 1-2 个就够了
+# 可以用 HBaseClient.get_pool_stats() 里的 wait_time 和 timeouts 来评估大小是否合适
+HBASE_POOL_SIZE = 10
+# 连接池满时最多等待多少秒
+HBASE_POOL_TIMEOUT = 5
+# thrift server 默认 60s 断开 idle 连接，闲置超过这个时间的连接直接淘汰
+HBASE_CONNECTION_MAX_IDLE_TIME = 50
+# 连接最长存活时间，超过后归还时关闭，避免长连接一直粘在同一个 thrift server 上
+HBASE_CONNECTION_MAX_AGE = 60 * 60
+# 闲置超过这个时间的连接在借出前先 ping 一下
+HBASE_POOL_HEALTH_CHECK_INTERVAL = 10
+# HBaseModel.batch() 批量写入时，攒够多少个 mutation 发送一次 thrift 请求
+HBASE_BATCH_SIZE = 1000
+# HBaseModel.parallel_scan() 默认把全表 row key 切成多少段并发 scan，最多 100 段，
+# 并发线程数不超过 HBASE_POOL_SIZE，离线任务可以根据 region server 的数量调整
+HBASE_PARALLEL_SCAN_PARTITIONS = 10
+# HBaseModel 的 Meta 中设置 row_key_codec = 'binary' 和 legacy_table_name 之后，会双写新老两张表，
+# 用 Model.migrate_row_keys() 把老表数据迁移完之后，把新表的 table_name 加到这里，scan 就会改为读新表
+HBASE_ROW_KEY_MIGRATED_TABLES = []
 
 try:
     from .local_settings import *